@@ -0,0 +1,576 @@
+"""
+Modul fuer die Verwaltung eines laufenden KOCHA-Servers ueber einen
+lokalen Unix Domain Socket. Darueber lassen sich Verbindungen anzeigen,
+Nutzer entfernen oder stummschalten, Grenzen und Puffergroeßen ohne
+Neustart aendern und die Stacks aller Threads ausgeben. Das
+Chat-Protokoll bleibt davon unberuehrt.
+
+Aufruf:
+    python3 -m kocha.admin PATH COMMAND [ARGUMENT ...]
+"""
+
+import argparse
+import collections
+import inspect
+import logging
+import math
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+
+from kocha import fanout, log, shared
+
+KOCHA_ADMIN_HELP = (
+    "list                 -- Show all connections\n"
+    "kick <user>          -- Disconnect a user\n"
+    "mute <user> [<sec>]  -- Only allow commands that reach nobody else\n"
+    "unmute <user>        -- Undo mute\n"
+    "get [<name>]         -- Show tunable settings\n"
+    "set <name> <value>   -- Change a setting (0 disables limits)\n"
+    "stacks               -- Dump the stacks of all threads")
+"""
+Liste aller Kommandos des Verwaltungssockets.
+"""
+
+KOCHA_ADMIN_MAX_REQUEST = 4096
+"""
+Die maximale Laenge eines Kommandos in Bytes.
+"""
+
+KOCHA_ADMIN_RATE_WINDOW = 10.0
+"""
+Der Zeitraum in Sekunden, ueber den list die Raten je Verbindung
+mittelt.
+"""
+
+logger = logging.getLogger(__name__)
+"""
+Der Logger fuer Eingriffe ueber den Verwaltungssocket.
+"""
+
+
+def positive(convert):
+    """
+    Einen Konverter erstellen, der nur endliche Werte groeßer 0
+    annimmt.
+
+    Args:
+        convert: Die Funktion, die den Text umwandelt, z.B. int.
+
+    Returns:
+        Die Funktion, die den Text umwandelt und prueft.
+    """
+    def parse(text):
+        value = convert(text)
+        if not math.isfinite(value):
+            raise ValueError("value must be finite")
+        if value <= 0:
+            raise ValueError("value must be greater than 0")
+        return value
+    return parse
+
+
+def optional(convert):
+    """
+    Einen Konverter fuer Grenzen erstellen, die sich mit 0 abschalten
+    lassen.
+
+    Args:
+        convert: Die Funktion, die den Text umwandelt, z.B. int.
+
+    Returns:
+        Die Funktion, die den Text umwandelt und fuer 0 None liefert.
+    """
+    def parse(text):
+        value = convert(text)
+        if not math.isfinite(value):
+            raise ValueError("value must be finite")
+        if value < 0:
+            raise ValueError("value must not be negative")
+        return value or None
+    return parse
+
+
+class KochaAdmin:
+    """
+    Klasse fuer den Verwaltungssocket eines KochaTcpServers. Ein eigener
+    Thread nimmt die Verbindungen nacheinander an. Jede Verbindung
+    schickt ein Kommando als Textzeile und erhaelt die Antwort als
+    Text, bevor sie geschlossen wird. Fehler beginnen mit ``error:``.
+
+    Der Socket ist nur fuer den Benutzer des KOCHA-Servers les- und
+    schreibbar. Wo moeglich, werden außerdem nur Verbindungen dieses
+    Benutzers und von root angenommen.
+    """
+
+    def __init__(self, server, path):
+        """
+        Initialisiert ein Object der Klasse KochaAdmin und startet
+        seinen Thread.
+
+        Args:
+            server: Der KochaTcpServer.
+            path: Pfad des Unix Domain Sockets. Ein verwaister Socket
+                wird vorher entfernt.
+        """
+        self.server = server
+        self.path = path
+
+        # Die Einstellungen, die sich zur Laufzeit aendern lassen, je
+        # Name als Tupel aus Getter, Setter und Konverter. Module
+        # lesen ihre Konstanten bei jeder Verwendung, daher wirken
+        # Aenderungen ohne Neustart. Ausnahme ist bufsize: Bestehende
+        # Verbindungen uebernehmen es erst, wenn ihr Empfangspuffer
+        # nach einem großen Frame wieder schrumpft
+        self.tunables = {
+            "backlog": (
+                lambda: server.backlog, server.set_backlog, positive(int)),
+            "bufsize": self.constant(shared, "KOCHA_BUFSIZE", int),
+            "max-queued": (
+                lambda: shared.KOCHA_MAX_QUEUED,
+                lambda value: setattr(shared, "KOCHA_MAX_QUEUED", value),
+                optional(int)),
+            "max-frame-size": self.constant(
+                shared, "KOCHA_MAX_FRAME_SIZE", int),
+            "lane-batch": self.constant(shared, "KOCHA_LANE_BATCH", int),
+            "fanout-batch": self.constant(
+                fanout, "KOCHA_FANOUT_BATCH", int),
+            "timeout": (
+                lambda: shared.KOCHA_TIMEOUT, self.set_timeout,
+                positive(float)),
+            "max-connections": self.attribute(
+                server, "max_connections", optional(int)),
+            "mailbox-size": self.attribute(
+                server, "mailbox_size", positive(int)),
+            "mailbox-age": self.attribute(
+                server, "mailbox_max_age", positive(float)),
+            "heartbeat-misses": self.attribute(
+                server, "heartbeat_misses", positive(int)),
+            "rate-limit": self.attribute(
+                server, "rate_limit", optional(float)),
+            "rate-burst": self.attribute(
+                server, "rate_burst", positive(int)),
+            "log-level": (
+                lambda: logging.getLevelName(
+                    logging.getLogger("kocha").getEffectiveLevel()).lower(),
+                lambda level: logging.getLogger("kocha").setLevel(level),
+                str.upper),
+        }
+
+        # Die Warteschlange des Protokolls nur, wenn kocha.log laeuft
+        for handler in logging.getLogger("kocha").handlers:
+            if isinstance(handler, log.KochaLogHandler):
+                self.tunables["log-queue"] = self.attribute(
+                    handler, "size", positive(int))
+
+        # Erst nach dem Einschraenken der Rechte lauschen, damit sich
+        # niemand vorher verbinden kann
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(path)
+        os.chmod(path, 0o600)
+        self.socket.listen(1)
+        self.socket.settimeout(shared.KOCHA_TIMEOUT)
+
+        # Je Verbindung die Stichproben der empfangenen und gesendeten
+        # Frames aus dem letzten KOCHA_ADMIN_RATE_WINDOW (siehe sample)
+        self.samples = {}
+
+        self.stopped = False
+        self.thread = threading.Thread(
+            target=self.run, name="admin", daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def constant(module, name, convert):
+        """
+        Getter und Setter fuer eine Konstante eines Moduls erstellen.
+
+        Args:
+            module: Das Modul.
+            name: Der Name der Konstante.
+            convert: Die Funktion, die den Text in einen Wert
+                groeßer 0 umwandelt.
+
+        Returns:
+            Tupel aus Getter, Setter und Konverter.
+        """
+        return (
+            lambda: getattr(module, name),
+            lambda value: setattr(module, name, value),
+            positive(convert))
+
+    @staticmethod
+    def attribute(obj, name, convert):
+        """
+        Getter und Setter fuer ein Attribut eines Objects erstellen.
+
+        Args:
+            obj: Das Object.
+            name: Der Name des Attributs.
+            convert: Die Funktion, die den Text umwandelt und prueft.
+
+        Returns:
+            Tupel aus Getter, Setter und Konverter.
+        """
+        return (
+            lambda: getattr(obj, name),
+            lambda value: setattr(obj, name, value),
+            convert)
+
+    def run(self):
+        """
+        Verbindungen annehmen und ihre Kommandos ausfuehren, bis stop
+        aufgerufen wird.
+        """
+        while not self.stopped:
+            # Der Timeout von accept weckt den Thread regelmaeßig fuer
+            # die Stichproben
+            self.sample()
+            try:
+                connection, _ = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+
+            # Ein Fehler in einem Kommando darf den Thread nicht beenden
+            with connection:
+                try:
+                    self.serve(connection)
+                except OSError:
+                    pass
+                except Exception:
+                    logger.exception("Admin command failed")
+
+    def sample(self):
+        """
+        Fuer jede Verbindung eine Stichprobe der Anzahl empfangener und
+        gesendeter Frames nehmen, hoechstens einmal je Sekunde. Es
+        bleiben nur die Stichproben, die das letzte
+        KOCHA_ADMIN_RATE_WINDOW abdecken.
+        """
+        now = time.monotonic()
+        samples = {}
+        for client in tuple(self.server.handlers):
+            # Eine neue Verbindung beginnt mit der Stichprobe ihres
+            # Verbindens, damit auch ihre ersten Frames zaehlen
+            history = self.samples.get(client)
+            if history is None:
+                history = collections.deque([(client.connected_at, 0, 0)])
+            if not history or now - history[-1][0] >= 1.0:
+                history.append(
+                    (now, client.received, client.writer.frames))
+
+            # Die aelteste Stichprobe behalten, solange keine juengere
+            # das Zeitfenster abdeckt
+            while (len(history) > 1
+                    and history[1][0] <= now - KOCHA_ADMIN_RATE_WINDOW):
+                history.popleft()
+            samples[client] = history
+
+        # Geschlossene Verbindungen fallen dabei heraus
+        self.samples = samples
+
+    def set_timeout(self, timeout):
+        """
+        Den Timeout fuer Sockets aendern, auch fuer alle bestehenden
+        Verbindungen.
+
+        Args:
+            timeout: Der Timeout in Sekunden.
+        """
+        shared.KOCHA_TIMEOUT = timeout
+        for client in tuple(self.server.handlers):
+            try:
+                client.socket.settimeout(timeout)
+            except OSError:
+                pass
+
+    def serve(self, connection):
+        """
+        Das Kommando einer Verbindung lesen, ausfuehren und beantworten.
+
+        Args:
+            connection: Das socket-Object der Verbindung.
+        """
+        connection.settimeout(shared.KOCHA_TIMEOUT)
+
+        # Nur den Benutzer des KOCHA-Servers und root zulassen
+        if hasattr(socket, "SO_PEERCRED"):
+            _, uid, _ = struct.unpack("3i", connection.getsockopt(
+                socket.SOL_SOCKET, socket.SO_PEERCRED,
+                struct.calcsize("3i")))
+            if uid not in (0, os.getuid()):
+                connection.sendall(b"error: permission denied\n")
+                return
+
+        # Bis zum Zeilenende oder dem Schließen der Senderichtung lesen
+        data = b""
+        while b"\n" not in data and len(data) < KOCHA_ADMIN_MAX_REQUEST:
+            chunk = connection.recv(KOCHA_ADMIN_MAX_REQUEST)
+            if not chunk:
+                break
+            data += chunk
+
+        command = data.split(b"\n", 1)[0].decode(errors="replace")
+        response = self.execute(command)
+        connection.sendall(response.encode() + b"\n")
+
+    def execute(self, command):
+        """
+        Ein Kommando ausfuehren.
+
+        Args:
+            command: Das Kommando mit seinen Argumenten.
+
+        Returns:
+            Die Antwort als Text.
+        """
+        name, *args = command.split() or ["help"]
+        handler = {
+            "help": self.on_help,
+            "list": self.on_list,
+            "kick": self.on_kick,
+            "mute": self.on_mute,
+            "unmute": self.on_unmute,
+            "get": self.on_get,
+            "set": self.on_set,
+            "stacks": self.on_stacks,
+        }.get(name)
+        if handler is None:
+            return "error: unknown command {!r}\n{}".format(
+                name, KOCHA_ADMIN_HELP)
+
+        # Die Anzahl der Argumente vorher pruefen, damit ein TypeError
+        # aus dem Kommando selbst nicht als Bedienfehler gilt
+        try:
+            inspect.signature(handler).bind(*args)
+        except TypeError:
+            return "error: wrong arguments\n{}".format(KOCHA_ADMIN_HELP)
+
+        try:
+            return handler(*args)
+        except ValueError as e:
+            return "error: {}".format(e)
+        except Exception as e:
+            logger.exception("Admin command %r failed", name)
+            return "error: {}".format(e)
+
+    def on_help(self):
+        """
+        Die Liste aller Kommandos liefern.
+        """
+        return KOCHA_ADMIN_HELP
+
+    def on_list(self):
+        """
+        Alle Verbindungen mit ausstehenden Frames, Empfangspuffer,
+        mittleren Raten ueber das letzte KOCHA_ADMIN_RATE_WINDOW und
+        Ruhezeit auflisten.
+        """
+        self.sample()
+        now = time.monotonic()
+        clients = dict(self.server.clients)
+        lines = ["{:<24} {:<16} {:>6} {:>8} {:>8} {:>8} {:>6} {}".format(
+            "ADDRESS", "ALIAS", "QUEUED", "BUFFER", "IN/S", "OUT/S",
+            "IDLE", "FLAGS")]
+
+        # Die Threads bearbeiten genau die offenen Verbindungen
+        for client in tuple(self.server.handlers):
+            alias = clients.get(client, "")
+            address = client.address
+            if isinstance(address, tuple):
+                address = "{}:{}".format(*address[:2])
+
+            flags = []
+            if alias and self.server.is_muted(alias):
+                flags.append("muted")
+            if client.throttled and self.server.rate_limit is not None:
+                flags.append("throttled")
+
+            # Raten seit der aeltesten Stichprobe im Zeitfenster. Eine
+            # Verbindung, die erst nach sample kam, hat noch keine
+            since, received, frames = self.samples.get(
+                client, ((client.connected_at, 0, 0),))[0]
+            age = max(now - since, 1e-3)
+            lines.append(
+                "{:<24} {:<16} {:>6} {:>8} {:>8.1f} {:>8.1f} {:>6.0f} {}"
+                .format(
+                    str(address)[:24], alias[:16], client.writer.queued,
+                    len(client.reader.buffer),
+                    (client.received - received) / age,
+                    (client.writer.frames - frames) / age,
+                    now - client.last_seen, ",".join(flags)))
+
+        lines.append("{} connections, {} logged in".format(
+            len(lines) - 1, len(clients)))
+        return "\n".join(lines)
+
+    def on_kick(self, alias):
+        """
+        Einen Nutzer vom KOCHA-Server trennen.
+
+        Args:
+            alias: Der Alias des Nutzers.
+        """
+        if not self.server.kick(alias):
+            raise ValueError("no user {!r}".format(alias))
+        logger.warning("Kicked %s", alias, extra={"alias": alias})
+        return "kicked {}".format(alias)
+
+    def on_mute(self, alias, seconds=None):
+        """
+        Einen Nutzer stummschalten.
+
+        Args:
+            alias: Der Alias des Nutzers.
+            seconds: Die Dauer in Sekunden als Text oder None fuer
+                unbegrenzt.
+        """
+        if seconds is not None:
+            seconds = positive(float)(seconds)
+        self.server.mute(alias, seconds)
+        logger.warning(
+            "Muted %s", alias, extra={"alias": alias, "seconds": seconds})
+        if seconds is None:
+            return "muted {}".format(alias)
+        return "muted {} for {:g} s".format(alias, seconds)
+
+    def on_unmute(self, alias):
+        """
+        Die Stummschaltung eines Nutzers aufheben.
+
+        Args:
+            alias: Der Alias des Nutzers.
+        """
+        if not self.server.unmute(alias):
+            raise ValueError("{!r} is not muted".format(alias))
+        logger.warning("Unmuted %s", alias, extra={"alias": alias})
+        return "unmuted {}".format(alias)
+
+    def on_get(self, name=None):
+        """
+        Eine oder alle Einstellungen liefern.
+
+        Args:
+            name: Der Name der Einstellung oder None fuer alle.
+        """
+        if name is not None and name not in self.tunables:
+            raise ValueError("unknown setting {!r}".format(name))
+
+        names = sorted(self.tunables) if name is None else [name]
+        return "\n".join(
+            "{:<18} {}".format(name, self.tunables[name][0]())
+            for name in names)
+
+    def on_set(self, name, value):
+        """
+        Eine Einstellung aendern.
+
+        Args:
+            name: Der Name der Einstellung.
+            value: Der neue Wert als Text.
+        """
+        if name not in self.tunables:
+            raise ValueError("unknown setting {!r}".format(name))
+
+        getter, setter, convert = self.tunables[name]
+        old = getter()
+        setter(convert(value))
+        logger.warning(
+            "Changed %s from %s to %s", name, old, getter(),
+            extra={"setting": name})
+        return self.on_get(name)
+
+    def on_stacks(self):
+        """
+        Die aktuellen Stacks aller Threads liefern.
+        """
+        frames = sys._current_frames()
+        lines = []
+        for thread in threading.enumerate():
+            frame = frames.get(thread.ident)
+            lines.append("Thread {} ({}{}):".format(
+                thread.name, thread.ident,
+                ", daemon" if thread.daemon else ""))
+            if frame is not None:
+                lines.extend(
+                    line.rstrip("\n")
+                    for line in traceback.format_stack(frame))
+            lines.append("")
+        return "\n".join(lines)
+
+    def stop(self):
+        """
+        Den Thread beenden und den Socket schließen. Der Pfad bleibt
+        bestehen, da ihn bei einem Neustart bereits der Nachfolger
+        gebunden haben kann.
+        """
+        self.stopped = True
+        self.thread.join()
+        self.socket.close()
+
+    @staticmethod
+    def request(path, command):
+        """
+        Ein Kommando an den Verwaltungssocket eines KOCHA-Servers
+        schicken.
+
+        Args:
+            path: Pfad des Unix Domain Sockets.
+            command: Das Kommando mit seinen Argumenten.
+
+        Returns:
+            Die Antwort als Text.
+        """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10 * shared.KOCHA_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(command.encode() + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        return b"".join(chunks).decode(errors="replace")
+
+    @staticmethod
+    def start():
+        """
+        Schickt das Kommando von der Kommandozeile und gibt die Antwort
+        aus.
+        """
+        parser = argparse.ArgumentParser(
+            prog="python3 -m kocha.admin",
+            epilog="commands:\n" + KOCHA_ADMIN_HELP,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+        parser.add_argument(
+            "path", metavar="PATH",
+            help="admin socket of the server (see --admin)")
+        parser.add_argument(
+            "command", metavar="COMMAND", nargs="+",
+            help="command and its arguments, e.g. 'list' or 'mute bob 60'")
+        args = parser.parse_args()
+
+        try:
+            response = KochaAdmin.request(args.path, " ".join(args.command))
+        except OSError as e:
+            print("Couldn't reach the admin socket: {}".format(e),
+                  file=sys.stderr)
+            return 1
+
+        print(response, end="")
+        return 1 if response.startswith("error:") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(KochaAdmin.start())
@@ -0,0 +1,1039 @@
+"""
+Modul mit Benchmarks fuer den KOCHA-Server und den KOCHA-Client.
+
+Aufruf:
+    python3 -m kocha.bench BENCHMARK [OPTIONEN]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import resource
+import selectors
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from kocha import client, log, search, server, shared, snapshot
+
+
+def free_port():
+    """
+    Einen freien TCP-Port auf localhost bestimmen.
+
+    Returns:
+        Die Portnummer.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def run_server(*args):
+    """
+    Einen KOCHA-Server in einem eigenen Prozess starten und warten, bis
+    er Verbindungen annimmt.
+
+    Args:
+        *args: Zusaetzliche Kommandozeilenparameter fuer den
+            KOCHA-Server.
+
+    Yields:
+        Tupel aus dem Port, auf dem der KOCHA-Server lauscht, und dem
+        Prozess des KOCHA-Servers.
+    """
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "kocha.server", "127.0.0.1", str(port)]
+        + list(args),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    try:
+        # Warten, bis der KOCHA-Server Verbindungen annimmt
+        deadline = time.monotonic() + 10.0
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), 0.1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+        yield port, process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def create_certificate(directory):
+    """
+    Ein selbstsigniertes Zertifikat fuer localhost mit openssl erstellen.
+
+    Args:
+        directory: Das Verzeichnis, in dem Zertifikat und Schluessel
+            abgelegt werden.
+
+    Returns:
+        Tupel aus dem Pfad zum Zertifikat und dem Pfad zum Schluessel.
+    """
+    certfile = os.path.join(directory, "cert.pem")
+    keyfile = os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+         "-keyout", keyfile, "-out", certfile, "-days", "1",
+         "-subj", "/CN=localhost",
+         "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return certfile, keyfile
+
+
+def measure_connects(kocha_tcp_client, count, resume):
+    """
+    Den KochaTcpClient wiederholt verbinden, anmelden und trennen.
+
+    Args:
+        kocha_tcp_client: Der KochaTcpClient.
+        count: Die Anzahl der Verbindungen.
+        resume: Gibt an, ob die TLS-Session der vorherigen Verbindung
+            wiederaufgenommen wird.
+
+    Returns:
+        Tupel aus der Anzahl der Verbindungen pro Sekunde und der Anzahl
+        der wiederaufgenommenen TLS-Sessions.
+    """
+    reused = 0
+    start = time.perf_counter()
+    for i in range(count):
+        if not resume:
+            kocha_tcp_client.tls_session = None
+
+        kocha_tcp_client.connect()
+        kocha_tcp_client.last_seq = None
+        kocha_tcp_client.login("bench{}".format(i))
+
+        if (isinstance(kocha_tcp_client.socket, ssl.SSLSocket)
+                and kocha_tcp_client.socket.session_reused):
+            reused += 1
+
+        kocha_tcp_client.socket.close()
+
+    elapsed = time.perf_counter() - start
+    return count / elapsed, reused
+
+
+def bench_tls(args):
+    """
+    Die Verbindungsrate ohne TLS, mit vollstaendigem TLS-Handshake und
+    mit wiederaufgenommener TLS-Session vergleichen.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        certfile, keyfile = create_certificate(directory)
+
+        print("{:<10} {:>12} {:>8}".format("mode", "connects/s", "reused"))
+
+        with run_server() as (port, _):
+            plain = client.KochaTcpClient("127.0.0.1", port)
+            rate, _ = measure_connects(plain, args.count, resume=False)
+            print("{:<10} {:>12.1f} {:>8}".format("plaintext", rate, "-"))
+
+        with run_server(
+                "--certfile", certfile, "--keyfile", keyfile) as (port, _):
+            tls = client.KochaTcpClient(
+                "localhost", port, tls=True, cafile=certfile)
+            for mode, resume in (("full", False), ("resumed", True)):
+                # Eine erste Verbindung fuer das Session Ticket aufbauen
+                measure_connects(tls, 1, resume=False)
+                rate, reused = measure_connects(tls, args.count, resume)
+                print("{:<10} {:>12.1f} {:>8}".format(mode, rate, reused))
+
+
+def measure_transport(connect, count, name):
+    """
+    Latenz und Durchsatz einer Verbindungsart zum KOCHA-Server messen.
+
+    Args:
+        connect: Funktion, die einen neuen, verbundenen KochaTcpClient
+            zurueckgibt.
+        count: Die Anzahl der Anfragen bzw. Nachrichten.
+        name: Praefix fuer die Aliase der beiden KochaTcpClients.
+
+    Returns:
+        Tupel aus der mittleren Latenz einer Anfrage in Mikrosekunden und
+        der Anzahl zugestellter Nachrichten pro Sekunde.
+    """
+    sender, receiver = connect(), connect()
+    sender.try_login(name + "-sender")
+    receiver.try_login(name + "-receiver")
+
+    # Latenz: Anfrage und Antwort nacheinander (/h wird nur vom
+    # KOCHA-Server beantwortet)
+    start = time.perf_counter()
+    for _ in range(count):
+        sender.send(shared.KochaMessage(content="/h"))
+        sender.receive()
+    latency = (time.perf_counter() - start) / count * 1e6
+
+    # Durchsatz: Nachrichten von sender ueber den KOCHA-Server an
+    # receiver; der Empfang laeuft parallel, damit keine Seite auf
+    # volle Socketpuffer wartet
+    def receive_all():
+        received = 0
+        while received < count:
+            message = receiver.receive()
+            if message.sender == sender.alias:
+                received += 1
+
+    worker = threading.Thread(target=receive_all)
+    start = time.perf_counter()
+    worker.start()
+    for _ in range(count):
+        sender.send(shared.KochaMessage(content="x" * 100))
+    worker.join()
+    throughput = count / (time.perf_counter() - start)
+
+    sender.socket.close()
+    receiver.socket.close()
+    return latency, throughput
+
+
+def bench_transport(args):
+    """
+    TCP ueber localhost mit einem Unix Domain Socket vergleichen.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        unix_path = os.path.join(directory, "kocha.sock")
+
+        print("{:<10} {:>14} {:>12}".format(
+            "transport", "latency (us)", "messages/s"))
+
+        # Jede Verbindungsart gegen einen frisch gestarteten KOCHA-Server
+        # messen, der auf beiden Sockets lauscht
+        for name in ("tcp", "unix"):
+            with run_server("--unix", unix_path) as (port, _):
+                if name == "tcp":
+                    def connect():
+                        return client.KochaTcpClient("127.0.0.1", port)
+                else:
+                    def connect():
+                        return client.KochaTcpClient(unix_path=unix_path)
+
+                latency, throughput = measure_transport(
+                    connect, args.count, name)
+                print("{:<10} {:>14.1f} {:>12.1f}".format(
+                    name, latency, throughput))
+
+
+@contextlib.contextmanager
+def run_local_server(**kwargs):
+    """
+    Einen KOCHA-Server im eigenen Prozess starten, damit ein Benchmark
+    auf dessen Zustand (z.B. Statistiken) zugreifen kann. Die Ausgaben
+    des KOCHA-Servers werden unterdrueckt, Ausgaben des Benchmarks
+    muessen daher nach dem Verlassen des Kontexts erfolgen.
+
+    Args:
+        **kwargs: Zusaetzliche Parameter fuer den KochaTcpServer.
+
+    Yields:
+        Der KochaTcpServer.
+    """
+    with contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        kocha_tcp_server = server.KochaTcpServer(
+            host="127.0.0.1", port=0, **kwargs)
+        worker = threading.Thread(target=kocha_tcp_server.loop, daemon=True)
+        worker.start()
+        try:
+            yield kocha_tcp_server
+        finally:
+            kocha_tcp_server.stop = True
+            worker.join()
+
+
+def drain(kocha_tcp_client, count):
+    """
+    So lange Daten vom KOCHA-Server lesen und verwerfen, bis count
+    Frames empfangen wurden.
+
+    Args:
+        kocha_tcp_client: Der angemeldete KochaTcpClient.
+        count: Die Anzahl der erwarteten Frames.
+    """
+    reader = kocha_tcp_client.reader
+    received = reader.buffer.count(
+        shared.KOCHA_FRAME_DELIMITER, reader.start, reader.end)
+    while received < count:
+        data = kocha_tcp_client.socket.recv(65536)
+        if not data:
+            return
+        received += data.count(shared.KOCHA_FRAME_DELIMITER)
+
+
+def bench_writes(args):
+    """
+    Die Anzahl der Systemaufrufe pro zugestellter Nachricht bei einem
+    Broadcast-Burst messen, einmal mit gesammelten (vektorisierten)
+    Schreibvorgaengen und einmal mit einem Systemaufruf pro Frame.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    print("{:<10} {:>10} {:>10} {:>14} {:>12}".format(
+        "mode", "frames", "syscalls", "frames/syscall", "messages/s"))
+
+    cork = shared.KochaFrameWriter.__dict__["cork"]
+    for mode in ("per-frame", "batched"):
+        # Zum Vergleich das Sammeln der Frames abschalten
+        if mode == "per-frame":
+            shared.KochaFrameWriter.cork = classmethod(
+                lambda cls: contextlib.nullcontext())
+        else:
+            shared.KochaFrameWriter.cork = cork
+
+        with run_local_server() as kocha_tcp_server:
+            port = kocha_tcp_server.socket.getsockname()[1]
+
+            receivers = []
+            for i in range(args.receivers):
+                receiver = client.KochaTcpClient("127.0.0.1", port)
+                receiver.try_login("receiver{}".format(i))
+                receivers.append(receiver)
+
+            sender = client.KochaTcpClient("127.0.0.1", port)
+            sender.try_login("sender")
+
+            # Zustellung an alle Empfaenger parallel abwarten
+            workers = [
+                threading.Thread(target=drain, args=(receiver, args.count))
+                for receiver in receivers]
+
+            start = time.perf_counter()
+            for worker in workers:
+                worker.start()
+            for i in range(args.count):
+                sender.send(shared.KochaMessage(content="x" * 100))
+            for worker in workers:
+                worker.join()
+            elapsed = time.perf_counter() - start
+
+            writers = [cli.writer for cli in kocha_tcp_server.clients]
+            frames = sum(writer.frames for writer in writers)
+            syscalls = sum(writer.syscalls for writer in writers)
+
+            for cli in receivers + [sender]:
+                cli.socket.close()
+
+        print("{:<10} {:>10} {:>10} {:>14.1f} {:>12.1f}".format(
+            mode,
+            frames,
+            syscalls,
+            frames / syscalls,
+            args.count * args.receivers / elapsed))
+
+    shared.KochaFrameWriter.cork = cork
+
+
+def proc_status(pid, field):
+    """
+    Einen Zahlenwert aus /proc/<pid>/status lesen.
+
+    Args:
+        pid: Die Prozess-ID.
+        field: Der Name des Feldes, z.B. "VmRSS" (in KiB) oder
+            "Threads".
+
+    Returns:
+        Der Wert als int.
+    """
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+
+
+def bench_memory(args):
+    """
+    Den Speicherbedarf (RSS) des KOCHA-Servers pro offener, untaetiger
+    Verbindung messen.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    # So viele Dateideskriptoren wie moeglich erlauben
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    server_args = []
+    if args.stack_size is not None:
+        server_args = ["--stack-size", str(args.stack_size)]
+
+    results = []
+    for count in args.connections:
+        with run_server(*server_args) as (port, process):
+            # Die Verbindung aus run_server ist noch nicht abgebaut
+            time.sleep(0.5)
+            rss_before = proc_status(process.pid, "VmRSS")
+            threads_before = proc_status(process.pid, "Threads")
+
+            def wait_for_handlers(backlog):
+                # Warten, bis der KOCHA-Server bis auf backlog alle
+                # Verbindungen angenommen hat (ein Thread je Verbindung)
+                deadline = time.monotonic() + 10.0
+                while (proc_status(process.pid, "Threads") + backlog
+                        < threads_before + len(sockets)):
+                    if time.monotonic() > deadline:
+                        raise OSError("server stopped accepting")
+                    time.sleep(0.001)
+
+            sockets = []
+            error = None
+            try:
+                # Ein paar Dateideskriptoren fuer den Benchmark selbst
+                # frei lassen
+                if count > hard - 64:
+                    error = "limited by RLIMIT_NOFILE={}".format(hard)
+                for _ in range(min(count, hard - 64)):
+                    sockets.append(
+                        socket.create_connection(("127.0.0.1", port)))
+
+                    # Nicht schneller verbinden, als der KOCHA-Server
+                    # annimmt, damit keine Verbindung in der vollen
+                    # Warteschlange von listen() haengen bleibt
+                    wait_for_handlers(backlog=4)
+            except OSError as e:
+                error = e
+
+            # Nur Verbindungen zaehlen, fuer die der KOCHA-Server einen
+            # Thread gestartet hat
+            time.sleep(1.0)
+            opened = min(
+                len(sockets),
+                proc_status(process.pid, "Threads") - threads_before)
+
+            rss_after = proc_status(process.pid, "VmRSS")
+            for sock in sockets:
+                sock.close()
+
+        per_connection = (rss_after - rss_before) / opened if opened else 0
+        results.append((count, opened, rss_after, per_connection, error))
+
+    print("{:>12} {:>8} {:>10} {:>16}".format(
+        "connections", "opened", "RSS (MiB)", "KiB/connection"))
+    for count, opened, rss, per_connection, error in results:
+        print("{:>12} {:>8} {:>10.1f} {:>16.1f}{}".format(
+            count,
+            opened,
+            rss / 1024,
+            per_connection,
+            "  ({})".format(error) if error else ""))
+
+
+def bench_accept(args):
+    """
+    Einen Ansturm gleichzeitiger Anmeldungen (z.B. nach einem
+    Neustart) auf KOCHA-Server mit unterschiedlich langer Warteschlange
+    fuer Verbindungen simulieren und die Zeit bis zur
+    Willkommensnachricht messen.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    # Fuer jede Verbindung wird ein Dateideskriptor benoetigt
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    results = []
+    for backlog in args.backlog:
+        with run_server("--backlog", str(backlog)) as (port, _):
+            # Alle Verbindungen ohne zu blockieren gleichzeitig aufbauen
+            selector = selectors.DefaultSelector()
+            start = time.perf_counter()
+            for i in range(args.connections):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                sock.connect_ex(("127.0.0.1", port))
+                selector.register(sock, selectors.EVENT_WRITE, i)
+
+            # Nach dem Verbindungsaufbau anmelden und auf die
+            # Willkommensnachricht warten
+            latencies = []
+            deadline = time.monotonic() + 60.0
+            while selector.get_map() and time.monotonic() < deadline:
+                for key, events in selector.select(1.0):
+                    sock = key.fileobj
+                    if events & selectors.EVENT_WRITE:
+                        request = shared.KochaMessage(
+                            content="/login user{}".format(key.data))
+                        sock.send(shared.JsonUtils.to_frame(request))
+                        selector.modify(sock, selectors.EVENT_READ, key.data)
+                    else:
+                        sock.recv(shared.KOCHA_BUFSIZE)
+                        latencies.append(time.perf_counter() - start)
+                        selector.unregister(sock)
+                        sock.close()
+
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+            selector.close()
+
+        latencies.sort()
+        results.append((backlog, latencies))
+
+    print("{:>8} {:>8} {:>10} {:>10} {:>10}".format(
+        "backlog", "welcomed", "p50 (ms)", "p99 (ms)", "max (ms)"))
+    for backlog, latencies in results:
+        if not latencies:
+            print("{:>8} {:>8}".format(backlog, 0))
+            continue
+        print("{:>8} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            backlog,
+            len(latencies),
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.99)] * 1e3,
+            latencies[-1] * 1e3))
+
+
+def bench_search(args):
+    """
+    Die Latenz von /search bei einem Index mit vielen Nachrichten
+    messen.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    # Woerter nach dem Zipfschen Gesetz verteilen, damit es wie in
+    # echten Texten sehr haeufige und sehr seltene Woerter gibt
+    rng = random.Random(0)
+    vocabulary = ["w{}".format(i) for i in range(args.vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(args.vocabulary)]
+    words = rng.choices(vocabulary, weights, k=8 * args.messages)
+    senders = ["user{}".format(i) for i in range(1000)]
+
+    index = search.KochaSearchIndex()
+    start = time.perf_counter()
+    sent_at = time.time() - args.messages
+    with index.lock:
+        for i in range(args.messages):
+            index.index(
+                sent_at + i, senders[i % len(senders)], False, None,
+                " ".join(words[8 * i:8 * i + 8]))
+    build = time.perf_counter() - start
+
+    # Haeufige und seltene Woerter, Kombinationen und Filter
+    queries = [
+        ("common word", dict(words="w0")),
+        ("rare word", dict(words="w{}".format(args.vocabulary - 1))),
+        ("two common words", dict(words="w1 w2")),
+        ("common and rare word", dict(
+            words="w0 w{}".format(args.vocabulary - 1))),
+        ("word from sender", dict(words="w5", sender="user7")),
+        ("word in last 10%", dict(
+            words="w3", after=sent_at + args.messages * 0.9)),
+        ("common word, page 10", dict(words="w0", page=10)),
+    ]
+
+    print("{} messages indexed in {:.1f} s ({:.0f} messages/s)".format(
+        args.messages, build, args.messages / build))
+    print("{:<24} {:>10} {:>10}".format("query", "p50 (ms)", "p99 (ms)"))
+    for name, query in queries:
+        latencies = []
+        for _ in range(args.count):
+            start = time.perf_counter()
+            index.search("user0", **query)
+            latencies.append((time.perf_counter() - start) * 1e3)
+        latencies.sort()
+        print("{:<24} {:>10.3f} {:>10.3f}".format(
+            name,
+            latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)]))
+
+    index.close()
+
+
+def bench_lanes(args):
+    """
+    Die Wartezeit von Antworten messen, waehrend ein langsam lesender
+    Client mit Broadcasts ueberflutet wird, einmal mit allen Frames in
+    derselben Spur (fifo) und einmal mit gewichteten Spuren. Gemessen
+    wird der KochaFrameWriter allein ueber ein Socketpaar, dessen eine
+    Seite mit begrenzter Rate gelesen wird.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    print("{:<6} {:>8} {:>10} {:>10} {:>10}   {}".format(
+        "mode", "replies", "p50 (ms)", "p99 (ms)", "max (ms)",
+        "queueing per lane: mean / max (ms)"))
+
+    for mode in ("fifo", "lanes"):
+        sock, peer = socket.socketpair()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 64 * 1024)
+        writer = shared.KochaFrameWriter(sock)
+        reply_lane = (
+            shared.KOCHA_LANE_BROADCAST if mode == "fifo"
+            else shared.KOCHA_LANE_DIRECT)
+
+        def read_slowly(latencies):
+            # Hoechstens 16 KiB je Millisekunde lesen und die Antworten
+            # am Zeitstempel erkennen
+            pending = b""
+            while True:
+                time.sleep(0.001)
+                data = peer.recv(16 * 1024)
+                if not data:
+                    return
+                *frames, pending = (pending + data).split(b"\n")
+                now = time.perf_counter()
+                for frame in frames:
+                    if frame.startswith(b"R"):
+                        latencies.append(now - float(frame[1:]))
+
+        def flood():
+            frame = b"B" + b"x" * 1000 + b"\n"
+            for _ in range(args.count):
+                writer.write(frame, shared.KOCHA_LANE_BROADCAST)
+
+        # Mehrere Sender wie beim KOCHA-Server: Waehrend einer von
+        # ihnen sendet, reihen die anderen ihre Frames ein
+        latencies = []
+        reader = threading.Thread(target=read_slowly, args=(latencies,))
+        flooders = [
+            threading.Thread(target=flood) for _ in range(args.senders)]
+        reader.start()
+        for flooder in flooders:
+            flooder.start()
+
+        # Waehrend des Rueckstaus regelmaeßig eine Antwort einreihen
+        while any(flooder.is_alive() for flooder in flooders):
+            writer.write(
+                "R{!r}\n".format(time.perf_counter()).encode(), reply_lane)
+            time.sleep(0.01)
+        for flooder in flooders:
+            flooder.join()
+        writer.flush()
+        sock.close()
+        reader.join()
+        peer.close()
+
+        latencies.sort()
+        print("{:<6} {:>8} {:>10.1f} {:>10.1f} {:>10.1f}   {}".format(
+            mode,
+            len(latencies),
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.99)] * 1e3,
+            latencies[-1] * 1e3,
+            ", ".join(
+                "{} {:.1f} / {:.1f}".format(
+                    name,
+                    waited[1] / waited[0] * 1e3,
+                    waited[2] * 1e3)
+                for name, waited in zip(
+                    shared.KOCHA_LANE_NAMES, writer.waited)
+                if waited[0])))
+
+
+def discard(client_sockets):
+    """
+    Die bei virtuellen Clients eingegangenen Daten verwerfen.
+
+    Args:
+        client_sockets: Die KochaMemorySockets der virtuellen Clients.
+
+    Returns:
+        Die Anzahl der verworfenen Frames.
+    """
+    frames = 0
+    for client_socket in client_sockets:
+        while True:
+            try:
+                data = client_socket.recv(1 << 20)
+            except BlockingIOError:
+                break
+            frames += data.count(shared.KOCHA_FRAME_DELIMITER)
+    return frames
+
+
+def login_memory(kocha_tcp_server, count):
+    """
+    Virtuelle Clients ohne eigene Threads verbinden und anmelden (siehe
+    KochaTcpServer.connect_memory). Die Antworten werden verworfen.
+
+    Args:
+        kocha_tcp_server: Der KochaTcpServer.
+        count: Die Anzahl der virtuellen Clients.
+
+    Returns:
+        Tupel aus der Liste der KochaMemorySockets der Clients und der
+        Liste ihrer KochaTcpConnections auf Seite des KOCHA-Servers.
+    """
+    client_sockets, connections = [], []
+    for i in range(count):
+        client_socket, connection = kocha_tcp_server.connect_memory(
+            "client{}".format(i), threaded=False)
+        client_socket.setblocking(False)
+        client_socket.sendall(shared.JsonUtils.to_frame(
+            shared.KochaMessage(content="/login user{}".format(i))))
+        kocha_tcp_server.pump(connection)
+        client_sockets.append(client_socket)
+        connections.append(connection)
+
+        # Jede Anmeldung wird allen anderen gemeldet, daher die
+        # Meldungen regelmaeßig verwerfen
+        if i % 100 == 99:
+            discard(client_sockets)
+
+    # Meldungen ueber Shards sind erst danach sicher zugestellt
+    if kocha_tcp_server.fanout is not None:
+        kocha_tcp_server.fanout.flush()
+    discard(client_sockets)
+    return client_sockets, connections
+
+
+def bench_dispatch(args):
+    """
+    Dekodieren, Bearbeiten und Verteilen von Anfragen ohne Netzwerk
+    messen. Alle virtuellen Clients werden ueber KochaMemorySockets aus
+    einem Thread bedient, daher fallen weder Systemaufrufe noch
+    Threadwechsel an.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        kocha_tcp_server = server.KochaTcpServer(port=None, notice_window=0)
+        client_sockets, connections = login_memory(
+            kocha_tcp_server, args.clients)
+
+        def measure(content):
+            # Jeweils ein anderer Client sendet die Anfrage. Gemessen
+            # wird nur die Bearbeitung durch den KOCHA-Server, die
+            # Antworten werden danach verworfen
+            elapsed, delivered = 0.0, 0
+            for i in range(args.count):
+                frame = shared.JsonUtils.to_frame(
+                    shared.KochaMessage(content=content(i)))
+                client_sockets[i % args.clients].sendall(frame)
+                start = time.perf_counter()
+                kocha_tcp_server.pump(connections[i % args.clients])
+                elapsed += time.perf_counter() - start
+                if i % 100 == 99 or i == args.count - 1:
+                    delivered += discard(client_sockets)
+            return elapsed, delivered
+
+        frame = shared.JsonUtils.to_frame(
+            shared.KochaMessage(content="x" * 100))[:-1].decode()
+        start = time.perf_counter()
+        for _ in range(args.count):
+            shared.JsonUtils.to_kocha_message(frame)
+        results = [("decode", time.perf_counter() - start, 0)]
+
+        results.append(("help", *measure(lambda i: "/h")))
+        results.append(("dm", *measure(lambda i: "/dm user{} {}".format(
+            (i + 1) % args.clients, "x" * 100))))
+        results.append(("broadcast", *measure(lambda i: "x" * 100)))
+
+        kocha_tcp_server.close()
+
+    print("{} virtual clients, {} requests per phase".format(
+        args.clients, args.count))
+    print("{:<10} {:>14} {:>12} {:>14}".format(
+        "phase", "us/request", "requests/s", "frames out/s"))
+    for name, elapsed, delivered in results:
+        print("{:<10} {:>14.2f} {:>12.0f} {:>14.0f}".format(
+            name,
+            elapsed / args.count * 1e6,
+            args.count / elapsed,
+            delivered / elapsed))
+
+
+def bench_fanout(args):
+    """
+    Die Dauer bis zur Zustellung einer oeffentlichen Nachricht an alle
+    Clients je Raumgroeße messen: einmal im Thread des Senders und
+    einmal ueber 1, 2, 4 und 8 Shards (siehe kocha.fanout). Die
+    virtuellen Clients sind ueber KochaMemorySockets verbunden.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    print("{:>6} {:>7} {:>12} {:>14} {:>14}".format(
+        "room", "shards", "sender (us)", "p50 (ms)", "p99 (ms)"))
+    for size in args.sizes:
+        for shards in [0] + args.shards:
+            # Die Meldungen ueber Anmeldungen nur sammeln, sonst kostet
+            # das Anmelden quadratisch viele Frames
+            kocha_tcp_server = server.KochaTcpServer(
+                port=None, notice_window=3600, notice_threshold=0,
+                fanout_shards=shards)
+            client_sockets, connections = login_memory(
+                kocha_tcp_server, size)
+
+            # Der erste Client sendet, gemessen wird die Bearbeitung im
+            # Thread des Senders und die Zeit, bis alle Empfaenger die
+            # Nachricht haben
+            frame = shared.JsonUtils.to_frame(
+                shared.KochaMessage(content="x" * 100))
+            senders, latencies = [], []
+            for _ in range(args.count):
+                client_sockets[0].sendall(frame)
+                start = time.perf_counter()
+                kocha_tcp_server.pump(connections[0])
+                sent = time.perf_counter()
+                if kocha_tcp_server.fanout is not None:
+                    kocha_tcp_server.fanout.flush()
+                latencies.append(time.perf_counter() - start)
+                senders.append(sent - start)
+                discard(client_sockets)
+
+            kocha_tcp_server.close()
+            senders.sort()
+            latencies.sort()
+            print("{:>6} {:>7} {:>12.1f} {:>14.2f} {:>14.2f}".format(
+                size,
+                shards or "inline",
+                senders[len(senders) // 2] * 1e6,
+                latencies[len(latencies) // 2] * 1e3,
+                latencies[int(len(latencies) * 0.99)] * 1e3))
+
+
+def bench_snapshot(args):
+    """
+    Sichern und Wiederherstellen eines großen Zustands messen: ein
+    voller Verlauf und --messages Direct-Messages fuer abgemeldete
+    Nutzer. Verglichen wird die Sicherung mit dem JSON-Zustand, den
+    auch der Neustart ohne Verbindungsabbruch uebertraegt.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "state.snap")
+        kocha_tcp_server = server.KochaTcpServer(
+            port=None, notice_window=0, heartbeat_interval=0,
+            snapshot_path=path, snapshot_interval=3600,
+            mailbox_size=args.messages)
+
+        # Ein Client fuellt den Verlauf und die Mailboxen abgemeldeter
+        # Nutzer
+        client_sockets, connections = login_memory(kocha_tcp_server, 1)
+        text = "x" * 100
+        for i in range(args.messages):
+            if i < server.KOCHA_HISTORY_SIZE:
+                content = text
+            else:
+                content = "/dm offline{} {}".format(i % args.users, text)
+            client_sockets[0].sendall(shared.JsonUtils.to_frame(
+                shared.KochaMessage(content=content)))
+            kocha_tcp_server.pump(connections[0])
+            if i % 1000 == 999:
+                discard(client_sockets)
+
+        # Sichern: Zustand kopieren und kodieren, dann schreiben
+        start = time.perf_counter()
+        state = kocha_tcp_server.get_snapshot()
+        collected = time.perf_counter()
+        kocha_tcp_server.snapshot.save(state)
+        saved = time.perf_counter()
+        size = os.path.getsize(path)
+
+        # Zum Vergleich der JSON-Zustand wie beim Neustart
+        json_start = time.perf_counter()
+        data = json.dumps(kocha_tcp_server.get_state([]))
+        json_saved = time.perf_counter()
+        kocha_tcp_server.close()
+
+        # Wiederherstellen: die Sicherung lesen und uebernehmen
+        start_load = time.perf_counter()
+        restored = server.KochaTcpServer(
+            port=None, heartbeat_interval=0, snapshot_path=path,
+            snapshot_interval=3600, mailbox_size=args.messages)
+        loaded = time.perf_counter()
+        restored_seq = restored.last_seq
+        restored.snapshot.stop()
+
+        json_load = time.perf_counter()
+        other = server.KochaTcpServer(
+            port=None, heartbeat_interval=0, mailbox_size=args.messages)
+        other.set_state(json.loads(data), [])
+        json_loaded = time.perf_counter()
+
+    print("{} messages in history and mailboxes, last seq {} "
+          "(restored {})".format(
+              args.messages, kocha_tcp_server.last_seq, restored_seq))
+    print("{:<9} {:>10} {:>12} {:>10} {:>10}".format(
+        "format", "size (MB)", "collect (ms)", "save (ms)", "load (ms)"))
+    print("{:<9} {:>10.1f} {:>12.0f} {:>10.0f} {:>10.0f}".format(
+        "snapshot", size / 1e6, (collected - start) * 1e3,
+        (saved - collected) * 1e3, (loaded - start_load) * 1e3))
+    print("{:<9} {:>10.1f} {:>12} {:>10.0f} {:>10.0f}".format(
+        "json", len(data) / 1e6, "-", (json_saved - json_start) * 1e3,
+        (json_loaded - json_load) * 1e3))
+
+
+def bench_log(args):
+    """
+    Die Dauer eines Protokollaufrufs im Thread des Aufrufers messen,
+    wenn der Datentraeger fuer jeden Eintrag --delay Millisekunden
+    braucht: einmal direkt geschrieben und einmal ueber KochaLog.
+
+    Args:
+        args: Die Kommandozeilenparameter.
+    """
+    class SlowHandler(logging.Handler):
+        # Simuliert einen langsamen Datentraeger
+        def emit(self, record):
+            self.format(record)
+            time.sleep(args.delay / 1e3)
+
+    logger = logging.getLogger("kocha.bench")
+    results = []
+    for mode in ("direct", "queued"):
+        # Im Modus queued schreibt der Thread von KochaLog
+        kocha_log = None
+        if mode == "direct":
+            handler = SlowHandler()
+            logger.addHandler(handler)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
+        else:
+            kocha_log = log.KochaLog(level="info")
+            kocha_log.listener.handlers = (SlowHandler(),)
+            kocha_log.start()
+
+        latencies = []
+        for i in range(args.count):
+            start = time.perf_counter()
+            logger.info("Connection from %s", i, extra={"address": i})
+            latencies.append(time.perf_counter() - start)
+
+        if kocha_log is None:
+            logger.removeHandler(handler)
+            logger.propagate = True
+            dropped = 0
+        else:
+            dropped = kocha_log.handler.dropped
+            kocha_log.handler.dropped = 0
+            kocha_log.close()
+
+        latencies.sort()
+        results.append((mode, latencies, dropped))
+
+    print("{} records, {} ms per record on disk".format(
+        args.count, args.delay))
+    print("{:<8} {:>10} {:>10} {:>10} {:>9}".format(
+        "mode", "p50 (us)", "p99 (us)", "max (us)", "dropped"))
+    for mode, latencies, dropped in results:
+        print("{:<8} {:>10.1f} {:>10.1f} {:>10.1f} {:>9}".format(
+            mode,
+            latencies[len(latencies) // 2] * 1e6,
+            latencies[int(len(latencies) * 0.99)] * 1e6,
+            latencies[-1] * 1e6,
+            dropped))
+
+
+def main():
+    """
+    Die Kommandozeilenparameter auswerten und den gewaehlten Benchmark
+    ausfuehren.
+    """
+    parser = argparse.ArgumentParser(prog="python3 -m kocha.bench")
+    benchmarks = parser.add_subparsers(dest="benchmark", metavar="BENCHMARK")
+    benchmarks.required = True
+
+    tls = benchmarks.add_parser(
+        "tls", help="compare plaintext, full and resumed TLS connect rates")
+    tls.add_argument("--count", type=int, default=200)
+    tls.set_defaults(func=bench_tls)
+
+    transport = benchmarks.add_parser(
+        "transport", help="compare tcp and unix domain socket transports")
+    transport.add_argument("--count", type=int, default=5000)
+    transport.set_defaults(func=bench_transport)
+
+    writes = benchmarks.add_parser(
+        "writes", help="count syscalls per message during a broadcast burst")
+    writes.add_argument("--count", type=int, default=5000)
+    writes.add_argument("--receivers", type=int, default=20)
+    writes.set_defaults(func=bench_writes)
+
+    memory = benchmarks.add_parser(
+        "memory", help="measure server RSS per idle connection")
+    memory.add_argument(
+        "--connections", type=int, nargs="+", default=[1000, 10000, 50000])
+    memory.add_argument(
+        "--stack-size", metavar="KIB", type=int,
+        help="stack size of the server's handler threads in KiB")
+    memory.set_defaults(func=bench_memory)
+
+    accept = benchmarks.add_parser(
+        "accept", help="measure login latency during a reconnect storm")
+    accept.add_argument("--connections", type=int, default=500)
+    accept.add_argument(
+        "--backlog", type=int, nargs="+", default=[5, server.KOCHA_BACKLOG])
+    accept.set_defaults(func=bench_accept)
+
+    search_parser = benchmarks.add_parser(
+        "search", help="measure /search latency on a large index")
+    search_parser.add_argument("--messages", type=int, default=1000000)
+    search_parser.add_argument("--vocabulary", type=int, default=20000)
+    search_parser.add_argument("--count", type=int, default=200)
+    search_parser.set_defaults(func=bench_search)
+
+    lanes = benchmarks.add_parser(
+        "lanes", help="measure reply latency behind a broadcast backlog")
+    lanes.add_argument("--senders", type=int, default=4)
+    lanes.add_argument("--count", type=int, default=5000)
+    lanes.set_defaults(func=bench_lanes)
+
+    dispatch = benchmarks.add_parser(
+        "dispatch", help="measure request handling without sockets")
+    dispatch.add_argument("--clients", type=int, default=1000)
+    dispatch.add_argument("--count", type=int, default=2000)
+    dispatch.set_defaults(func=bench_dispatch)
+
+    fanout_parser = benchmarks.add_parser(
+        "fanout", help="measure broadcast delivery latency per shard count")
+    fanout_parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+    fanout_parser.add_argument(
+        "--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    fanout_parser.add_argument("--count", type=int, default=100)
+    fanout_parser.set_defaults(func=bench_fanout)
+
+    snapshot_parser = benchmarks.add_parser(
+        "snapshot", help="measure saving and restoring a large state")
+    snapshot_parser.add_argument("--messages", type=int, default=100000)
+    snapshot_parser.add_argument("--users", type=int, default=1000)
+    snapshot_parser.set_defaults(func=bench_snapshot)
+
+    log_parser = benchmarks.add_parser(
+        "log", help="measure logging latency with a slow disk")
+    log_parser.add_argument("--count", type=int, default=2000)
+    log_parser.add_argument(
+        "--delay", metavar="MS", type=float, default=1.0)
+    log_parser.set_defaults(func=bench_log)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
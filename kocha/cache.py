@@ -0,0 +1,271 @@
+"""
+Modul fuer den lokalen Verlauf des KOCHA-Clients. Die angezeigten
+Nachrichten werden je KOCHA-Server und Alias auf dem Datentraeger
+gesammelt, sodass der KOCHA-Client beim Start sofort den letzten
+Bildschirm zeigt und vom KOCHA-Server nur neuere Nachrichten abruft.
+"""
+
+import os
+import struct
+import threading
+import urllib.parse
+
+from kocha import shared
+
+KOCHA_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "kocha")
+"""
+Das Verzeichnis, in dem der KOCHA-Client seinen Verlauf ablegt.
+"""
+
+KOCHA_CACHE_TAIL = 200
+"""
+Die Anzahl der Nachrichten, die beim Start aus dem Verlauf geladen
+werden. Sie genuegt, um auch ein großes Terminal zu fuellen.
+"""
+
+KOCHA_CACHE_SIZE = 100000
+"""
+Die maximale Anzahl an Nachrichten im Verlauf. Beim Oeffnen werden
+aeltere Nachrichten verworfen, sobald der Verlauf doppelt so viele
+enthaelt.
+"""
+
+KOCHA_CACHE_RECORD = struct.Struct("<qQ")
+"""
+Ein Eintrag im Index je Nachricht: die hoechste bis einschließlich
+dieser Nachricht empfangene Sequenznummer (-1 fuer keine) und das Ende
+der Nachricht in der Datei. Die Spuren des KOCHA-Servers koennen
+Nachrichten umsortieren, daher zaehlt die hoechste und nicht die
+letzte. Nach einem Neustart des KOCHA-Servers ohne Sicherung beginnen
+die Sequenznummern neu (siehe KochaHistoryCache.rewind).
+"""
+
+
+class KochaHistoryCache:
+    """
+    Klasse fuer den Verlauf eines Alias auf einem KOCHA-Server. Die
+    Nachrichten werden als Frames (siehe JsonUtils.to_frame) an eine
+    Datei angehaengt. Ein kleiner Index daneben haelt je Nachricht einen
+    Eintrag fester Groeße (KOCHA_CACHE_RECORD), sodass sich die letzten
+    Nachrichten und die zuletzt empfangene Sequenznummer lesen lassen,
+    ohne die ganze Datei zu lesen.
+
+    Passen Datei und Index nach einem Absturz nicht zusammen, wird der
+    Index aus der Datei neu erstellt.
+    """
+
+    def __init__(self, directory, server, alias, size=KOCHA_CACHE_SIZE):
+        """
+        Initialisiert ein Object der Klasse KochaHistoryCache und oeffnet
+        den Verlauf.
+
+        Args:
+            directory: Das Verzeichnis des Verlaufs.
+            server: Die Adresse des KOCHA-Servers als Text, z.B.
+                ``host:port``.
+            alias: Der Alias.
+            size: Die maximale Anzahl an Nachrichten im Verlauf.
+        """
+        # Server und Alias duerfen beliebige Zeichen enthalten
+        os.makedirs(directory, exist_ok=True)
+        name = "{}-{}".format(
+            urllib.parse.quote(server, safe=""),
+            urllib.parse.quote(alias, safe=""))
+        self.path = os.path.join(directory, name + ".log")
+        self.index_path = os.path.join(directory, name + ".idx")
+        self.lock = threading.Lock()
+
+        # Die Anzahl der Nachrichten, die hoechste empfangene
+        # Sequenznummer und das Ende der Datei
+        self.count = 0
+        self.last_seq = None
+        self.end = 0
+
+        self.file = None
+        self.index_file = None
+        self.open()
+        if self.count > 2 * size:
+            self.compact(size)
+
+    def open(self):
+        """
+        Datei und Index oeffnen und pruefen, ob beide zusammenpassen.
+        """
+        self.file = open(self.path, "ab")
+        self.index_file = open(self.index_path, "a+b")
+
+        size = self.file.seek(0, os.SEEK_END)
+        index_size = self.index_file.seek(0, os.SEEK_END)
+
+        # Der Index endet genau mit dem letzten vollstaendigen Eintrag
+        # und dieser genau mit der Datei
+        record = None
+        if index_size >= KOCHA_CACHE_RECORD.size:
+            self.index_file.seek(
+                index_size - index_size % KOCHA_CACHE_RECORD.size
+                - KOCHA_CACHE_RECORD.size)
+            record = KOCHA_CACHE_RECORD.unpack(
+                self.index_file.read(KOCHA_CACHE_RECORD.size))
+
+        if (index_size % KOCHA_CACHE_RECORD.size
+                or (record is None and size)
+                or (record is not None and record[1] != size)):
+            self.rebuild()
+            return
+
+        self.count = index_size // KOCHA_CACHE_RECORD.size
+        self.end = size
+        if record is not None and record[0] >= 0:
+            self.last_seq = record[0]
+
+    def rebuild(self):
+        """
+        Den Index aus der Datei neu erstellen. Eine unvollstaendige
+        letzte Nachricht wird dabei verworfen.
+        """
+        records = []
+        last_seq = None
+        end = 0
+        with open(self.path, "rb") as file:
+            for line in file:
+                if not line.endswith(shared.KOCHA_FRAME_DELIMITER):
+                    break
+                try:
+                    message = shared.JsonUtils.to_kocha_message(line)
+                except ValueError:
+                    break
+                if message.seq is not None and (
+                        last_seq is None or message.seq > last_seq):
+                    last_seq = message.seq
+                end += len(line)
+                records.append(KOCHA_CACHE_RECORD.pack(
+                    -1 if last_seq is None else last_seq, end))
+
+        self.file.truncate(end)
+        self.index_file.truncate(0)
+        self.index_file.write(b"".join(records))
+        self.index_file.flush()
+
+        self.count = len(records)
+        self.last_seq = last_seq
+        self.end = end
+
+    def compact(self, size):
+        """
+        Nur die letzten size Nachrichten behalten.
+
+        Args:
+            size: Die Anzahl der Nachrichten, die behalten werden.
+        """
+        # Beginn der aeltesten behaltenen Nachricht bestimmen
+        skip = self.count - size
+        self.index_file.seek((skip - 1) * KOCHA_CACHE_RECORD.size)
+        start = KOCHA_CACHE_RECORD.unpack(
+            self.index_file.read(KOCHA_CACHE_RECORD.size))[1]
+
+        # Beide Dateien unter temporaerem Namen neu schreiben und dann
+        # ersetzen. Ein Absturz dazwischen faellt in open auf
+        self.close()
+        with open(self.path, "rb") as source, \
+                open(self.path + ".tmp", "wb") as target:
+            source.seek(start)
+            target.write(source.read())
+        with open(self.index_path, "rb") as source, \
+                open(self.index_path + ".tmp", "wb") as target:
+            source.seek(skip * KOCHA_CACHE_RECORD.size)
+            for seq, end in KOCHA_CACHE_RECORD.iter_unpack(source.read()):
+                target.write(KOCHA_CACHE_RECORD.pack(seq, end - start))
+        os.replace(self.path + ".tmp", self.path)
+        os.replace(self.index_path + ".tmp", self.index_path)
+        self.open()
+
+    def tail(self, count=KOCHA_CACHE_TAIL):
+        """
+        Die letzten Nachrichten lesen.
+
+        Args:
+            count: Die maximale Anzahl an Nachrichten.
+
+        Returns:
+            Liste der KochaMessage-Objects, die aelteste zuerst.
+        """
+        with self.lock:
+            # Das Ende der Nachricht vor der ersten gelesenen bestimmen
+            start = 0
+            skip = self.count - count
+            if skip > 0:
+                self.index_file.seek((skip - 1) * KOCHA_CACHE_RECORD.size)
+                start = KOCHA_CACHE_RECORD.unpack(
+                    self.index_file.read(KOCHA_CACHE_RECORD.size))[1]
+            end = self.end
+
+        with open(self.path, "rb") as file:
+            file.seek(start)
+            data = file.read(end - start)
+
+        return [
+            shared.JsonUtils.to_kocha_message(line)
+            for line in data.splitlines()]
+
+    def append(self, messages):
+        """
+        Nachrichten an den Verlauf anhaengen.
+
+        Args:
+            messages: Liste der KochaMessage-Objects.
+        """
+        frames = []
+        records = []
+        with self.lock:
+            if self.file is None:
+                return
+
+            end = self.end
+            last_seq = self.last_seq
+            for message in messages:
+                frame = shared.JsonUtils.to_frame(message)
+                frames.append(frame)
+                end += len(frame)
+                if message.seq is not None and (
+                        last_seq is None or message.seq > last_seq):
+                    last_seq = message.seq
+                records.append(KOCHA_CACHE_RECORD.pack(
+                    -1 if last_seq is None else last_seq, end))
+
+            # Zuerst die Nachrichten, dann den Index schreiben, damit
+            # der Index nie auf fehlende Nachrichten zeigt
+            self.file.write(b"".join(frames))
+            self.file.flush()
+            self.index_file.write(b"".join(records))
+            self.index_file.flush()
+
+            self.count += len(messages)
+            self.last_seq = last_seq
+            self.end = end
+
+    def rewind(self, seq):
+        """
+        Die hoechste Sequenznummer auf seq zuruecksetzen, wenn der
+        KOCHA-Server bei der Anmeldung eine kleinere meldet, er also
+        ohne Sicherung neu gestartet wurde. Im Index steht sie mit der
+        naechsten angehaengten Nachricht.
+
+        Args:
+            seq: Die Sequenznummer, ab der der KOCHA-Client zaehlt.
+        """
+        with self.lock:
+            if self.last_seq is not None and seq < self.last_seq:
+                self.last_seq = seq
+
+    def close(self):
+        """
+        Den Verlauf schließen.
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.index_file.close()
+                self.file = None
+                self.index_file = None
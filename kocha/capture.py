@@ -0,0 +1,237 @@
+"""
+Modul zum Aufzeichnen der beim KOCHA-Server eingehenden Frames, damit
+sich reale Lastprofile spaeter mit kocha.replay nachstellen lassen.
+"""
+
+import hashlib
+import os
+import queue
+import struct
+import threading
+import time
+
+from kocha import shared
+
+KOCHA_CAPTURE_MAGIC = b"KOCHACAP1\n"
+"""
+Die Kennung am Anfang jeder Aufzeichnung.
+"""
+
+KOCHA_CAPTURE_RECORD = struct.Struct("<dIBI")
+"""
+Der Kopf eines Eintrags der Aufzeichnung: Zeitpunkt in Sekunden seit
+Beginn der Aufzeichnung, Id der Verbindung, Art des Eintrags und Laenge
+der nachfolgenden Daten (UTF-8) in Bytes.
+"""
+
+
+class KochaCapture:
+    """
+    Klasse schreibt das Oeffnen und Schließen von Clientverbindungen
+    und alle eingehenden Frames mit Zeitpunkt und Id der Verbindung in
+    eine kompakte Binaerdatei.
+
+    Wie beim Protokoll (siehe kocha.log) reihen die Threads der Clients
+    die Eintraege nur in eine queue.SimpleQueue ein. Anonymisieren und
+    Schreiben uebernimmt ein eigener Thread, damit die Threads der
+    Clients nicht aufeinander und auf die Datei warten.
+
+    Auf Wunsch werden die Inhalte anonymisiert: Aliase werden durch
+    gleichbleibende Pseudonyme ersetzt und Text durch gleich lange
+    Platzhalter, sodass Kommandos und Nachrichtengroeßen erhalten
+    bleiben.
+    """
+
+    OPEN = 0
+    """
+    Art des Eintrags fuer eine neue Clientverbindung.
+    """
+
+    FRAME = 1
+    """
+    Art des Eintrags fuer einen eingehenden Frame.
+    """
+
+    CLOSE = 2
+    """
+    Art des Eintrags fuer eine geschlossene Clientverbindung.
+    """
+
+    def __init__(self, path, anonymize=False):
+        """
+        Initialisiert ein Object der Klasse KochaCapture und beginnt
+        die Aufzeichnung.
+
+        Args:
+            path: Pfad der Datei fuer die Aufzeichnung.
+            anonymize: Gibt an, ob Aliase und Inhalte anonymisiert
+                werden.
+        """
+        self.file = open(path, "wb", buffering=64 * 1024)
+        self.file.write(KOCHA_CAPTURE_MAGIC)
+        self.start = time.monotonic()
+
+        # Die Ids der aufgezeichneten Verbindungen. Nur der schreibende
+        # Thread greift darauf zu
+        self.ids = {}
+        self.next_id = 0
+
+        # Zufaelliges Salz, damit sich die Pseudonyme nicht durch
+        # Ausprobieren von Aliasen zurueckrechnen lassen
+        self.salt = os.urandom(16) if anonymize else None
+
+        # Die Warteschlange der Eintraege und der schreibende Thread
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(
+            target=self.write, name="kocha-capture", daemon=True)
+        self.writer.start()
+
+    def record(self, connection, kind, data=""):
+        """
+        Einen Eintrag zum Aufzeichnen einreihen. Blockiert nie.
+
+        Args:
+            connection: Die Clientverbindung.
+            kind: Die Art des Eintrags (OPEN, FRAME oder CLOSE).
+            data: Der Frame ohne Trennzeichen als str.
+        """
+        self.queue.put_nowait(
+            (time.monotonic() - self.start, connection, kind, data))
+
+    def write(self):
+        """
+        Die eingereihten Eintraege schreiben, bis close None einreiht.
+        Fuer Verbindungen, die vor Beginn der Aufzeichnung geoeffnet
+        wurden, wird das Oeffnen nachgetragen.
+        """
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                return
+            now, connection, kind, data = entry
+
+            # Den Frame ggf. anonymisieren
+            if kind == self.FRAME and self.salt is not None:
+                data = self.anonymize(data)
+            payload = data.encode()
+
+            # Die Id der Verbindung bestimmen und ggf. das Oeffnen
+            # nachtragen
+            connection_id = self.ids.get(connection)
+            if connection_id is None:
+                connection_id = self.ids[connection] = self.next_id
+                self.next_id += 1
+                if kind != self.OPEN:
+                    self.file.write(KOCHA_CAPTURE_RECORD.pack(
+                        now, connection_id, self.OPEN, 0))
+            if kind == self.CLOSE:
+                del self.ids[connection]
+
+            # Den Eintrag schreiben
+            self.file.write(KOCHA_CAPTURE_RECORD.pack(
+                now, connection_id, kind, len(payload)))
+            self.file.write(payload)
+
+    def anonymize(self, data):
+        """
+        Einen Frame anonymisieren.
+
+        Args:
+            data: Der Frame als str.
+
+        Returns:
+            Der anonymisierte Frame als str.
+        """
+        try:
+            message = shared.JsonUtils.to_kocha_message(data)
+        except ValueError:
+            return "x" * len(data)
+        if isinstance(message, list):
+            return "x" * len(data)
+
+        # Bei Kommandos das Kommando erhalten und nur die Argumente
+        # ersetzen. Aliase an den ueblichen Stellen bleiben als
+        # Pseudonym unterscheidbar, damit sich z.B. Anmeldungen und
+        # Direct-Messages wiedergeben lassen
+        command, _, args = message.content.partition(" ")
+        if command in ("/login", "/nick", "/dm"):
+            alias, _, rest = args.partition(" ")
+            if command == "/dm":
+                rest = self.mask(rest)
+            message.content = " ".join(
+                part for part in (command, self.pseudonym(alias), rest)
+                if part)
+        elif not command.startswith("/"):
+            message.content = self.mask(message.content)
+        elif args:
+            message.content = command + " " + self.mask(args)
+
+        if message.sender:
+            message.sender = self.pseudonym(message.sender)
+        return shared.JsonUtils.to_json(message)
+
+    def pseudonym(self, alias):
+        """
+        Einen Alias durch ein gleichbleibendes Pseudonym ersetzen.
+
+        Args:
+            alias: Der Alias.
+
+        Returns:
+            Das Pseudonym.
+        """
+        if not alias:
+            return alias
+        digest = hashlib.blake2b(
+            alias.encode(), digest_size=5, key=self.salt).hexdigest()
+        return "u" + digest
+
+    @staticmethod
+    def mask(text):
+        """
+        Text durch einen gleich langen Platzhalter ersetzen. Leerzeichen
+        und Zeilenumbrueche bleiben erhalten.
+
+        Args:
+            text: Der Text.
+
+        Returns:
+            Der Platzhalter.
+        """
+        return "".join(c if c.isspace() else "x" for c in text)
+
+    def close(self):
+        """
+        Die Aufzeichnung beenden, die noch eingereihten Eintraege
+        schreiben und die Datei schließen.
+        """
+        self.queue.put_nowait(None)
+        self.writer.join()
+        self.file.close()
+
+    @staticmethod
+    def read(path):
+        """
+        Eine Aufzeichnung lesen.
+
+        Args:
+            path: Pfad der Datei mit der Aufzeichnung.
+
+        Yields:
+            Tupel aus Zeitpunkt, Id der Verbindung, Art des Eintrags und
+            Daten (str).
+
+        Raises:
+            ValueError: Wenn die Datei keine Aufzeichnung ist.
+        """
+        with open(path, "rb") as file:
+            if file.read(len(KOCHA_CAPTURE_MAGIC)) != KOCHA_CAPTURE_MAGIC:
+                raise ValueError("Not a KOCHA capture: " + path)
+
+            while True:
+                header = file.read(KOCHA_CAPTURE_RECORD.size)
+                if len(header) < KOCHA_CAPTURE_RECORD.size:
+                    return
+                at, connection_id, kind, size = (
+                    KOCHA_CAPTURE_RECORD.unpack(header))
+                yield at, connection_id, kind, file.read(size).decode()
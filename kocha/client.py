@@ -2,16 +2,49 @@
 Modul mit Klassen und Methoden fuer den KOCHA-Client.
 """
 
+import argparse
 import curses
 import enum
 import locale
 import queue
+import random
+import re
 import socket
+import ssl
 import sys
 import threading
 import time
 
-from kocha import shared
+from kocha import cache, shared, transfer
+
+KOCHA_RECONNECT_DELAY = 0.5
+"""
+Die Wartezeit in Sekunden vor dem ersten Versuch, die Verbindung zum
+KOCHA-Server wiederherzustellen. Sie verdoppelt sich nach jedem
+gescheiterten Versuch.
+"""
+
+KOCHA_RECONNECT_MAX_DELAY = 30.0
+"""
+Die maximale Wartezeit in Sekunden zwischen zwei Versuchen, die
+Verbindung zum KOCHA-Server wiederherzustellen.
+"""
+
+KOCHA_SEEN_SIZE = 4096
+"""
+Die Anzahl der zuletzt empfangenen Sequenznummern, die sich der
+KOCHA-Client merkt, um doppelt zugestellte Nachrichten zu erkennen.
+Aeltere gelten als empfangen.
+"""
+
+KOCHA_ACK_INTERVAL = 1.0
+"""
+Der minimale Abstand in Sekunden zwischen zwei gesammelten
+Empfangsbestaetigungen im zuverlaessigen Modus. Bestaetigungen werden
+bevorzugt an ausgehende Nachrichten angehaengt, sodass unabhaengig von
+der Nachrichtenrate hoechstens eine eigene Bestaetigung pro Intervall
+anfaellt.
+"""
 
 
 class KochaTcpClient(shared.KochaTcpSocketWrapper):
@@ -19,39 +52,316 @@ class KochaTcpClient(shared.KochaTcpSocketWrapper):
     Klasse fuer die Kommunikation mit dem KOCHA-Server via TCP/IP.
     """
 
-    def __init__(self, server_host, server_port):
-        # Einen TCP-Socket fuer den KOCHA-Client erstellen
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    def __init__(
+            self, server_host=None, server_port=None, reliable=False,
+            tls=False, cafile=None, unix_path=None, presence=False):
+        """
+        Initialisiert ein Object der Klasse KochaTcpClient.
 
-        # Timeout fuer den Client-Socket setzen
-        sock.settimeout(shared.KOCHA_TIMEOUT)
+        Args:
+            server_host: Der Host des KOCHA-Servers.
+            server_port: Der Port des KOCHA-Servers.
+            reliable: Gibt an, ob der Client den Empfang von Nachrichten
+                kumulativ bestaetigt, damit der KOCHA-Server
+                unbestaetigte Nachrichten erneut senden kann.
+            tls: Gibt an, ob die Verbindung mit TLS verschluesselt wird.
+            cafile: Pfad zu den Zertifikaten (PEM), denen beim Pruefen
+                des Serverzertifikats vertraut wird. Ohne Angabe werden
+                die Zertifikate des Systems verwendet.
+            unix_path: Pfad zum Unix Domain Socket eines KOCHA-Servers
+                auf demselben Rechner. Wird er angegeben, werden
+                server_host, server_port und tls ignoriert.
+            presence: Gibt an, ob der Client nach der Anmeldung die
+                Mitgliederliste abonniert und in members aktuell haelt.
+        """
+        # Adresse des KOCHA-Servers fuer spaetere Verbindungsversuche
+        # merken
+        self.server_host = server_host
+        self.server_port = server_port
+        self.unix_path = unix_path
+        self.reliable = reliable
+
+        # TLS-Kontext und die Session der letzten Verbindung, mit der
+        # beim erneuten Verbinden der vollstaendige Handshake
+        # eingespart wird
+        self.ssl_context = None
+        if tls:
+            self.ssl_context = ssl.create_default_context(cafile=cafile)
+        self.tls_session = None
 
         # Der Alias
         self.alias = ""
 
+        # Die hoechste empfangene Sequenznummer, die seit der ersten
+        # Anmeldung empfangenen Sequenznummern und die Sequenznummer,
+        # bis zu der alle als empfangen gelten (siehe is_new)
+        self.last_seq = None
+        self.seen = set()
+        self.seen_floor = None
+
+        # Die zuletzt bestaetigte Sequenznummer und der Zeitpunkt der
+        # letzten Bestaetigung
+        self.acked_seq = None
+        self.acked_at = time.monotonic()
+
+        # Die Mitgliederliste und deren Version. Beide sind None,
+        # solange kein Snapshot vom KOCHA-Server vorliegt
+        self.presence = presence
+        self.members = None
+        self.presence_version = None
+
+        # Mit dem KOCHA-Server verbinden
+        super().__init__(None)
+        self.connect()
+
+    def connect(self):
+        """
+        Einen neuen Socket erstellen und mit dem KOCHA-Server verbinden.
+
+        Returns:
+            True, wenn die Verbindung hergestellt werden konnte, sonst
+            False.
+        """
+        if self.unix_path is not None:
+            # Einen Unix Domain Socket fuer den KOCHA-Client erstellen
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.unix_path
+        else:
+            # Einen TCP-Socket fuer den KOCHA-Client erstellen
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = (self.server_host, self.server_port)
+
+            # Kleine Nachrichten sofort senden
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # Den Socket fuer TLS kapseln und dabei die Session der
+            # letzten Verbindung wiederaufnehmen
+            if self.ssl_context is not None:
+                sock = self.ssl_context.wrap_socket(
+                    sock,
+                    server_hostname=self.server_host,
+                    session=self.tls_session)
+
+        # Timeout fuer den Client-Socket setzen
+        sock.settimeout(shared.KOCHA_TIMEOUT)
+
         # Mit dem KOCHA-Server verbinden
         self.is_connected = True
         try:
-            sock.connect((server_host, server_port))
+            sock.connect(address)
         except Exception as e:
             print(e, file=sys.stderr)
             self.is_connected = False
 
-        # Den Client-Socket merken
-        super().__init__(sock)
+        # Den Client-Socket merken und den Empfangspuffer der alten
+        # Verbindung verwerfen
+        self.socket = sock
+        self.reader = shared.KochaFrameReader(sock)
+        self.writer = shared.KochaFrameWriter(sock)
+        return self.is_connected
+
+    def reconnect(self, stop=lambda: False):
+        """
+        Die Verbindung zum KOCHA-Server mit exponentiell wachsender
+        Wartezeit so lange wiederherstellen, bis die erneute Anmeldung
+        mit dem bisherigen Alias gelingt. Der KOCHA-Server liefert dabei
+        alle seit der letzten empfangenen Nachricht verpassten
+        Nachrichten als Batch nach.
+
+        Args:
+            stop: Funktion, die True zurueckgibt, wenn die Versuche
+                abgebrochen werden sollen.
+
+        Returns:
+            True, wenn die Verbindung wiederhergestellt wurde, sonst
+            False.
+        """
+        delay = KOCHA_RECONNECT_DELAY
+        while not stop():
+            # Zufaellig verkuerzte Wartezeit, damit nach einem Ausfall
+            # nicht alle KOCHA-Clients gleichzeitig zurueckkehren
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, KOCHA_RECONNECT_MAX_DELAY)
+
+            # Alte Verbindung verwerfen
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+
+            if not self.connect():
+                continue
+
+            try:
+                answer = self.login(self.alias, self.last_seq)
+            except (OSError, ValueError):
+                answer = None
+
+            if self.is_welcome(answer):
+                return True
 
-    def send(self, message):
+        return False
+
+    def receive(self):
+        """
+        Eine Nachricht (oder einen Batch) vom KOCHA-Server empfangen
+        und die Sequenznummer der zuletzt empfangenen Nachricht
+        aktualisieren.
+
+        Returns:
+            Die Nachricht, eine Liste von Nachrichten oder None, wenn
+            nur die Mitgliederliste aktualisiert, ein Heartbeat
+            beantwortet oder die Nachricht bereits empfangen wurde.
+        """
+        message = super().receive()
+
+        # Aenderungen der Mitgliederliste nicht als Nachricht anzeigen
+        if (not isinstance(message, list)
+                and message.sender == shared.KOCHA_SERVER_ALIAS
+                and message.content.startswith("/presence ")):
+            self.on_presence(message.content)
+            return None
+
+        # Heartbeats des KOCHA-Servers sofort beantworten
+        if (not isinstance(message, list)
+                and message.sender == shared.KOCHA_SERVER_ALIAS
+                and message.content == "/ping"):
+            self.send(
+                shared.KochaMessage(content="/pong"),
+                shared.KOCHA_LANE_CONTROL)
+            return None
+
+        # Erneut gesendete Nachrichten, die bereits empfangen wurden,
+        # entfernen. Nach dem erneuten Anmelden kann eine Nachricht
+        # sowohl im Batch als auch einzeln ankommen
+        if isinstance(message, list):
+            return [msg for msg in message if self.is_new(msg.seq)]
+        if not self.is_new(message.seq):
+            return None
+        return message
+
+    def is_new(self, seq):
+        """
+        Gibt an, ob eine Nachricht noch nicht empfangen wurde, und
+        merkt sich ihre Sequenznummer. Da Spuren Nachrichten
+        ueberholen lassen, genuegt die hoechste Sequenznummer dafuer
+        nicht. Von den Sequenznummern werden nur die letzten
+        KOCHA_SEEN_SIZE gemerkt, aeltere gelten als empfangen.
+
+        Args:
+            seq: Die Sequenznummer der Nachricht oder None.
+
+        Returns:
+            True, wenn die Nachricht keine Sequenznummer hat oder zum
+            ersten Mal empfangen wurde.
+        """
+        if seq is None:
+            return True
+        if ((self.seen_floor is not None and seq <= self.seen_floor)
+                or seq in self.seen):
+            return False
+
+        self.seen.add(seq)
+        if self.last_seq is None or seq > self.last_seq:
+            self.last_seq = seq
+
+        # Nur die neuesten Sequenznummern behalten
+        if len(self.seen) > 2 * KOCHA_SEEN_SIZE:
+            kept = sorted(self.seen)[-KOCHA_SEEN_SIZE:]
+            self.seen = set(kept)
+            self.seen_floor = kept[0] - 1
+        return True
+
+    def on_presence(self, content):
+        """
+        Einen Snapshot oder ein Delta der Mitgliederliste anwenden.
+        Fehlt ein Delta, wird ein neuer Snapshot angefordert.
+
+        Args:
+            content: Der Inhalt der Nachricht des KOCHA-Servers
+                (siehe KochaTcpServer.on_presence).
+        """
+        _, version, operation, *aliases = content.split()
+        version = int(version)
+
+        # Den eigenen Alias auch dann nachfuehren, wenn ein Delta fehlt
+        if operation == "~" and aliases[0] == self.alias:
+            self.alias = aliases[1]
+
+        if operation == "=":
+            self.members = aliases
+        elif self.presence_version is None:
+            # Auf den angeforderten Snapshot warten
+            return
+        elif version <= self.presence_version:
+            # Deltas werden nachrangig gesendet und koennen daher nach
+            # einem Snapshot eintreffen, der sie bereits enthaelt
+            return
+        elif version != self.presence_version + 1:
+            self.members = self.presence_version = None
+            self.request_presence()
+            return
+        elif operation == "+":
+            self.members.append(aliases[0])
+        elif operation == "-":
+            if aliases[0] in self.members:
+                self.members.remove(aliases[0])
+        elif operation == "~":
+            self.members = [
+                aliases[1] if alias == aliases[0] else alias
+                for alias in self.members]
+
+        self.presence_version = version
+
+    def request_presence(self):
+        """
+        Die Mitgliederliste beim KOCHA-Server abonnieren bzw. einen
+        neuen Snapshot anfordern.
+
+        Returns:
+            False, wenn das Senden fehlgeschlagen ist, sonst True.
+        """
+        request = shared.KochaMessage(content="/presence")
+        return self.send_frame(shared.JsonUtils.to_frame(request))
+
+    def send(self, message, lane=shared.KOCHA_LANE_DIRECT):
         """
         Eine Nachricht an den KOCHA-Server schicken.
 
         Args:
             message: Die Nachricht.
+            lane: Die Spur (KOCHA_LANE_*) der Nachricht.
+
+        Returns:
+            False, wenn nicht angemeldet oder das Senden fehlgeschlagen
+            ist, sonst True.
         """
         # Wenn nicht angemeldet, nix machen
         if not self.alias:
-            return
+            return False
+
+        # Im zuverlaessigen Modus den Empfang aller bisherigen
+        # Nachrichten mit der ausgehenden Nachricht bestaetigen
+        ack = self.last_seq if self.reliable else None
+        message.ack = ack
+
+        sent = super().send(message, lane)
+        if sent and ack is not None:
+            self.acked_seq = ack
+            self.acked_at = time.monotonic()
+        return sent
 
-        super().send(message)
+    def flush_ack(self):
+        """
+        Im zuverlaessigen Modus eine gesammelte Empfangsbestaetigung
+        senden, falls seit der letzten Bestaetigung neue Nachrichten
+        empfangen wurden und das Bestaetigungsintervall abgelaufen ist.
+        """
+        if (self.reliable
+                and self.last_seq != self.acked_seq
+                and time.monotonic() - self.acked_at >= KOCHA_ACK_INTERVAL):
+            self.send(
+                shared.KochaMessage(content="/ack"), shared.KOCHA_LANE_CONTROL)
 
     def close(self):
         """
@@ -63,6 +373,9 @@ class KochaTcpClient(shared.KochaTcpSocketWrapper):
     def try_login(self, alias):
         """
         Versuchen den Client mit einem Alias Am KOCHA-Server anzumelden.
+        Ist last_seq bereits gesetzt (z.B. aus dem lokalen Verlauf),
+        liefert der KOCHA-Server die seitdem verpassten Nachrichten
+        nach.
 
         Args:
             alias: Der Alias fuer die Anmeldung.
@@ -73,26 +386,93 @@ class KochaTcpClient(shared.KochaTcpSocketWrapper):
 
         # Wenn nicht mit dem KOCHA-Server verbunden, nix machen
         if self.is_connected:
+            answer = self.login(alias, self.last_seq)
+
+            # Wenn die Anmeldung erfolgreich war den Alias setzen
+            if self.is_welcome(answer):
+                self.alias = alias
 
-            # Loginanfrage an den KOCHA-Server senden
-            request = shared.KochaMessage(content="/login " + alias)
-            data = shared.JsonUtils.to_json(request)
-            self.socket.sendall(data.encode())
+        return answer
 
-            # Auf Antwort des KOCHA-Servers warten (maximal 5 Versuche)
-            count = 0
-            while answer is None and count < 5:
-                try:
-                    answer = self.receive()
-                except socket.timeout:
-                    pass
+    @staticmethod
+    def is_welcome(answer):
+        """
+        Gibt an, ob die Antwort auf eine Loginanfrage eine erfolgreiche
+        Anmeldung bestaetigt.
 
-                count += 1
+        Args:
+            answer: Die Antwort des KOCHA-Servers oder None.
 
-            # Wenn die Anmeldung erfolgreich war den Alias setzen
-            if answer is not None:
-                if answer.content != "":
-                    self.alias = alias
+        Returns:
+            False, wenn keine Antwort kam, die Anmeldung abgelehnt wurde
+            oder der KOCHA-Server voll ist (``/full``), sonst True.
+        """
+        return (
+            answer is not None
+            and answer.content != ""
+            and not answer.content.startswith("/full "))
+
+    def login(self, alias, last_seq=None):
+        """
+        Die Loginanfrage an den KOCHA-Server senden und auf dessen
+        Antwort warten.
+
+        Args:
+            alias: Der Alias fuer die Anmeldung.
+            last_seq: Die Sequenznummer der zuletzt empfangenen
+                Nachricht, ab der verpasste Nachrichten nachgeliefert
+                werden sollen, oder None.
+
+        Returns:
+            Die Antwort des KOCHA-Servers oder None.
+        """
+        answer = None
+
+        # Loginanfrage an den KOCHA-Server senden
+        content = "/login " + alias
+        if last_seq is not None:
+            content += " {}".format(last_seq)
+        request = shared.KochaMessage(content=content)
+        if not self.send_frame(
+                shared.JsonUtils.to_frame(request), shared.KOCHA_LANE_CONTROL):
+            return None
+
+        # Auf Antwort des KOCHA-Servers warten (maximal 5 Versuche)
+        count = 0
+        while answer is None and count < 5:
+            try:
+                answer = super().receive()
+            except socket.timeout:
+                pass
+
+            count += 1
+
+        # Bei der ersten Anmeldung ab der Sequenznummer der
+        # Willkommensnachricht weiterzaehlen. Diese ist auch nach einem
+        # Neustart des KOCHA-Servers maßgeblich, wenn sie kleiner als
+        # die bisher zuletzt empfangene ist. Ansonsten zaehlt der
+        # nachgelieferte Batch weiter. Stammt last_seq aus dem lokalen
+        # Verlauf, gelten alle Nachrichten bis dahin als empfangen
+        if self.is_welcome(answer):
+            if self.last_seq is None or answer.seq < self.last_seq:
+                self.last_seq = answer.seq
+                self.acked_seq = None
+                self.seen.clear()
+                self.seen_floor = answer.seq
+            elif self.seen_floor is None:
+                self.seen_floor = self.last_seq
+
+            # Die Mitgliederliste (erneut) abonnieren. Der Snapshot
+            # ersetzt die Liste der alten Verbindung
+            if self.presence:
+                self.presence_version = None
+                self.request_presence()
+
+        # Die TLS-Session merken. Bei TLS 1.3 stellt der KOCHA-Server
+        # das Session Ticket erst nach dem Handshake aus, daher ist die
+        # Session erst nach der ersten Antwort vollstaendig
+        if isinstance(self.socket, ssl.SSLSocket):
+            self.tls_session = self.socket.session
 
         return answer
 
@@ -114,6 +494,67 @@ class KochaUiColorPair(enum.IntEnum):
     """
 
 
+class KochaHighlighter:
+    """
+    Klasse findet den eigenen Alias und weitere Stichwoerter (z.B.
+    Team-Handles wie ``@backend``) in Nachrichten. Alle Begriffe werden
+    zu einem einzigen regulaeren Ausdruck kombiniert, sodass jede
+    Nachricht nur einmal durchsucht wird.
+    """
+
+    def __init__(self, alias="", keywords=()):
+        """
+        Initialisiert ein Object der Klasse KochaHighlighter.
+
+        Args:
+            alias: Der eigene Alias.
+            keywords: Weitere hervorzuhebende Stichwoerter.
+        """
+        self.keywords = list(keywords)
+        self.compile(alias)
+
+    def compile(self, alias):
+        """
+        Den regulaeren Ausdruck fuer den Alias und die Stichwoerter
+        erstellen.
+
+        Args:
+            alias: Der eigene Alias.
+        """
+        self.alias = alias
+
+        # Laengere Begriffe zuerst, damit z.B. "@backend-team" nicht nur
+        # als "@backend" erkannt wird. Begriffe werden nur als ganze
+        # Woerter gefunden
+        terms = sorted(
+            {term for term in [alias] + self.keywords if term},
+            key=len,
+            reverse=True)
+        self.pattern = None
+        if terms:
+            self.pattern = re.compile(
+                r"(?<!\w)(?:{})(?!\w)".format(
+                    "|".join(map(re.escape, terms))),
+                re.IGNORECASE)
+
+    def find(self, text, start=0):
+        """
+        Alle Vorkommen der Begriffe in einem Text finden.
+
+        Args:
+            text: Der Text.
+            start: Die Position, ab der gesucht wird.
+
+        Returns:
+            Liste von Tupeln aus Position und Laenge der Vorkommen.
+        """
+        if self.pattern is None:
+            return []
+        return [
+            (match.start(), match.end() - match.start())
+            for match in self.pattern.finditer(text, start)]
+
+
 class KochaUi:
     """
     Klasse fuer das User Interface des KOCHA-Clients.
@@ -124,7 +565,10 @@ class KochaUi:
         kocha_tcp_client,
         stdscr=None,
         prompt="> ",
-        welcome_message=None):
+        welcome_message=None,
+        keywords=(),
+        download_dir=".",
+        history=None):
         """
         Initialisert ein Object der Klasse KochaUi.
 
@@ -132,6 +576,12 @@ class KochaUi:
             stdscr: Window-Object, das den gesamten Bilschirm
             repraesentiert.
             prompt: Das Zeichen fuer die Eingabeaufforderung.
+            keywords: Stichwoerter, die neben dem eigenen Alias in
+                Nachrichten hervorgehoben werden.
+            download_dir: Das Verzeichnis fuer empfangene Dateien.
+            history: Der lokale Verlauf (KochaHistoryCache) oder None.
+                Seine letzten Nachrichten werden sofort angezeigt und
+                alle weiteren angehaengt.
         """
         # Den kocha_tcp_client merken
         self.kocha_tcp_client = kocha_tcp_client
@@ -139,12 +589,32 @@ class KochaUi:
         # Das Zeichen fuer die Eingabeaufforderung merken
         self.prompt = prompt
 
-        # Puffer fuer die Nachrichten initialisieren
+        # Puffer fuer die Nachrichten initialisieren und mit den
+        # letzten Nachrichten aus dem lokalen Verlauf fuellen
+        self.history = history
         self.messages = []
+        if history is not None:
+            self.messages.extend(history.tail())
+
+        # Die fertig umgebrochenen Zeilen je Nachricht (Index in
+        # messages) samt Hervorhebungen fuer die Breite
+        # rendered_width. So muessen Nachrichten beim Neuzeichnen
+        # nicht erneut durchsucht werden
+        self.highlighter = KochaHighlighter(
+            kocha_tcp_client.alias, keywords)
+        self.rendered = {}
+        self.rendered_width = None
 
         # Puffer fuer die Texteingabe initialisieren
         self.input = ""
 
+        # Die Dateiuebertragungen mit anderen Nutzern. Ihre
+        # Statusmeldungen kommen auch aus den sendenden Threads und
+        # werden daher gesammelt und erst von show_statuses gezeichnet
+        self.statuses = queue.SimpleQueue()
+        self.transfers = transfer.KochaTransfers(
+            kocha_tcp_client, download_dir, self.statuses.put)
+
         # Signal zum schließen des KOCHA-Clients
         self.stop = False
 
@@ -225,8 +695,13 @@ class KochaUi:
         # Warten bis der Worker-Thread terminiert
         self.receive_messages_worker.join()
 
-        # Den KochaTcpClient schließen
+        # Laufende Dateiuebertragungen beenden
+        self.transfers.close()
+
+        # Den KochaTcpClient und den lokalen Verlauf schließen
         self.kocha_tcp_client.close()
+        if self.history is not None:
+            self.history.close()
 
         # Terminaleinstellungen fuer curses wieder aufheben
         curses.nocbreak()
@@ -254,13 +729,35 @@ class KochaUi:
                 if self.input.lower() in { "/q", "/quit" }:
                     self.stop = True
 
+                # Die Mitgliederliste lokal anzeigen, statt sie beim
+                # KOCHA-Server abzufragen
+                members = self.kocha_tcp_client.members
+                if self.input in { "/m", "/members" } and members is not None:
+                    self.input = ""
+                    self.draw_input_window()
+                    self.show_status(", ".join(members))
+                    continue
+
+                # Dateiuebertragungen lokal bearbeiten
+                command, *args = self.input.split(" ", 2)
+                if (command in transfer.KOCHA_TRANSFER_COMMANDS
+                        and command != "/chunk" and len(args) == 2):
+                    self.input = ""
+                    self.draw_input_window()
+                    self.on_transfer_command(command, *args)
+                    self.show_statuses()
+                    continue
+
                 # Ein Message-Object erstellen
                 message = shared.KochaMessage(
                     content=self.input,
                     sender=self.kocha_tcp_client.alias)
 
-                # Nachricht zum Nachrichtenpuffer hinzufuegen
+                # Nachricht zum Nachrichtenpuffer und zum lokalen
+                # Verlauf hinzufuegen
                 self.messages.append(message)
+                if self.history is not None:
+                    self.history.append([message])
 
                 # Eingabepuffer zuruecksetzen
                 self.input = ""
@@ -297,6 +794,26 @@ class KochaUi:
         # KOCHA-Client am Server abmelden und UI schließen
         self.close()
 
+    def on_transfer_command(self, command, alias, argument):
+        """
+        Ein eingegebenes Kommando der Dateiuebertragung ausfuehren.
+
+        Args:
+            command: ``/send``, ``/accept`` oder ``/cancel``.
+            alias: Der Alias der Gegenseite.
+            argument: Der Pfad der Datei bei ``/send``, sonst die Id der
+                Uebertragung.
+        """
+        if command == "/send":
+            try:
+                self.transfers.offer(alias, argument)
+            except OSError as e:
+                self.show_status(str(e))
+        elif command == "/accept":
+            self.transfers.accept(alias, argument)
+        else:
+            self.transfers.cancel(alias, argument)
+
     def draw_messages_window(self):
         """
         Zeichnet das Nachrichtenfenster.
@@ -313,97 +830,106 @@ class KochaUi:
         # Breite des Rahmens abziehen
         max_y, max_x = max_y - 2, max_x - 2
 
-        # Nachrichten an die Breite des Nachrichtenfensters anpassen
-        lines = []
-        for message in self.messages:
-            line = ""
-
-            # Indikator fuer Direct-Message, Server-Message oder
-            # Chat-Message voranstellen
-            if message.sender == shared.KOCHA_SERVER_ALIAS:
-                line += "[SM]"
-            elif message.sender == self.kocha_tcp_client.alias:
-                line += "[ME]"
-            elif message.is_dm:
-                line += "[DM]"
-            else:
-                line += "[CM]"
-
-            # Sendezeit anhaengen
-            line += message.sent_at.strftime("[%H:%M:%S] ")
-
-            # Alias des Senders anhaengen
-            line += message.sender + ": "
-
-            # Eigentlichen Nachrichteninhalt anhaengen
-            line += message.content
-
-            # Newlines in Zeile verarbeiten
-            parts = line.split("\n")
-
-            # Zeilen an die Breite des User Interfaces anpassen
-            for part in parts:
-                while part != "":
-                    lines.append(part[:max_x])
-                    part = part[max_x:]
-
-        # Index der aeltesten Nachricht, die im Nachrichtenfenster
-        # gezeichnet werden kann, bestimmen
-        begin = len(lines) - max_y
-        begin = begin if begin >= 0 else 0
-
-        for y, line in enumerate(lines[begin:], start=1):
-            # Nachricht ins Nachrichtenfenster zeichnen
-            self.messages_window.addstr(y, 1, line)
-
-            # Den Beginn des eigentlichen Inhalts bestimmen (die
-            # Startposition ergibt sich aus der Laenge des Headers)
-            start_content = line.find(":", 15) + 1
-
-            # Direktnachrichten und Servernachrichten hervorheben
-            if line.startswith("[SM]"):
+        # Nach einer Groeßenaenderung oder einem neuen Alias muessen
+        # die Nachrichten neu umgebrochen bzw. durchsucht werden
+        alias = self.kocha_tcp_client.alias
+        if max_x != self.rendered_width or alias != self.highlighter.alias:
+            self.highlighter.compile(alias)
+            self.rendered = {}
+            self.rendered_width = max_x
+
+        # Von der neuesten Nachricht an nur so viele Nachrichten
+        # umbrechen, wie ins Nachrichtenfenster passen. Bereits
+        # umgebrochene Nachrichten kommen aus dem Cache
+        blocks = []
+        count = 0
+        for index in range(len(self.messages) - 1, -1, -1):
+            if count >= max_y:
+                break
+            lines = self.rendered.get(index)
+            if lines is None:
+                lines = self.render(self.messages[index], max_x)
+                self.rendered[index] = lines
+            blocks.append(lines)
+            count += len(lines)
+
+        lines = [line for block in reversed(blocks) for line in block]
+
+        # Nur die Zeilen zeichnen, die ins Nachrichtenfenster passen,
+        # und die gespeicherten Hervorhebungen wiederholen
+        for y, (text, spans) in enumerate(lines[-max_y:], start=1):
+            self.messages_window.addstr(y, 1, text)
+            for x, length, color_pair in spans:
                 self.messages_window.chgat(
-                    y,
-                    1,
-                    start_content,
-                    curses.color_pair(KochaUiColorPair.SERVER))
-            elif line.startswith("[DM]"):
-                self.messages_window.chgat(
-                    y,
-                    1,
-                    start_content,
-                    curses.color_pair(KochaUiColorPair.DM))
-
-            # Keine Hervorhebung fuer Nachrichten, die man selbst
-            # geschrieben hat
-            if line.startswith("[ME]"):
-                continue
-
-            # Liste fuer die X-Positionen des eigenen Alias anlegen
-            alias_x_positions = []
+                    y, 1 + x, length, curses.color_pair(color_pair))
 
-            # Die X-Position des eigenen Aliases in einer Zeile
-            # finden
-            line_lower = line.lower()
-            alias_lower = self.kocha_tcp_client.alias.lower()
-            while True:
-                alias_x = line_lower.find(alias_lower, start_content)
-
-                # Wenn der Alias nicht auftaucht, abbrechen
-                if alias_x == -1:
-                    break
+    def render(self, message, width):
+        """
+        Eine Nachricht in Zeilen der Breite width umbrechen und die
+        hervorzuhebenden Bereiche jeder Zeile bestimmen.
 
-                # X-Position des Alias zur Liste hinzufuegen
-                alias_x_positions.append(alias_x)
-                start_content = alias_x + len(alias_lower)
+        Args:
+            message: Das KochaMessage-Object.
+            width: Die Breite einer Zeile.
 
-            # Den eigenen Alias im Nachrichtentext hervorheben
-            for alias_x in alias_x_positions:
-                self.messages_window.chgat(
-                    y,
-                    1 + alias_x,
-                    len(self.kocha_tcp_client.alias),
-                    curses.color_pair(KochaUiColorPair.DM))
+        Returns:
+            Liste von Tupeln aus dem Text einer Zeile und einer Liste
+            der Hervorhebungen (Tupel aus Position, Laenge und
+            Farbpaar).
+        """
+        # Indikator fuer Direct-Message, Server-Message oder
+        # Chat-Message und dessen Farbe bestimmen
+        color_pair = None
+        if message.sender == shared.KOCHA_SERVER_ALIAS:
+            indicator, color_pair = "[SM]", KochaUiColorPair.SERVER
+        elif message.sender == self.kocha_tcp_client.alias:
+            indicator = "[ME]"
+        elif message.is_dm:
+            indicator, color_pair = "[DM]", KochaUiColorPair.DM
+        else:
+            indicator = "[CM]"
+
+        # Indikator, Sendezeit und Alias des Senders voranstellen
+        header = "{}{}{}: ".format(
+            indicator,
+            message.sent_at.strftime("[%H:%M:%S] "),
+            message.sender)
+        text = header + message.content
+
+        # Den Kopf von Direktnachrichten und Servernachrichten
+        # hervorheben
+        spans = []
+        if color_pair is not None:
+            spans.append((0, len(header) - 1, color_pair))
+
+        # Den eigenen Alias und die Stichwoerter im Nachrichtentext
+        # hervorheben, aber nicht in Nachrichten, die man selbst
+        # geschrieben hat
+        if indicator != "[ME]":
+            spans.extend(
+                (x, length, KochaUiColorPair.DM)
+                for x, length in self.highlighter.find(text, len(header)))
+
+        # Newlines verarbeiten und die Zeilen an die Breite des User
+        # Interfaces anpassen. Hervorhebungen werden auf die Zeilen
+        # aufgeteilt
+        lines = []
+        offset = 0
+        for part in text.split("\n"):
+            for begin in range(0, len(part), width):
+                start = offset + begin
+                end = start + min(width, len(part) - begin)
+                lines.append((
+                    text[start:end],
+                    [
+                        (max(x, start) - start,
+                         min(x + length, end) - max(x, start),
+                         pair)
+                        for x, length, pair in spans
+                        if x < end and x + length > start]))
+            offset += len(part) + 1
+
+        return lines
 
     def draw_input_window(self):
         """
@@ -453,22 +979,102 @@ class KochaUi:
         Nachrichtenfenster zeichnen.
         """
         while not self.stop:
+            # Gesammelte Statusmeldungen anzeigen und faellige
+            # Empfangsbestaetigungen gesammelt senden
+            self.show_statuses()
+            self.kocha_tcp_client.flush_ack()
+
             try:
                 message = self.kocha_tcp_client.receive()
+            except socket.timeout:
+                continue
+            except (OSError, ValueError):
+                # Die Verbindung ist abgebrochen, daher versuchen sie
+                # wiederherzustellen
+                self.on_connection_lost()
+                continue
 
-                self.messages.append(message)
-                self.draw_messages_window()
+            # Nur die Mitgliederliste hat sich geaendert oder es kam ein
+            # Heartbeat
+            if message is None:
+                self.draw_title()
                 self.refresh()
-            except socket.timeout:
-                pass
+                continue
+
+            # Nachrichten der Dateiuebertragung nicht anzeigen
+            if self.transfers.handle(message):
+                continue
+
+            # Einen Batch nachgelieferter Nachrichten auf einmal
+            # anhaengen und nur einmal neu zeichnen
+            batch = message if isinstance(message, list) else [message]
+            self.messages.extend(batch)
+            if self.history is not None:
+                self.history.append(batch)
+            self.draw_messages_window()
+            self.refresh()
+
+    def on_connection_lost(self):
+        """
+        Den Nutzer ueber den Verbindungsabbruch informieren und die
+        Verbindung zum KOCHA-Server wiederherstellen.
+        """
+        self.show_status("Connection lost. Reconnecting...")
+
+        if self.kocha_tcp_client.reconnect(stop=lambda: self.stop):
+            self.show_status("Reconnected.")
+
+            # Ein neu gestarteter KOCHA-Server zaehlt von vorne
+            if self.history is not None:
+                self.history.rewind(self.kocha_tcp_client.last_seq)
+
+            # Unterbrochene Dateiuebertragungen fortsetzen
+            self.transfers.resume()
+
+    def show_status(self, content):
+        """
+        Eine lokale Statusmeldung im Nachrichtenfenster anzeigen.
+
+        Args:
+            content: Der Inhalt der Statusmeldung.
+        """
+        self.messages.append(shared.KochaMessage(
+            content=content, sender=shared.KOCHA_SERVER_ALIAS, is_dm=True))
+        self.draw_messages_window()
+        self.refresh()
+
+    def show_statuses(self):
+        """
+        Alle gesammelten Statusmeldungen (siehe statuses) anzeigen und
+        dabei nur einmal neu zeichnen.
+        """
+        count = len(self.messages)
+        try:
+            while True:
+                self.messages.append(shared.KochaMessage(
+                    content=self.statuses.get_nowait(),
+                    sender=shared.KOCHA_SERVER_ALIAS,
+                    is_dm=True))
+        except queue.Empty:
+            pass
+
+        if len(self.messages) > count:
+            self.draw_messages_window()
+            self.refresh()
 
     def draw_title(self):
         """
         Den Titel zeichnen.
         """
+        title = " KOCHA CLIENT " + shared.KOCHA_VERSION
+
+        # Die Anzahl der angemeldeten Nutzer anzeigen
+        if self.kocha_tcp_client.members is not None:
+            title += " - {} online".format(
+                len(self.kocha_tcp_client.members))
+
         self.stdscr.clear()
-        self.stdscr.addstr(
-            0, 0, " KOCHA CLIENT " + shared.KOCHA_VERSION, curses.A_REVERSE)
+        self.stdscr.addstr(0, 0, title, curses.A_REVERSE)
         self.stdscr.chgat(-1, curses.A_REVERSE)
 
     def resize(self):
@@ -502,33 +1108,98 @@ class KochaUi:
         locale.setlocale(locale.LC_ALL, "")
 
         # Kommandozeilenparameter verarbeiten
-        if (len(sys.argv) != 3):
-            print("Usage: python3 -m kocha.client SERVER_HOST SERVER_PORT")
-            return 1
-
-        server_host = sys.argv[1]
-        server_port = int(sys.argv[2])
+        parser = argparse.ArgumentParser(prog="python3 -m kocha.client")
+        parser.add_argument("server_host", metavar="SERVER_HOST", nargs="?")
+        parser.add_argument(
+            "server_port", metavar="SERVER_PORT", type=int, nargs="?")
+        parser.add_argument(
+            "--reliable", action="store_true",
+            help="acknowledge received messages so that the server can "
+                 "retransmit lost ones after a reconnect")
+        parser.add_argument(
+            "--tls", action="store_true",
+            help="encrypt the connection with TLS")
+        parser.add_argument(
+            "--cafile", metavar="PATH",
+            help="trusted certificates (PEM) for verifying the server")
+        parser.add_argument(
+            "--unix", metavar="PATH",
+            help="connect to a local server over its unix domain socket "
+                 "instead of SERVER_HOST and SERVER_PORT")
+        parser.add_argument(
+            "--highlight", metavar="KEYWORD", action="append", default=[],
+            help="also highlight this keyword or team handle besides your "
+                 "alias (repeatable)")
+        parser.add_argument(
+            "--download-dir", metavar="PATH", default=".",
+            help="directory for files received with /send (default: "
+                 "current directory)")
+        parser.add_argument(
+            "--cache-dir", metavar="PATH", default=cache.KOCHA_CACHE_DIR,
+            help="directory for the local message history (default: "
+                 "%(default)s)")
+        parser.add_argument(
+            "--no-cache", action="store_true",
+            help="don't keep a local message history")
+        args = parser.parse_args()
+        if args.unix is None and args.server_port is None:
+            parser.error("SERVER_HOST and SERVER_PORT or --unix are required")
 
         # Eine Instanz des KochaTcpClients erstellen und mit dem Server
         # verbinden
         kocha_tcp_client = KochaTcpClient(
-            server_host=server_host, server_port=server_port)
+            server_host=args.server_host,
+            server_port=args.server_port,
+            reliable=args.reliable,
+            tls=args.tls,
+            cafile=args.cafile,
+            unix_path=args.unix,
+            presence=True)
         if not kocha_tcp_client.is_connected:
             print("Couldn't connect with KOCHA-Server. Did you provide the"
                  "correct host and port? Is the KOCHA-Server running?")
             return 1
 
+        # Der lokale Verlauf gehoert zu KOCHA-Server und Alias
+        server = args.unix or "{}:{}".format(
+            args.server_host, args.server_port)
+
         # Mit dem Client am KOCHA-Server anmelden
         welcome_message = None
+        history = None
         while not kocha_tcp_client.alias:
             # Alias vom Benutzer holen
             alias = input("Enter alias: ")
 
+            # Den lokalen Verlauf oeffnen, damit der KOCHA-Server nur
+            # die seit der letzten Sitzung verpassten Nachrichten
+            # nachliefert
+            if not args.no_cache:
+                try:
+                    history = cache.KochaHistoryCache(
+                        args.cache_dir, server, alias)
+                    kocha_tcp_client.last_seq = history.last_seq
+                except OSError as e:
+                    print("Local history disabled: {}".format(e),
+                          file=sys.stderr)
+
             # Versuchen sich mit dem Alias anzumelden
             welcome_message = kocha_tcp_client.try_login(alias)
 
+            # Der Verlauf eines abgelehnten Alias wird nicht gebraucht
+            if not kocha_tcp_client.alias and history is not None:
+                history.close()
+                history = None
+                kocha_tcp_client.last_seq = None
+
             # Bei gescheiterter Anmeldung, Nutzer fragen, ob er es mit
             # einem anderen Alias nochmal probieren moechte
+            # Ein voller KOCHA-Server nimmt auch keinen anderen Alias an
+            if (welcome_message is not None
+                    and welcome_message.content.startswith("/full ")):
+                print(welcome_message.content[len("/full "):])
+                return 1
+
             if not kocha_tcp_client.alias:
                 print("The login failed. Your alias might be taken by another "
                       "user or your alias contains illegal characters like ':' "
@@ -538,8 +1209,17 @@ class KochaUi:
                 if try_again.lower() != "y":
                     return 1
 
+        # Ein neu gestarteter KOCHA-Server zaehlt von vorne
+        if history is not None:
+            history.rewind(kocha_tcp_client.last_seq)
+
         # Das User-Interface des KOCHA-Clients erstellen
-        ui = KochaUi(kocha_tcp_client, welcome_message=welcome_message)
+        ui = KochaUi(
+            kocha_tcp_client,
+            welcome_message=welcome_message,
+            keywords=args.highlight,
+            download_dir=args.download_dir,
+            history=history)
 
         # Wenn das Terminal keine Farben unterstuezt, hier abbrechen
         if not ui.has_colors:
@@ -0,0 +1,202 @@
+"""
+Modul zum Verteilen oeffentlicher Nachrichten an sehr viele Clients.
+Die angemeldeten Clientverbindungen werden auf eine feste Anzahl von
+Shards aufgeteilt, die jeweils in einem eigenen Thread schreiben. Der
+Thread des Senders reiht eine Nachricht nur einmal je Shard ein, statt
+sie selbst an jeden Empfaenger zu schreiben.
+"""
+
+import queue
+import threading
+
+from kocha import shared
+
+KOCHA_FANOUT_BATCH = 64
+"""
+Die maximale Anzahl an Nachrichten, die ein Shard auf einmal aus seiner
+Warteschlange nimmt. Alle Frames fuer dieselbe Verbindung werden dann
+mit einem Systemaufruf gesendet (siehe KochaFrameWriter.cork).
+"""
+
+
+class KochaFanoutShard:
+    """
+    Klasse fuer einen Shard. Der Shard haelt seine Clientverbindungen
+    als unveraenderliches Tupel, das nur bei An- und Abmeldungen neu
+    erstellt wird, und schreibt die eingereihten Nachrichten in seinem
+    Thread an die Verbindungen, die beim Einreihen dazugehoerten.
+
+    Der Shard besitzt die Verbindungen nicht allein. Die Threads der
+    Clients schreiben Antworten weiterhin selbst, und ein Client, der
+    nicht mehr liest, haelt den Shard bis zum Timeout des Sendens auf.
+    """
+
+    def __init__(self, index):
+        """
+        Initialisiert ein Object der Klasse KochaFanoutShard und startet
+        seinen Thread.
+
+        Args:
+            index: Die Nummer des Shards.
+        """
+        # Die Verbindungen des Shards. Geaendert wird nur unter dem
+        # Lock von KochaFanout
+        self.clients = ()
+
+        # Die Warteschlange blockiert beim Einreihen nie. Eintraege sind
+        # Tupel aus Frame, Empfaengern, ausgenommener Verbindung und
+        # Spur, ein threading.Event (siehe KochaFanout.flush) oder None
+        # zum Beenden
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(
+            target=self.run, name="fanout-{}".format(index), daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Die eingereihten Nachrichten an die Verbindungen des Shards
+        schreiben, bis None eingereiht wird.
+        """
+        running = True
+        while running:
+            # Auf die naechste Nachricht warten und dann alle weiteren
+            # bereits wartenden mitnehmen
+            jobs = [self.queue.get()]
+            while len(jobs) < KOCHA_FANOUT_BATCH:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            events = []
+            with shared.KochaFrameWriter.cork():
+                for job in jobs:
+                    if job is None:
+                        running = False
+                        break
+                    if isinstance(job, threading.Event):
+                        events.append(job)
+                        continue
+
+                    frame, clients, excluded, lane = job
+                    for client in clients:
+                        if client is not excluded:
+                            client.send_frame(frame, lane)
+
+            # Erst nach dem Senden melden, dass die Nachrichten davor
+            # zugestellt sind
+            for event in events:
+                event.set()
+
+
+class KochaFanout:
+    """
+    Klasse verteilt oeffentliche Nachrichten ueber mehrere
+    KochaFanoutShards. Neue Verbindungen kommen in den Shard mit den
+    wenigsten Verbindungen.
+    """
+
+    def __init__(self, shards):
+        """
+        Initialisiert ein Object der Klasse KochaFanout.
+
+        Args:
+            shards: Die Anzahl der Shards (mindestens 1).
+        """
+        self.shards = [KochaFanoutShard(i) for i in range(shards)]
+
+        # Der Shard je Verbindung
+        self.assigned = {}
+        self.lock = threading.Lock()
+
+    def add(self, client):
+        """
+        Eine Verbindung einem Shard zuordnen.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+        """
+        with self.lock:
+            if client in self.assigned:
+                return
+            shard = min(self.shards, key=lambda shard: len(shard.clients))
+            shard.clients += (client,)
+            self.assigned[client] = shard
+
+    def remove(self, client):
+        """
+        Eine Verbindung aus ihrem Shard entfernen.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+        """
+        with self.lock:
+            shard = self.assigned.pop(client, None)
+            if shard is not None:
+                shard.clients = tuple(
+                    cli for cli in shard.clients if cli is not client)
+
+    def broadcast(self, frame, excluded=None,
+                  lane=shared.KOCHA_LANE_BROADCAST):
+        """
+        Einen Frame an alle Verbindungen senden. Der Aufruf reiht den
+        Frame nur in jeden Shard ein und kehrt sofort zurueck.
+
+        Args:
+            frame: Die Bytes des Frames (siehe JsonUtils.to_frame).
+            excluded: Die Clientverbindung, die den Frame nicht
+                erhaelt, oder None.
+            lane: Die Spur (KOCHA_LANE_*) des Frames.
+        """
+        # Die Empfaenger beim Einreihen festhalten. Wer sich spaeter
+        # anmeldet, hat die Nachricht bereits mit der Nachlieferung
+        # erhalten
+        for shard in self.shards:
+            shard.queue.put((frame, shard.clients, excluded, lane))
+
+    def send(self, client, frame, lane=shared.KOCHA_LANE_BROADCAST):
+        """
+        Einen Frame an eine einzelne Verbindung ueber deren Shard
+        senden, damit er nach den zuvor fuer sie eingereihten Frames
+        ankommt. Eine Verbindung ohne Shard erhaelt ihn direkt.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            frame: Die Bytes des Frames (siehe JsonUtils.to_frame).
+            lane: Die Spur (KOCHA_LANE_*) des Frames.
+        """
+        # Lesen ohne Lock genuegt, die Zuordnung aendert sich nur beim
+        # An- und Abmelden
+        shard = self.assigned.get(client)
+        if shard is None:
+            client.send_frame(frame, lane)
+            return
+        shard.queue.put((frame, (client,), None, lane))
+
+    def flush(self, timeout=None):
+        """
+        Warten, bis alle bisher eingereihten Frames gesendet sind.
+
+        Args:
+            timeout: Die maximale Wartezeit je Shard in Sekunden oder
+                None fuer unbegrenzt.
+
+        Returns:
+            True, wenn alle Shards fertig sind, sonst False.
+        """
+        events = []
+        for shard in self.shards:
+            event = threading.Event()
+            shard.queue.put(event)
+            events.append(event)
+        return all(event.wait(timeout) for event in events)
+
+    def close(self):
+        """
+        Die ausstehenden Frames senden und die Threads der Shards
+        beenden.
+        """
+        for shard in self.shards:
+            shard.queue.put(None)
+        for shard in self.shards:
+            shard.thread.join()
@@ -0,0 +1,121 @@
+"""
+Modul mit einem Timer Wheel, mit dem der KOCHA-Server alle
+Clientverbindungen in festen Abstaenden prueft (siehe
+KochaTcpServer.on_heartbeat), ohne je Verbindung einen eigenen Timer zu
+benoetigen.
+"""
+
+import logging
+import threading
+
+KOCHA_HEARTBEAT_INTERVAL = 30.0
+"""
+Die Zeit in Sekunden ohne eingehende Daten, nach der der KOCHA-Server
+einem Client ein ``/ping`` schickt. Der Client antwortet mit
+``/pong``.
+"""
+
+KOCHA_HEARTBEAT_MISSES = 3
+"""
+Die Anzahl der Intervalle ohne eingehende Daten, nach denen der
+KOCHA-Server eine Verbindung als tot ansieht und schließt.
+"""
+
+KOCHA_HEARTBEAT_SLOTS = 32
+"""
+Die Anzahl der Faecher des Timer Wheels. Die Verbindungen verteilen
+sich auf die Faecher, sodass je Schritt nur ein Bruchteil geprueft wird.
+"""
+
+logger = logging.getLogger(__name__)
+"""
+Der Logger fuer Fehler im Callback des Timer Wheels.
+"""
+
+
+class KochaTimerWheel:
+    """
+    Klasse ruft fuer jedes Element einmal je Periode einen Callback
+    auf. Die Elemente liegen in Faechern, von denen ein eigener Thread
+    in jedem Schritt (Periode geteilt durch Anzahl der Faecher) genau
+    eins abarbeitet. Einfuegen und Entfernen kosten unabhaengig von der
+    Anzahl der Elemente gleich viel.
+    """
+
+    def __init__(self, period, callback, slots=KOCHA_HEARTBEAT_SLOTS):
+        """
+        Initialisiert ein Object der Klasse KochaTimerWheel und startet
+        seinen Thread.
+
+        Args:
+            period: Die Periode in Sekunden.
+            callback: Die Funktion, die mit dem Element aufgerufen
+                wird.
+            slots: Die Anzahl der Faecher.
+        """
+        self.tick = period / slots
+        self.callback = callback
+
+        # Die Elemente je Fach, das Fach je Element und das Fach, das
+        # als naechstes abgearbeitet wird
+        self.slots = [set() for _ in range(slots)]
+        self.where = {}
+        self.position = 0
+        self.lock = threading.Lock()
+
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="timer-wheel", daemon=True)
+        self.thread.start()
+
+    def add(self, item):
+        """
+        Ein Element einfuegen. Der Callback wird zum ersten Mal nach
+        einer Periode aufgerufen.
+
+        Args:
+            item: Das Element.
+        """
+        with self.lock:
+            # Das gerade abgearbeitete Fach kommt erst nach einer
+            # vollen Umdrehung wieder an die Reihe
+            slot = (self.position - 1) % len(self.slots)
+            self.slots[slot].add(item)
+            self.where[item] = slot
+
+    def remove(self, item):
+        """
+        Ein Element entfernen.
+
+        Args:
+            item: Das Element.
+        """
+        with self.lock:
+            slot = self.where.pop(item, None)
+            if slot is not None:
+                self.slots[slot].discard(item)
+
+    def run(self):
+        """
+        Je Schritt ein Fach abarbeiten, bis stop aufgerufen wird.
+        """
+        while not self.stopped.wait(self.tick):
+            with self.lock:
+                items = list(self.slots[self.position])
+                self.position = (self.position + 1) % len(self.slots)
+
+            # Der Callback laeuft ohne Lock, damit er Elemente
+            # entfernen kann. Ein Fehler betrifft nur dieses Element,
+            # sonst endeten alle weiteren Pruefungen mit dem Thread
+            for item in items:
+                try:
+                    self.callback(item)
+                except Exception:
+                    logger.exception("Timer wheel callback failed")
+
+    def stop(self):
+        """
+        Den Thread beenden.
+        """
+        self.stopped.set()
+        self.thread.join()
@@ -0,0 +1,304 @@
+"""
+Modul fuer das strukturierte Protokoll des KOCHA-Servers. Die Threads,
+die Nachrichten zustellen, reihen Eintraege nur in eine Warteschlange
+ein. Ein eigener Thread formatiert sie als JSON-Zeilen und schreibt sie
+in eine rotierende Datei oder nach stderr, sodass ein langsamer
+Datentraeger die Zustellung nie aufhaelt.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+KOCHA_LOG_MAX_BYTES = 10 * 1024 * 1024
+"""
+Die Groeße in Bytes, ab der die Protokolldatei rotiert wird.
+"""
+
+KOCHA_LOG_BACKUPS = 5
+"""
+Die Anzahl der rotierten Protokolldateien, die aufbewahrt werden.
+"""
+
+KOCHA_LOG_QUEUE_SIZE = 10000
+"""
+Die maximale Anzahl an Eintraegen, die auf das Schreiben warten. Ist
+die Warteschlange voll, werden weitere Eintraege verworfen und nur
+gezaehlt, statt die Zustellung von Nachrichten aufzuhalten.
+"""
+
+KOCHA_LOG_SAMPLE_BURST = 10
+"""
+Die Anzahl gleichartiger Warnungen und Fehler, die je Zeitfenster
+protokolliert werden. Weitere werden nur gezaehlt und mit dem naechsten
+protokollierten Eintrag gemeldet.
+"""
+
+KOCHA_LOG_SAMPLE_WINDOW = 60.0
+"""
+Die Laenge des Zeitfensters in Sekunden fuer KOCHA_LOG_SAMPLE_BURST.
+"""
+
+
+class KochaLogHandler(logging.handlers.QueueHandler):
+    """
+    Klasse reiht die Eintraege ohne Formatierung in eine
+    queue.SimpleQueue ein. Diese blockiert beim Einreihen nie. Ist die
+    Warteschlange voll, wird der Eintrag verworfen und gezaehlt.
+    """
+
+    def __init__(self, size=KOCHA_LOG_QUEUE_SIZE):
+        """
+        Initialisiert ein Object der Klasse KochaLogHandler.
+
+        Args:
+            size: Die maximale Anzahl wartender Eintraege.
+        """
+        super().__init__(queue.SimpleQueue())
+        self.size = size
+
+        # Anzahl der verworfenen Eintraege
+        self.dropped = 0
+
+    def prepare(self, record):
+        """
+        Den Eintrag unveraendert einreihen. Formatiert wird erst im
+        schreibenden Thread.
+
+        Args:
+            record: Der logging.LogRecord.
+
+        Returns:
+            Der logging.LogRecord.
+        """
+        return record
+
+    def enqueue(self, record):
+        """
+        Den Eintrag einreihen oder verwerfen, wenn die Warteschlange
+        voll ist.
+
+        Args:
+            record: Der logging.LogRecord.
+        """
+        # qsize ist nur ungefaehr, genuegt aber als Obergrenze
+        if self.queue.qsize() >= self.size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+class KochaJsonFormatter(logging.Formatter):
+    """
+    Klasse formatiert einen Eintrag als eine JSON-Zeile. Zusaetzliche
+    Felder, die beim Protokollieren mit extra uebergeben werden, z.B.
+    die Adresse eines Clients, werden als eigene Schluessel
+    uebernommen.
+    """
+
+    RESERVED = frozenset(vars(logging.LogRecord(
+        "", logging.INFO, "", 0, "", None, None))) | {"message"}
+    """
+    Die Attribute, die jeder logging.LogRecord hat und die daher nicht
+    als zusaetzliche Felder gelten.
+    """
+
+    def format(self, record):
+        """
+        Einen Eintrag als JSON-Zeile formatieren.
+
+        Args:
+            record: Der logging.LogRecord.
+
+        Returns:
+            Die JSON-Zeile ohne Zeilenumbruch.
+        """
+        entry = {
+            "time": time.strftime(
+                "%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+                + ".{:03d}".format(int(record.msecs)),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+
+        # Zusaetzliche Felder uebernehmen. Was sich nicht als JSON
+        # darstellen laesst, wird als Text geschrieben
+        for key, value in vars(record).items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class KochaSampleFilter(logging.Filter):
+    """
+    Klasse begrenzt gleichartige Warnungen und Fehler, z.B. ein
+    fehlgeschlagenes Senden an viele getrennte Clients, auf burst
+    Eintraege je Zeitfenster. Gleichartig sind Eintraege mit demselben
+    Logger und derselben Formatvorlage. Der erste Eintrag nach dem
+    Zeitfenster meldet im Feld suppressed, wie viele verworfen wurden.
+    """
+
+    def __init__(
+            self, burst=KOCHA_LOG_SAMPLE_BURST,
+            window=KOCHA_LOG_SAMPLE_WINDOW):
+        """
+        Initialisiert ein Object der Klasse KochaSampleFilter.
+
+        Args:
+            burst: Die Anzahl gleichartiger Eintraege je Zeitfenster.
+            window: Die Laenge des Zeitfensters in Sekunden.
+        """
+        super().__init__()
+        self.burst = burst
+        self.window = window
+
+        # Je Art: Beginn des Zeitfensters, Anzahl protokollierter und
+        # Anzahl verworfener Eintraege
+        self.counts = {}
+
+    def filter(self, record):
+        """
+        Entscheiden, ob ein Eintrag protokolliert wird.
+
+        Args:
+            record: Der logging.LogRecord.
+
+        Returns:
+            True, wenn der Eintrag protokolliert wird.
+        """
+        # Nur Warnungen und Fehler werden begrenzt
+        if record.levelno < logging.WARNING:
+            return True
+
+        key = (record.name, record.msg)
+        start, logged, suppressed = self.counts.get(key, (0.0, 0, 0))
+
+        # Ein neues Zeitfenster beginnen
+        if record.created - start >= self.window:
+            start, logged = record.created, 0
+
+        if logged >= self.burst:
+            self.counts[key] = (start, logged, suppressed + 1)
+            return False
+
+        if suppressed:
+            record.suppressed = suppressed
+        self.counts[key] = (start, logged + 1, 0)
+        return True
+
+
+class KochaLog:
+    """
+    Klasse richtet das Protokoll fuer den Logger "kocha" und damit alle
+    Module des Pakets ein. Ein logging.handlers.QueueListener schreibt
+    die Eintraege in einem eigenen Thread.
+    """
+
+    def __init__(
+            self, path=None, level=logging.INFO,
+            max_bytes=KOCHA_LOG_MAX_BYTES, backups=KOCHA_LOG_BACKUPS,
+            queue_size=KOCHA_LOG_QUEUE_SIZE,
+            sample_burst=KOCHA_LOG_SAMPLE_BURST,
+            sample_window=KOCHA_LOG_SAMPLE_WINDOW):
+        """
+        Initialisiert ein Object der Klasse KochaLog.
+
+        Args:
+            path: Pfad der Protokolldatei oder None fuer stderr.
+            level: Die niedrigste protokollierte Stufe als Zahl oder
+                Name (z.B. "warning").
+            max_bytes: Die Groeße in Bytes, ab der die Datei rotiert
+                wird, oder 0, um nie zu rotieren.
+            backups: Die Anzahl aufbewahrter rotierter Dateien.
+            queue_size: Die maximale Anzahl wartender Eintraege.
+            sample_burst: Die Anzahl gleichartiger Warnungen und Fehler
+                je Zeitfenster.
+            sample_window: Die Laenge des Zeitfensters in Sekunden.
+        """
+        if isinstance(level, str):
+            level = logging.getLevelName(level.upper())
+        self.level = level
+
+        # Der Handler, der in die Datei oder nach stderr schreibt. Er
+        # laeuft nur im Thread des QueueListener, daher wirken Formatieren
+        # und Begrenzen nicht auf die Zustellung
+        if path is None:
+            target = logging.StreamHandler(sys.stderr)
+        else:
+            target = logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups,
+                encoding="utf-8")
+        target.setFormatter(KochaJsonFormatter())
+        target.addFilter(KochaSampleFilter(sample_burst, sample_window))
+
+        self.handler = KochaLogHandler(queue_size)
+        self.listener = logging.handlers.QueueListener(
+            self.handler.queue, target, respect_handler_level=True)
+        self.logger = logging.getLogger("kocha")
+        self.lock = threading.Lock()
+        self.started = False
+        self.excepthook = None
+
+    def start(self):
+        """
+        Das Protokoll einrichten und den schreibenden Thread starten.
+        """
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+
+        # Stufen unterhalb von level erzeugen gar keinen Eintrag
+        self.logger.setLevel(self.level)
+        self.logger.addHandler(self.handler)
+        self.logger.propagate = False
+        self.listener.start()
+
+        # Unbehandelte Ausnahmen in Threads ebenfalls protokollieren,
+        # statt sie nur nach stderr zu schreiben
+        self.excepthook = threading.excepthook
+        threading.excepthook = self.on_thread_exception
+
+    def on_thread_exception(self, args):
+        """
+        Eine unbehandelte Ausnahme eines Threads protokollieren (siehe
+        threading.excepthook).
+
+        Args:
+            args: Die Angaben zur Ausnahme.
+        """
+        if issubclass(args.exc_type, SystemExit):
+            return
+        self.logger.error(
+            "Unhandled exception in thread %s",
+            args.thread.name if args.thread else None,
+            exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
+
+    def close(self):
+        """
+        Die restlichen Eintraege schreiben und das Protokoll beenden.
+        """
+        with self.lock:
+            if not self.started:
+                return
+            self.started = False
+
+        threading.excepthook = self.excepthook
+        self.logger.removeHandler(self.handler)
+        self.logger.propagate = True
+        self.listener.stop()
+        for handler in self.listener.handlers:
+            handler.close()
+
+        if self.handler.dropped:
+            print("Dropped {} log records".format(self.handler.dropped),
+                  file=sys.stderr)
@@ -0,0 +1,246 @@
+"""
+Modul zum Wiedergeben einer Aufzeichnung (siehe kocha.capture) gegen
+einen KOCHA-Server, um den Durchsatz mit realen Lastprofilen zu testen.
+
+Aufruf:
+    python3 -m kocha.replay CAPTURE HOST PORT [--speed FAKTOR]
+"""
+
+import argparse
+import selectors
+import socket
+import sys
+import threading
+import time
+
+from kocha import capture, shared
+
+KOCHA_REPLAY_CLOSE_TIMEOUT = 5.0
+"""
+Die Zeit in Sekunden, die beim Wiedergeben ohne Pausen hoechstens
+darauf gewartet wird, dass der KOCHA-Server eine Verbindung schließt.
+"""
+
+
+class KochaReplay:
+    """
+    Klasse gibt eine Aufzeichnung mit denselben gleichzeitig offenen
+    Verbindungen wieder. Jede aufgezeichnete Verbindung erhaelt eine
+    eigene Verbindung zum KOCHA-Server, und die Frames werden im
+    aufgezeichneten zeitlichen Abstand (geteilt durch speed) gesendet.
+    Die Antworten des KOCHA-Servers werden in einem eigenen Thread
+    gelesen und nur gezaehlt.
+    """
+
+    def __init__(self, path, host, port, speed=1.0):
+        """
+        Initialisiert ein Object der Klasse KochaReplay.
+
+        Args:
+            path: Pfad der Aufzeichnung.
+            host: Der Host des KOCHA-Servers.
+            port: Der Port des KOCHA-Servers.
+            speed: Der Faktor, um den die Wiedergabe schneller als die
+                Aufzeichnung ablaeuft, oder 0 fuer so schnell wie
+                moeglich.
+        """
+        self.path = path
+        self.address = (host, port)
+        self.speed = speed
+
+        # Die Verbindungen je aufgezeichneter Id und der Selector, mit
+        # dem die Antworten gelesen werden
+        self.sockets = {}
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.done = False
+
+        # Statistik der Wiedergabe
+        self.connections = 0
+        self.failed = 0
+        self.sent = 0
+        self.received = 0
+        self.max_lag = 0.0
+
+    def run(self):
+        """
+        Die Aufzeichnung wiedergeben.
+
+        Returns:
+            Die Dauer der Wiedergabe in Sekunden.
+        """
+        reader = threading.Thread(target=self.drain, daemon=True)
+        reader.start()
+
+        start = time.monotonic()
+        for at, connection_id, kind, data in capture.KochaCapture.read(
+                self.path):
+            # Bis zum (skalierten) Zeitpunkt des Eintrags warten und
+            # merken, wie weit die Wiedergabe hinterherhinkt
+            if self.speed:
+                delay = start + at / self.speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.max_lag = max(self.max_lag, -delay)
+
+            if kind == capture.KochaCapture.OPEN:
+                self.open(connection_id)
+            elif kind == capture.KochaCapture.FRAME:
+                self.send(connection_id, data)
+            elif kind == capture.KochaCapture.CLOSE and self.speed:
+                self.close(connection_id)
+            elif kind == capture.KochaCapture.CLOSE:
+                # Ohne Pausen wuerde die Verbindung geschlossen, bevor
+                # die Antworten ankommen. Dann nur die Senderichtung
+                # schließen und warten, bis der KOCHA-Server fertig ist,
+                # damit z.B. eine neue Anmeldung mit demselben Alias
+                # nicht vor der Abmeldung ankommt
+                self.finish(connection_id)
+
+        elapsed = time.monotonic() - start
+
+        # Auf die letzten Antworten warten
+        received = -1
+        while received != self.received:
+            received = self.received
+            time.sleep(0.5)
+
+        for connection_id in list(self.sockets):
+            self.close(connection_id)
+        self.done = True
+        reader.join()
+        self.selector.close()
+        return elapsed
+
+    def open(self, connection_id):
+        """
+        Eine Verbindung zum KOCHA-Server herstellen.
+
+        Args:
+            connection_id: Die Id der aufgezeichneten Verbindung.
+        """
+        try:
+            sock = socket.create_connection(self.address)
+        except OSError as e:
+            print(e, file=sys.stderr)
+            self.failed += 1
+            return
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.sockets[connection_id] = sock
+            self.selector.register(sock, selectors.EVENT_READ)
+        self.connections += 1
+
+    def send(self, connection_id, data):
+        """
+        Einen aufgezeichneten Frame ueber die zugehoerige Verbindung
+        senden.
+
+        Args:
+            connection_id: Die Id der aufgezeichneten Verbindung.
+            data: Der Frame ohne Trennzeichen.
+        """
+        sock = self.sockets.get(connection_id)
+        if sock is None:
+            return
+        try:
+            sock.sendall(data.encode() + shared.KOCHA_FRAME_DELIMITER)
+            self.sent += 1
+        except OSError:
+            self.close(connection_id)
+
+    def close(self, connection_id):
+        """
+        Eine Verbindung zum KOCHA-Server schließen.
+
+        Args:
+            connection_id: Die Id der aufgezeichneten Verbindung.
+        """
+        with self.lock:
+            sock = self.sockets.pop(connection_id, None)
+            if sock is None:
+                return
+            if sock.fileno() in self.selector.get_map():
+                self.selector.unregister(sock)
+        sock.close()
+
+    def finish(self, connection_id):
+        """
+        Eine Verbindung zum KOCHA-Server halb schließen, die restlichen
+        Antworten lesen und die Verbindung schließen, sobald der
+        KOCHA-Server sie geschlossen hat.
+
+        Args:
+            connection_id: Die Id der aufgezeichneten Verbindung.
+        """
+        # Die Verbindung dem lesenden Thread entziehen
+        with self.lock:
+            sock = self.sockets.pop(connection_id, None)
+            if sock is None:
+                return
+            if sock.fileno() in self.selector.get_map():
+                self.selector.unregister(sock)
+
+        # Die restlichen Antworten bis zum Ende der Verbindung zaehlen
+        try:
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(KOCHA_REPLAY_CLOSE_TIMEOUT)
+            while True:
+                data = sock.recv(65536)
+                if not data:
+                    break
+                self.received += data.count(shared.KOCHA_FRAME_DELIMITER)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+
+    def drain(self):
+        """
+        Die Antworten des KOCHA-Servers lesen und die Frames zaehlen,
+        bis die Wiedergabe beendet ist.
+        """
+        while not self.done:
+            for key, _ in self.selector.select(0.1):
+                try:
+                    data = key.fileobj.recv(65536)
+                except OSError:
+                    continue
+                if not data:
+                    with self.lock:
+                        if key.fd in self.selector.get_map():
+                            self.selector.unregister(key.fileobj)
+                    continue
+                self.received += data.count(shared.KOCHA_FRAME_DELIMITER)
+
+    @staticmethod
+    def start():
+        """
+        Startet die Wiedergabe mit den Kommandozeilenparametern.
+        """
+        parser = argparse.ArgumentParser(prog="python3 -m kocha.replay")
+        parser.add_argument("capture", metavar="CAPTURE")
+        parser.add_argument("host", metavar="HOST")
+        parser.add_argument("port", metavar="PORT", type=int)
+        parser.add_argument(
+            "--speed", metavar="FACTOR", type=float, default=1.0,
+            help="replay speed, e.g. 1 or 10 (default: %(default)s, 0 "
+                 "replays as fast as possible)")
+        args = parser.parse_args()
+
+        replay = KochaReplay(args.capture, args.host, args.port, args.speed)
+        elapsed = replay.run()
+
+        print("connections      {} ({} failed)".format(
+            replay.connections, replay.failed))
+        print("frames sent      {} ({:.0f}/s)".format(
+            replay.sent, replay.sent / elapsed if elapsed else 0))
+        print("frames received  {}".format(replay.received))
+        print("duration         {:.2f} s".format(elapsed))
+        print("max lag          {:.1f} ms".format(replay.max_lag * 1e3))
+
+
+if __name__ == "__main__":
+    sys.exit(KochaReplay.start())
@@ -0,0 +1,351 @@
+"""
+Modul mit einem invertierten Index fuer die Volltextsuche im Verlauf
+des KOCHA-Servers.
+"""
+
+import array
+import bisect
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+KOCHA_SEARCH_PAGE_SIZE = 10
+"""
+Die Anzahl der Treffer pro Seite einer Suche.
+"""
+
+KOCHA_SEARCH_TOKEN_PATTERN = re.compile(r"\w+")
+"""
+Regulaerer Ausdruck fuer die Woerter einer Nachricht, die in den Index
+aufgenommen werden. Links werden so in ihre Bestandteile zerlegt und
+koennen z.B. mit ``example com`` gefunden werden.
+"""
+
+logger = logging.getLogger(__name__)
+"""
+Der Logger fuer Fehler beim Einlesen der gespeicherten Nachrichten.
+"""
+
+
+class KochaSearchIndex:
+    """
+    Invertierter Index ueber alle vom KOCHA-Server versendeten
+    Nachrichten.
+
+    Jede Nachricht erhaelt eine fortlaufende Id. Der Index bildet jedes
+    Wort (in Kleinbuchstaben) und jeden Sender (als ``from:<alias>``)
+    auf eine aufsteigend sortierte Liste der Ids ab, in denen es
+    vorkommt. Nachrichten werden mit add in eine Warteschlange gelegt
+    und von einem eigenen Thread in den Index aufgenommen, damit der
+    Versand nicht auf den Index warten muss.
+
+    Optional werden die Nachrichten in einer Datei (eine JSON-Zeile pro
+    Nachricht) gespeichert und beim Start wieder eingelesen.
+    """
+
+    def __init__(self, path=None):
+        """
+        Initialisiert ein Object der Klasse KochaSearchIndex und startet
+        den Thread, der den Index aktualisiert.
+
+        Args:
+            path: Pfad der Datei, in der die Nachrichten gespeichert
+                werden, oder None, um sie nur im Speicher zu halten.
+        """
+        # Die Nachrichten als Tupel aus Sender, is_dm, Empfaenger und
+        # Inhalt, der Zeitpunkt ihres Eingangs beim KOCHA-Server und
+        # die Postinglisten je Wort bzw. Sender
+        self.messages = []
+        self.times = array.array("d")
+        self.postings = {}
+        self.lock = threading.Lock()
+
+        # Bereits gespeicherte Nachrichten einlesen und die Datei fuer
+        # neue Nachrichten oeffnen
+        self.file = None
+        if path is not None:
+            self.load(path)
+            self.file = open(path, "a", encoding="utf-8")
+
+        # Warteschlange mit den noch nicht aufgenommenen Nachrichten
+        self.queue = queue.SimpleQueue()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def load(self, path):
+        """
+        Die gespeicherten Nachrichten einlesen. Unlesbare Zeilen werden
+        uebersprungen. Nach einem Absturz kann die letzte Zeile
+        unvollstaendig sein. Nur sie wird abgeschnitten, damit neue
+        Nachrichten wieder auf einer eigenen Zeile beginnen.
+
+        Args:
+            path: Pfad der Datei mit den Nachrichten.
+        """
+        offset = 0
+        try:
+            with open(path, "r+b") as file:
+                for line in file:
+                    # Eine unvollstaendige Zeile kann nur die letzte sein
+                    if not line.endswith(b"\n"):
+                        logger.warning(
+                            "Dropped incomplete last line of %d bytes "
+                            "in %s", len(line), path)
+                        file.truncate(offset)
+                        break
+
+                    try:
+                        self.index(*json.loads(line.decode("utf-8")))
+                    except (TypeError, ValueError):
+                        logger.warning(
+                            "Skipped unreadable line at byte %d in %s",
+                            offset, path)
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+
+    def add(self, message, recipient=None):
+        """
+        Eine Nachricht zur Aufnahme in den Index vormerken.
+
+        Args:
+            message: Das KochaMessage-Object.
+            recipient: Der Alias des Empfaengers bei einer
+                Direct-Message, sonst None.
+        """
+        self.queue.put((
+            time.time(),
+            message.sender,
+            message.is_dm,
+            recipient,
+            message.content))
+
+    def flush(self):
+        """
+        Warten, bis alle vorgemerkten Nachrichten im Index und in der
+        Datei stehen.
+
+        Returns:
+            False, wenn der Thread nicht mehr laeuft, sonst True.
+        """
+        done = threading.Event()
+        self.queue.put(done)
+
+        # Regelmaeßig pruefen, ob der Thread noch lebt, statt ewig auf
+        # ein Signal zu warten, das nie kommt
+        while not done.wait(1.0):
+            if not self.worker.is_alive():
+                logger.error("Search index thread is not running")
+                return False
+        return True
+
+    def close(self):
+        """
+        Die vorgemerkten Nachrichten noch aufnehmen, den Thread beenden
+        und die Datei schließen.
+        """
+        self.queue.put(None)
+        self.worker.join()
+        if self.file is not None:
+            self.file.close()
+
+    def run(self):
+        """
+        Vorgemerkte Nachrichten gesammelt in den Index aufnehmen und in
+        die Datei schreiben, bis close aufgerufen wird.
+        """
+        while True:
+            # Auf die naechste Nachricht warten und alle weiteren, die
+            # bereits vorliegen, gleich mit aufnehmen
+            batch = [self.queue.get()]
+            try:
+                while True:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            # Ein fehlerhafter Eintrag darf den Thread nicht beenden
+            entries = []
+            with self.lock:
+                for entry in batch:
+                    if not isinstance(entry, tuple):
+                        continue
+                    try:
+                        self.index(*entry)
+                    except (TypeError, ValueError) as e:
+                        logger.warning("Skipped message: %s", e)
+                        continue
+                    entries.append(entry)
+
+            if self.file is not None and entries:
+                self.file.writelines(
+                    json.dumps(entry) + "\n" for entry in entries)
+                self.file.flush()
+
+            # Auf flush wartende Threads wecken
+            for entry in batch:
+                if isinstance(entry, threading.Event):
+                    entry.set()
+
+            if None in batch:
+                return
+
+    def index(self, sent_at, sender, is_dm, recipient, content):
+        """
+        Eine Nachricht in den Index aufnehmen. Der Aufrufer haelt lock
+        (oder ist beim Einlesen der Datei noch der einzige Thread).
+
+        Args:
+            sent_at: Der Zeitpunkt des Eingangs beim KOCHA-Server als
+                Timestamp.
+            sender: Der Alias des Senders.
+            is_dm: Gibt an, ob es sich um eine Direct-Message handelt.
+            recipient: Der Alias des Empfaengers bei einer
+                Direct-Message, sonst None.
+            content: Der Inhalt der Nachricht.
+
+        Raises:
+            TypeError: Wenn der Eintrag ungueltige Typen enthaelt.
+            ValueError: Wenn der Zeitpunkt keine Zahl ist.
+        """
+        # Zuerst alles berechnen, was an einem fehlerhaften Eintrag
+        # scheitern kann, damit messages, times und die Postinglisten
+        # zusammenpassen. Jedes Wort nur einmal je Nachricht aufnehmen
+        if not isinstance(sender, str) or not isinstance(content, str):
+            raise TypeError("sender and content must be strings")
+        sent_at = float(sent_at)
+        keys = set(self.tokenize(content))
+        keys.add("from:" + sender)
+
+        # Die Systemzeit kann zurueckspringen. Die Zeitpunkte muessen
+        # fuer bisect aber aufsteigend sortiert bleiben
+        if self.times:
+            sent_at = max(sent_at, self.times[-1])
+
+        # Die Ids sind fortlaufend, daher bleiben die Postinglisten
+        # sortiert
+        message_id = len(self.messages)
+        self.messages.append((sender, is_dm, recipient, content))
+        self.times.append(sent_at)
+        for key in keys:
+            posting = self.postings.get(key)
+            if posting is None:
+                posting = self.postings[key] = array.array("I")
+            posting.append(message_id)
+
+    def search(
+            self, alias, words="", sender=None, is_dm=None, after=None,
+            before=None, page=1):
+        """
+        Die neuesten Nachrichten suchen, die alle Woerter enthalten und
+        zu allen Filtern passen. Direct-Messages findet nur der Sender
+        oder Empfaenger.
+
+        Args:
+            alias: Der Alias des suchenden Nutzers.
+            words: Die gesuchten Woerter.
+            sender: Nur Nachrichten dieses Senders oder None.
+            is_dm: True fuer nur Direct-Messages, False fuer nur
+                oeffentliche Nachrichten, None fuer beide.
+            after: Nur Nachrichten ab diesem Timestamp oder None.
+            before: Nur Nachrichten vor diesem Timestamp oder None.
+            page: Die Seite der Treffer, beginnend bei 1.
+
+        Returns:
+            Tupel aus der Liste der Treffer (jeweils ein Tupel aus
+            Timestamp, Sender, is_dm, Empfaenger und Inhalt) und der
+            Angabe, ob es weitere Seiten gibt.
+
+        Raises:
+            ValueError: Wenn weder Woerter noch ein Sender angegeben
+                sind.
+        """
+        keys = set(self.tokenize(words))
+        if sender is not None:
+            keys.add("from:" + sender)
+        if not keys:
+            raise ValueError("No search terms")
+
+        skip = (page - 1) * KOCHA_SEARCH_PAGE_SIZE
+        results = []
+        with self.lock:
+            postings = [self.postings.get(key) for key in keys]
+            if None in postings:
+                return results, False
+
+            # Von der kuerzesten Postingliste ausgehend in den anderen
+            # per Binaersuche pruefen, ob die Id ebenfalls vorkommt
+            postings.sort(key=len)
+            shortest, others = postings[0], postings[1:]
+
+            # Die Zeitpunkte steigen mit der Id, daher begrenzt der
+            # Zeitraum den Bereich der Ids
+            first, last = 0, len(self.times)
+            if after is not None:
+                first = bisect.bisect_left(self.times, after)
+            if before is not None:
+                last = bisect.bisect_left(self.times, before)
+            low = bisect.bisect_left(shortest, first)
+            high = bisect.bisect_left(shortest, last)
+
+            # Die neuesten Treffer zuerst
+            for i in range(high - 1, low - 1, -1):
+                message_id = shortest[i]
+                if not all(
+                        self.contains(posting, message_id)
+                        for posting in others):
+                    continue
+
+                msg_sender, msg_is_dm, recipient, content = (
+                    self.messages[message_id])
+                if msg_is_dm and alias not in (msg_sender, recipient):
+                    continue
+                if is_dm is not None and msg_is_dm != is_dm:
+                    continue
+
+                if skip > 0:
+                    skip -= 1
+                    continue
+                if len(results) == KOCHA_SEARCH_PAGE_SIZE:
+                    return results, True
+
+                results.append((
+                    self.times[message_id],
+                    msg_sender,
+                    msg_is_dm,
+                    recipient,
+                    content))
+
+        return results, False
+
+    @staticmethod
+    def contains(posting, message_id):
+        """
+        Gibt an, ob eine Id in einer Postingliste vorkommt.
+
+        Args:
+            posting: Die sortierte Postingliste.
+            message_id: Die Id der Nachricht.
+
+        Returns:
+            True, wenn die Id vorkommt.
+        """
+        i = bisect.bisect_left(posting, message_id)
+        return i < len(posting) and posting[i] == message_id
+
+    @staticmethod
+    def tokenize(content):
+        """
+        Einen Text in die Woerter fuer den Index zerlegen.
+
+        Args:
+            content: Der Text.
+
+        Returns:
+            Die Liste der Woerter in Kleinbuchstaben.
+        """
+        return KOCHA_SEARCH_TOKEN_PATTERN.findall(content.lower())
@@ -2,13 +2,129 @@
 Modul mit Klassen und Methoden fuer den KOCHA-Server.
 """
 
+import argparse
+import base64
+import collections
+import datetime
+import gc
 import json
 import locale
+import logging
+import os
+import selectors
 import socket
+import ssl
 import sys
 import threading
+import time
 
-from kocha import shared
+from kocha import (
+    admin, capture, fanout, heartbeat, log, search, shared, snapshot)
+
+KOCHA_HISTORY_SIZE = 1000
+"""
+Die Anzahl der zuletzt versendeten Nachrichten, die der KOCHA-Server
+vorhaelt, damit sich neu verbundene KOCHA-Clients verpasste Nachrichten
+nachliefern lassen koennen.
+"""
+
+KOCHA_NOTICE_WINDOW = 1.0
+"""
+Die Laenge des Zeitfensters in Sekunden, in dem der KOCHA-Server
+Meldungen ueber an- und abgemeldete Nutzer zaehlt und bei zu vielen
+Meldungen zu einer Sammelmeldung zusammenfasst.
+"""
+
+KOCHA_NOTICE_THRESHOLD = 10
+"""
+Die Anzahl der Meldungen ueber an- und abgemeldete Nutzer, die
+innerhalb eines Zeitfensters einzeln verschickt werden. Alle weiteren
+werden gesammelt und am Ende des Zeitfensters zusammengefasst.
+"""
+
+KOCHA_NOTICE_MAX_ALIASES = 20
+"""
+Die maximale Anzahl an Aliasen, die in einer Sammelmeldung namentlich
+aufgefuehrt werden.
+"""
+
+KOCHA_MAILBOX_SIZE = 100
+"""
+Die maximale Anzahl an Direct-Messages, die der KOCHA-Server fuer einen
+abgemeldeten Nutzer aufbewahrt.
+"""
+
+KOCHA_MAILBOX_MAX_AGE = 7 * 24 * 60 * 60
+"""
+Die Zeit in Sekunden, die eine Direct-Message fuer einen abgemeldeten
+Nutzer hoechstens aufbewahrt wird.
+"""
+
+KOCHA_MAILBOX_MEMORY = 16 * 1024 * 1024
+"""
+Die maximale Groeße des Inhalts aller aufbewahrten Direct-Messages im
+Speicher in Zeichen. Weitere Direct-Messages werden in die Datei fuer
+ausgelagerte Direct-Messages geschrieben oder abgelehnt.
+"""
+
+KOCHA_BACKLOG = socket.SOMAXCONN
+"""
+Die Laenge der Warteschlange fuer noch nicht angenommene Verbindungen
+(siehe socket.listen). Ist sie zu kurz, verwirft der Kernel bei vielen
+gleichzeitigen Verbindungsversuchen, z.B. nach einem Neustart,
+Verbindungen, die Clients erst nach Sekunden erneut versuchen.
+"""
+
+KOCHA_HANDOFF_MAX_FDS = 250
+"""
+Die maximale Anzahl an Dateideskriptoren, die beim Neustart mit einer
+einzelnen Nachricht an den neuen KOCHA-Server uebergeben werden. Linux
+erlaubt hoechstens 253 Dateideskriptoren je Nachricht (SCM_MAX_FD).
+"""
+
+KOCHA_KEEPALIVE_IDLE = 60
+"""
+Die Zeit in Sekunden ohne Daten, nach der der Kernel auf einer
+TCP-Verbindung Keepalive-Pakete sendet. So werden auch NAT-Eintraege
+auf dem Weg frisch gehalten.
+"""
+
+KOCHA_KEEPALIVE_INTERVAL = 10
+"""
+Der Abstand in Sekunden zwischen unbeantworteten Keepalive-Paketen.
+"""
+
+KOCHA_KEEPALIVE_COUNT = 5
+"""
+Die Anzahl unbeantworteter Keepalive-Pakete, nach denen der Kernel die
+TCP-Verbindung abbricht.
+"""
+
+KOCHA_HANDOFF_TIMEOUT = 30.0
+"""
+Die Zeit in Sekunden, die ein KOCHA-Server beim Neustart auf die
+Bestaetigung des neuen KOCHA-Servers wartet, bevor er selbst
+weiterarbeitet.
+"""
+
+KOCHA_RATE_BURST = 20
+"""
+Die Anzahl an Anfragen, die ein Client bei gesetzter Ratenbegrenzung
+auf einmal stellen darf, bevor die Begrenzung greift.
+"""
+
+KOCHA_MUTED_COMMANDS = frozenset(
+    ("/h", "/help", "/m", "/members", "/presence", "/search"))
+"""
+Die Kommandos, die stummgeschaltete Nutzer weiterhin ausfuehren
+duerfen, da sie nur den Nutzer selbst erreichen.
+"""
+
+logger = logging.getLogger("kocha.server")
+"""
+Der Logger des KOCHA-Servers (siehe kocha.log). Der Name steht fest,
+weil das Modul mit python3 -m als __main__ laeuft.
+"""
 
 
 class KochaTcpConnection(shared.KochaTcpSocketWrapper):
@@ -17,6 +133,10 @@ class KochaTcpConnection(shared.KochaTcpSocketWrapper):
     KOCHA-Server.
     """
 
+    __slots__ = (
+        "address", "last_seen", "connected_at", "received", "tokens",
+        "refilled", "throttled")
+
     def __init__(self, socket, address):
         """
         Intialisiert ein Object der Klasse KochaTcpConnectionWrapper.
@@ -28,6 +148,19 @@ class KochaTcpConnection(shared.KochaTcpSocketWrapper):
         self.address = address
         super().__init__(socket)
 
+        # Der Zeitpunkt der zuletzt empfangenen Daten (siehe
+        # KochaTcpServer.on_heartbeat) und fuer kocha.admin der
+        # Zeitpunkt des Verbindens und die Anzahl empfangener Frames
+        self.last_seen = time.monotonic()
+        self.connected_at = self.last_seen
+        self.received = 0
+
+        # Der Token Bucket fuer die Ratenbegrenzung (siehe
+        # KochaTcpServer.allow). Er wird bei der ersten Anfrage gefuellt
+        self.tokens = 0.0
+        self.refilled = 0.0
+        self.throttled = False
+
 
 class KochaTcpServer(shared.KochaTcpSocketWrapper):
     """
@@ -49,69 +182,560 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         "/h or /help          -- Show this list\n"
         "/q or /quit          -- Exit the KOCHA chat\n"
         "/m or /members       -- Show a list of all registered users\n"
-        "/dm <user> <message> -- Write a direct message")
+        "/dm <user> <message> -- Write a direct message\n"
+        "/nick <alias>        -- Change your alias\n"
+        "/send <user> <path>  -- Send a file\n"
+        "/search <words>      -- Search the chat history")
     """
     Liste aller verfuegbaren Kommandos, die beim Aufruf der Hilfe
     gezeigt wird.
     """
 
-    def __init__(self, host="", port=9999):
+    KOCHA_SEARCH_USAGE = (
+        "Usage: /search <words> [from:<user>] [is:dm|is:public] "
+        "[after:<date>] [before:<date>] [page:<n>]\n"
+        "Dates are given as YYYY-MM-DD or YYYY-MM-DDTHH:MM.")
+    """
+    Die Beschreibung des Kommandos /search, die bei fehlerhaften
+    Suchanfragen gezeigt wird.
+    """
+
+    KOCHA_FULL_MESSAGE = "/full The server is full. Please try again later."
+    """
+    Die Nachricht, mit der der KOCHA-Server neue Verbindungen ablehnt,
+    wenn max_connections erreicht ist. Clients erkennen sie am
+    Kommando ``/full``.
+    """
+
+    def __init__(
+            self, host="", port=9999, reliable=False, certfile=None,
+            keyfile=None, unix_path=None, stack_size=None,
+            handoff_path=None, notice_window=KOCHA_NOTICE_WINDOW,
+            notice_threshold=KOCHA_NOTICE_THRESHOLD, history_file=None,
+            mailbox_size=KOCHA_MAILBOX_SIZE,
+            mailbox_max_age=KOCHA_MAILBOX_MAX_AGE, mailbox_file=None,
+            backlog=KOCHA_BACKLOG, max_connections=None, capture_path=None,
+            anonymize=False, fanout_shards=0,
+            heartbeat_interval=heartbeat.KOCHA_HEARTBEAT_INTERVAL,
+            heartbeat_misses=heartbeat.KOCHA_HEARTBEAT_MISSES,
+            snapshot_path=None,
+            snapshot_interval=snapshot.KOCHA_SNAPSHOT_INTERVAL,
+            rate_limit=None, rate_burst=KOCHA_RATE_BURST, admin_path=None):
         """
         Initialisiert ein Object der Klasse KochaTcpServer.
 
         Args:
             host: Der Host des KOCHA-Servers.
-            port: Der Port auf dem KOCHA-Server lauscht.
+            port: Der Port auf dem KOCHA-Server lauscht, oder None, um
+                auf keinem Port zu lauschen und nur Verbindungen im
+                selben Prozess anzunehmen (siehe connect_memory).
+            reliable: Gibt an, ob der KOCHA-Server Nachrichten, die ein
+                Client nicht bestaetigt hat, nach dem erneuten
+                Verbinden nochmals sendet und Sendern von
+                Direct-Messages die Zustellung bestaetigt.
+            certfile: Pfad zum Zertifikat (PEM) fuer TLS. Ohne
+                Zertifikat kommuniziert der KOCHA-Server unverschluesselt.
+            keyfile: Pfad zum privaten Schluessel (PEM) des Zertifikats.
+                Kann entfallen, wenn der Schluessel in certfile liegt.
+            unix_path: Pfad, unter dem der KOCHA-Server zusaetzlich auf
+                einem Unix Domain Socket lauscht. Lokale Clients und Bots
+                umgehen so den TCP-Stack. Verbindungen ueber den Unix
+                Domain Socket werden nicht mit TLS verschluesselt.
+            stack_size: Die Stackgroeße in Bytes fuer die Threads, die
+                die Clients bearbeiten (mindestens 32 KiB), oder None
+                fuer die Voreinstellung des Systems. Ein kleiner Stack
+                spart Adressraum, sodass bei vielen Verbindungen mehr
+                Threads gestartet werden koennen.
+            handoff_path: Pfad eines Unix Domain Sockets fuer den
+                Neustart ohne Verbindungsabbruch. Lauscht dort bereits
+                ein KOCHA-Server, uebernimmt der KochaTcpServer dessen
+                Sockets und Zustand. Anschließend lauscht er selbst
+                dort auf seinen Nachfolger (siehe hand_off).
+            notice_window: Die Laenge des Zeitfensters in Sekunden fuer
+                das Zusammenfassen von Meldungen ueber an- und
+                abgemeldete Nutzer. Bei 0 wird jede Meldung einzeln
+                verschickt.
+            notice_threshold: Die Anzahl der Meldungen, die je
+                Zeitfenster einzeln verschickt werden, bevor weitere
+                zusammengefasst werden.
+            history_file: Pfad der Datei, in der alle Nachrichten fuer
+                die Suche gespeichert werden, oder None, um sie nur im
+                Speicher zu halten.
+            mailbox_size: Die maximale Anzahl an Direct-Messages, die
+                fuer einen abgemeldeten Nutzer aufbewahrt werden.
+            mailbox_max_age: Die Zeit in Sekunden, die Direct-Messages
+                fuer abgemeldete Nutzer hoechstens aufbewahrt werden.
+            mailbox_file: Pfad der Datei, in die Direct-Messages fuer
+                abgemeldete Nutzer ausgelagert werden, wenn der dafuer
+                vorgesehene Speicher voll ist, oder None.
+            backlog: Die Laenge der Warteschlange fuer noch nicht
+                angenommene Verbindungen.
+            max_connections: Die maximale Anzahl gleichzeitiger
+                Clientverbindungen oder None fuer unbegrenzt viele.
+                Weitere Verbindungen werden mit KOCHA_FULL_MESSAGE
+                abgelehnt.
+            capture_path: Pfad einer Datei, in der alle eingehenden
+                Frames fuer kocha.replay aufgezeichnet werden, oder
+                None.
+            anonymize: Gibt an, ob Aliase und Inhalte in der
+                Aufzeichnung anonymisiert werden.
+            fanout_shards: Die Anzahl der Threads, auf die das
+                Verteilen oeffentlicher Nachrichten aufgeteilt wird
+                (siehe kocha.fanout), oder 0, um im Thread des Senders
+                zu verteilen.
+            heartbeat_interval: Die Zeit in Sekunden ohne eingehende
+                Daten, nach der ein Client ein ``/ping`` erhaelt, oder
+                0, um keine Heartbeats zu senden.
+            heartbeat_misses: Die Anzahl der Intervalle ohne eingehende
+                Daten, nach denen eine Verbindung geschlossen wird.
+            snapshot_path: Pfad der Datei, in der der Zustand
+                regelmaeßig gesichert und aus der er beim Start
+                wiederhergestellt wird, oder None.
+            snapshot_interval: Der Abstand in Sekunden zwischen zwei
+                Sicherungen.
+            rate_limit: Die Anzahl an Anfragen je Sekunde, die jeder
+                angemeldete Client im Mittel stellen darf, oder None
+                fuer unbegrenzt viele.
+            rate_burst: Die Anzahl an Anfragen, die ein Client auf
+                einmal stellen darf.
+            admin_path: Pfad eines Unix Domain Sockets, ueber den sich
+                der KOCHA-Server zur Laufzeit verwalten laesst (siehe
+                kocha.admin), oder None.
         """
         # Host und Port des KOCHA-Servers merken
         self.port = port
         self.host = host
+        self.reliable = reliable
+
+        # TLS-Kontext erstellen. Der Kontext stellt Clients Session
+        # Tickets aus und haelt einen Session-Cache vor, damit sich
+        # Clients beim erneuten Verbinden ohne vollstaendigen Handshake
+        # wieder anmelden koennen
+        self.ssl_context = None
+        if certfile is not None:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(certfile, keyfile)
 
-        # Set zum Speichern der Clientverbindungen initialisieren
+        # Die angemeldeten Clientverbindungen mit ihrem Alias. Das
+        # Dictionary wird nur unter clients_lock geaendert (siehe
+        # register). Nach jeder Aenderung wird recipients als
+        # unveraenderliches Tupel aus Paaren von Clientverbindung und
+        # Alias neu erstellt, ueber das z.B. on_broadcast ohne Lock
+        # iteriert, waehrend sich andere Clients an- und abmelden
         self.clients = {}
+        self.recipients = ()
+        self.clients_lock = threading.Lock()
 
-        # Liste mit allen Threads zur Bearbeitung der Clientanfragen
-        # initialisieren
-        self.handlers = []
+        # Optional die Clientverbindungen fuer das Verteilen
+        # oeffentlicher Nachrichten auf Shards aufteilen
+        self.fanout = None
+        if fanout_shards:
+            self.fanout = fanout.KochaFanout(fanout_shards)
+
+        # Die zuletzt vergebene Sequenznummer und den Verlauf der
+        # versendeten Nachrichten initialisieren. Jeder Eintrag im
+        # Verlauf ist ein Tupel aus der Nachricht, dem Alias des
+        # Empfaengers (None bei oeffentlichen Nachrichten) und dem
+        # Alias des Clients, der die Nachricht nicht erhalten hat.
+        self.last_seq = 0
+        self.history = collections.deque(maxlen=KOCHA_HISTORY_SIZE)
+        self.history_lock = threading.Lock()
+
+        # Die hoechste von einem Alias kumulativ bestaetigte
+        # Sequenznummer und die noch nicht bestaetigten
+        # Direct-Messages je Empfaenger (Tupel aus Sequenznummer und
+        # Alias des Senders)
+        self.acked = {}
+        self.pending_dms = {}
+
+        # Die Mitgliederliste fuer Clients, die sie mit /presence
+        # abonniert haben. Jede Aenderung erhoeht die Version und wird
+        # den Abonnenten als Delta geschickt. Der Snapshot und der
+        # Inhalt fuer /members werden erst bei Bedarf erstellt und bis
+        # zur naechsten Aenderung wiederverwendet
+        self.presence_version = 0
+        self.presence_snapshot = None
+        self.members_content = None
+        self.presence_subscribers = set()
+        self.presence_lock = threading.Lock()
+
+        # Die Aliase, die schon einmal angemeldet waren. Nur fuer diese
+        # werden Direct-Messages aufbewahrt, damit beliebige Empfaenger
+        # weder den Speicher noch mailbox_file fuellen. Geaendert wird
+        # die Menge nur unter clients_lock
+        self.known_aliases = set()
+
+        # Direct-Messages fuer abgemeldete Nutzer je Alias (Tupel aus
+        # dem Zeitpunkt der Aufbewahrung und der Nachricht), die Groeße
+        # ihres Inhalts und die Anzahl der in mailbox_file
+        # ausgelagerten Direct-Messages je Alias
+        self.mailbox_size = mailbox_size
+        self.mailbox_max_age = mailbox_max_age
+        self.mailbox_file = mailbox_file
+        self.mailboxes = {}
+        self.mailbox_memory = 0
+        self.spilled = collections.Counter()
+        self.mailbox_lock = threading.Lock()
+        if mailbox_file is not None and os.path.exists(mailbox_file):
+            with open(mailbox_file, encoding="utf-8") as file:
+                for line in file:
+                    self.spilled[json.loads(line)[1]] += 1
+            self.known_aliases.update(self.spilled)
+
+        # Meldungen ueber an- und abgemeldete Nutzer. Das Ende des
+        # aktuellen Zeitfensters, die Anzahl der darin einzeln
+        # verschickten Meldungen, die gesammelten Aliase und der Timer,
+        # der die Sammelmeldung am Ende des Zeitfensters verschickt
+        self.notice_window = notice_window
+        self.notice_threshold = notice_threshold
+        self.notice_window_end = 0.0
+        self.notice_count = 0
+        self.joined = []
+        self.left = []
+        self.notice_timer = None
+        self.notice_lock = threading.Lock()
+
+        # Dictionary mit den Threads zur Bearbeitung der Clientanfragen
+        # je Clientverbindung initialisieren. Beendete Threads entfernen
+        # sich selbst
+        self.handlers = {}
+
+        # Die Stackgroeße gilt fuer alle danach gestarteten Threads
+        if stack_size is not None:
+            threading.stack_size(stack_size)
 
         # Signal zum Herunterfahren des KochaTcpServers
         self.stop = False
 
-        # Einen TCP-Socket fuer den KOCHA-Server erstellen
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Alle Verbindungen mit einem gemeinsamen Timer Wheel auf
+        # Lebenszeichen pruefen. Das /ping wird nur einmal kodiert
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.heartbeats = None
+        self.ping_frame = shared.JsonUtils.to_frame(shared.KochaMessage(
+            content="/ping", sender=shared.KOCHA_SERVER_ALIAS, is_dm=True))
+        if heartbeat_interval:
+            self.heartbeats = heartbeat.KochaTimerWheel(
+                heartbeat_interval, self.on_heartbeat)
 
-        # Den erstellten Socket an die uebergene IP-Adresse und den
-        # uebergebene Port binden
-        sock.bind((self.host, self.port))
+        # Obergrenze fuer gleichzeitige Clientverbindungen
+        self.max_connections = max_connections
 
-        # Server gestatten Verbindungen anzunehmen
-        sock.listen(5)
+        # Die Ratenbegrenzung je Client und die stummgeschalteten
+        # Nutzer mit dem Ende der Stummschaltung (None fuer unbegrenzt)
+        self.rate_limit = rate_limit
+        self.rate_burst = rate_burst
+        self.muted = {}
 
-        # Socket merken
+        # Optional alle eingehenden Frames aufzeichnen
+        self.capture = None
+        if capture_path is not None:
+            self.capture = capture.KochaCapture(capture_path, anonymize)
+
+        # Bei einem Neustart die Sockets und den Zustand des noch
+        # laufenden KOCHA-Servers uebernehmen
+        state, sockets, predecessor = None, [], None
+        if handoff_path is not None:
+            state, sockets, predecessor = self.receive_handoff(
+                handoff_path)
+
+        # Der Index fuer /search ueber alle Nachrichten der Nutzer. Die
+        # Datei erst einlesen, wenn der Vorgaenger sie vollstaendig
+        # geschrieben hat
+        self.search_index = search.KochaSearchIndex(history_file)
+
+        if state is not None:
+            # Den lauschenden TCP-Socket des Vorgaengers weiter nutzen
+            sock = sockets.pop(0)
+        elif port is None:
+            # Ohne Port nur Verbindungen im selben Prozess annehmen
+            sock = None
+        else:
+            # Einen TCP-Socket fuer den KOCHA-Server erstellen
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+            # Den erstellten Socket an die uebergene IP-Adresse und den
+            # uebergebene Port binden
+            sock.bind((self.host, self.port))
+
+            # Server gestatten Verbindungen anzunehmen
+            sock.listen(backlog)
+
+        # Socket und Laenge der Warteschlange merken
         super().__init__(sock)
+        self.backlog = backlog
+
+        # Optional einen Unix Domain Socket fuer lokale Clients
+        # erstellen und einen verwaisten Socket eines frueheren
+        # KOCHA-Servers vorher entfernen
+        self.unix_path = unix_path
+        self.unix_socket = None
+        if state is not None and state["unix_path"] is not None:
+            self.unix_path = state["unix_path"]
+            self.unix_socket = sockets.pop(0)
+        elif unix_path is not None:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)
+            self.unix_socket = socket.socket(
+                socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_socket.bind(unix_path)
+            self.unix_socket.listen(backlog)
+
+        # Ohne Vorgaenger den Zustand aus der letzten Sicherung
+        # wiederherstellen. Die Verbindungen der Clients sind dabei
+        # verloren, sie melden sich neu an und erhalten verpasste
+        # Nachrichten und ihre Direct-Messages
+        self.snapshot = None
+        if snapshot_path is not None:
+            self.snapshot = snapshot.KochaSnapshot(
+                snapshot_path, snapshot_interval)
+            # Beim Lesen entstehen sehr viele langlebige Objekte, die
+            # die Garbage Collection sonst immer wieder durchsucht.
+            # Danach den vorherigen Zustand der Garbage Collection
+            # wiederherstellen, auch wenn sie schon abgeschaltet war
+            gc_enabled = gc.isenabled()
+            gc.disable()
+            try:
+                saved = self.snapshot.load() if state is None else None
+                if saved is not None:
+                    self.set_state(saved, [], snapshot.KochaSnapshot.unpack)
+            finally:
+                if gc_enabled:
+                    gc.enable()
+            if saved is not None:
+                logger.info(
+                    "Restored snapshot up to seq %d", self.last_seq,
+                    extra={"seq": self.last_seq})
+            self.snapshot.start(self.get_snapshot)
+
+        # Den Zustand des Vorgaengers wiederherstellen und ihm melden,
+        # dass er sich beenden kann
+        if state is not None:
+            self.set_state(state, sockets)
+            predecessor.sendall(b"ready")
+            predecessor.close()
+            logger.info(
+                "Took over %d connections", len(sockets),
+                extra={"connections": len(sockets)})
+
+        # Auf einen Nachfolger warten, der die Sockets spaeter
+        # uebernimmt. Der Vorgaenger entfernt den Pfad nicht, daher
+        # kann er hier neu gebunden werden
+        self.handoff_path = handoff_path
+        self.handoff_socket = None
+        if handoff_path is not None:
+            if os.path.exists(handoff_path):
+                os.unlink(handoff_path)
+            self.handoff_socket = socket.socket(
+                socket.AF_UNIX, socket.SOCK_STREAM)
+            self.handoff_socket.bind(handoff_path)
+            self.handoff_socket.listen(1)
+
+        # Erst jetzt den Verwaltungssocket oeffnen, da ein Vorgaenger
+        # ihn bis zur Uebergabe noch bedient
+        self.admin = None
+        if admin_path is not None:
+            self.admin = admin.KochaAdmin(self, admin_path)
 
     def loop(self):
         """
         Auf eingehenden Verbindungen von KOCHA-Clients warten und diese
         jweils in einem eigenen Thread bearbeiten.
         """
+        # Auf dem TCP-Socket und ggf. dem Unix Domain Socket
+        # gleichzeitig auf Verbindungen warten. Die Sockets blockieren
+        # nicht, damit pro Aufwachen alle wartenden Verbindungen
+        # angenommen werden koennen
+        selector = selectors.DefaultSelector()
+        if self.socket is not None:
+            self.socket.setblocking(False)
+            selector.register(self.socket, selectors.EVENT_READ)
+        if self.unix_socket is not None:
+            self.unix_socket.setblocking(False)
+            selector.register(self.unix_socket, selectors.EVENT_READ)
+        if self.handoff_socket is not None:
+            selector.register(self.handoff_socket, selectors.EVENT_READ)
+
         while not self.stop:
             # Auf eine eingehende Clientverbindung warten
-            client_socket, address = self.socket.accept()
+            for key, _ in selector.select(shared.KOCHA_TIMEOUT):
+                if key.fileobj is self.handoff_socket:
+                    # Ein neu gestarteter KOCHA-Server uebernimmt
+                    connection, _ = key.fileobj.accept()
+                    self.hand_off(connection)
+                    break
 
-            # Timeout fuer den Client-Socket setzen
-            client_socket.settimeout(shared.KOCHA_TIMEOUT)
+                # Zuerst alle wartenden Verbindungen annehmen, damit
+                # die Warteschlange des Kernels bei einem Ansturm nicht
+                # ueberlaeuft, und erst dann die Threads starten
+                pending = []
+                while True:
+                    try:
+                        pending.append(key.fileobj.accept())
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        # Z.B. keine Dateideskriptoren mehr frei
+                        logger.error("Accept failed: %s", e)
+                        break
 
-            # Die Verbinungsdaten des Clients kapseln
-            client = KochaTcpConnection(client_socket, address)
+                for client_socket, address in pending:
+                    self.accept(client_socket, address)
+
+        selector.close()
+
+    def accept(self, client_socket, address):
+        """
+        Eine neue Clientverbindung einrichten und in einem eigenen
+        Thread bearbeiten.
+
+        Args:
+            client_socket: Das socket-Object der Clientverbindung.
+            address: Die Adressinformationen des Clients.
+
+        Returns:
+            Die KochaTcpConnection oder None, wenn die Verbindung
+            abgelehnt wurde.
+        """
+        # Timeout fuer den Client-Socket setzen
+        client_socket.settimeout(shared.KOCHA_TIMEOUT)
+
+        # Ist die Obergrenze erreicht, die Verbindung hoeflich ablehnen
+        if (self.max_connections is not None
+                and len(self.handlers) >= self.max_connections):
+            self.reject(client_socket)
+            return None
+
+        if isinstance(client_socket, shared.KochaMemorySocket):
+            # Verbindungen im selben Prozess haben weder TCP-Optionen
+            # noch TLS
+            pass
+        elif client_socket.family == socket.AF_UNIX:
+            # Unix Domain Sockets haben keine Adresse des Clients
+            address = self.unix_path
+        else:
+            # Kleine Nachrichten sofort senden. Ohne diese Option haelt
+            # der Nagle-Algorithmus z.B. die Willkommensnachricht nach
+            # dem Session Ticket von TLS bis zum verzoegerten ACK des
+            # Clients zurueck
+            client_socket.setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            # Tote Verbindungen auch ohne Heartbeats vom Kernel erkennen
+            # lassen. Die Feineinstellung gibt es nicht auf jedem System
+            client_socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, "TCP_KEEPIDLE"):
+                client_socket.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                    KOCHA_KEEPALIVE_IDLE)
+                client_socket.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                    KOCHA_KEEPALIVE_INTERVAL)
+                client_socket.setsockopt(
+                    socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                    KOCHA_KEEPALIVE_COUNT)
+
+            # Den Socket fuer TLS kapseln. Der Handshake findet erst im
+            # Thread des Clients statt, damit er das Annehmen weiterer
+            # Verbindungen nicht blockiert
+            if self.ssl_context is not None:
+                client_socket = self.ssl_context.wrap_socket(
+                    client_socket,
+                    server_side=True,
+                    do_handshake_on_connect=False)
+
+        # Die Verbinungsdaten des Clients kapseln
+        client = KochaTcpConnection(client_socket, address)
+
+        logger.info(
+            "Connection from %s", client.address,
+            extra={"address": client.address})
+
+        if self.capture is not None:
+            self.capture.record(client, capture.KochaCapture.OPEN)
+
+        self.start_handler(client)
+        return client
+
+    def reject(self, client_socket):
+        """
+        Eine Verbindung mit KOCHA_FULL_MESSAGE ablehnen und schließen.
+
+        Args:
+            client_socket: Das socket-Object der Clientverbindung.
+        """
+        # Bei TLS ist vor dem Handshake keine Antwort moeglich
+        try:
+            if (self.ssl_context is None
+                    or client_socket.family != socket.AF_INET):
+                client_socket.sendall(shared.JsonUtils.to_frame(
+                    shared.KochaMessage(
+                        content=self.KOCHA_FULL_MESSAGE,
+                        sender=shared.KOCHA_SERVER_ALIAS,
+                        is_dm=True)))
 
-            print("Connection from", client.address)
+            # Nur die Senderichtung schließen und bereits empfangene
+            # Daten verwerfen, damit der Kernel die Antwort nicht durch
+            # ein RST ersetzt
+            client_socket.shutdown(socket.SHUT_WR)
+            client_socket.setblocking(False)
+            client_socket.recv(shared.KOCHA_BUFSIZE)
+        except OSError:
+            pass
+        client_socket.close()
 
-            # Die Anfragen des Clients in einem eigen Thread bearbeiten
-            handler = threading.Thread(
-                target=self.handle, args=(client,), daemon=True)
-            self.handlers.append(handler)
+    def connect_memory(self, address="memory", threaded=True):
+        """
+        Einen virtuellen KOCHA-Client ohne Netzwerk im selben Prozess
+        verbinden. Die Anfragen durchlaufen dieselbe Logik wie die
+        Anfragen ueber TCP, sodass sich z.B. Dekodieren, Bearbeiten und
+        Verteilen der Nachrichten ohne Einfluss des Kernels messen
+        lassen.
+
+        Args:
+            address: Die Adressinformationen des virtuellen Clients.
+            threaded: Gibt an, ob die Verbindung wie ueber TCP in einem
+                eigenen Thread bearbeitet wird. Sonst blockiert die
+                Verbindung nicht und ihre Anfragen werden erst durch
+                Aufrufe von pump bearbeitet.
+
+        Returns:
+            Tupel aus dem KochaMemorySocket des Clients und der
+            KochaTcpConnection auf Seite des KOCHA-Servers (None, wenn
+            die Verbindung abgelehnt wurde).
+        """
+        client_socket, server_socket = shared.KochaMemorySocket.pair()
+        if threaded:
+            return client_socket, self.accept(server_socket, address)
+
+        server_socket.setblocking(False)
+        client = KochaTcpConnection(server_socket, address)
+        if self.capture is not None:
+            self.capture.record(client, capture.KochaCapture.OPEN)
+        return client_socket, client
+
+    def start_handler(self, client):
+        """
+        Die Anfragen eines KOCHA-Clients in einem eigenen Thread
+        bearbeiten.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+        """
+        handler = threading.Thread(
+            target=self.handle, args=(client,), daemon=True)
+        self.handlers[client] = handler
+        try:
             handler.start()
+        except RuntimeError as e:
+            # Kein Thread mehr moeglich (Speicher oder Limit des
+            # Systems erschoepft), daher nur diese Verbindung abweisen
+            logger.error(
+                "Cannot start handler thread: %s", e,
+                extra={"address": client.address})
+            del self.handlers[client]
+            client.close()
 
     def handle(self, client):
         """Methode zur Bearbeitung der Anfragen eines KOCHA-Clients.
@@ -119,12 +743,65 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         Args:
             client: Die Daten der Clientverbindung.
         """
+        if self.heartbeats is not None:
+            self.heartbeats.add(client)
+        try:
+            self.serve(client)
+        finally:
+            # Den Thread aus der Verwaltung entfernen
+            self.handlers.pop(client, None)
+            if self.heartbeats is not None:
+                self.heartbeats.remove(client)
+
+            # Nur geschlossene Verbindungen, nicht die bei einem
+            # Neustart uebergebenen
+            if self.capture is not None and client.socket.fileno() == -1:
+                self.capture.record(client, capture.KochaCapture.CLOSE)
+
+    def receive_request(self, client):
+        """
+        Eine Anfrage eines KOCHA-Clients empfangen und ggf.
+        aufzeichnen.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+
+        Returns:
+            Das KochaMessage-Object der Anfrage.
+        """
+        data = client.reader.read_frame()
+        client.last_seen = time.monotonic()
+        client.received += 1
+        if self.capture is not None:
+            self.capture.record(client, capture.KochaCapture.FRAME, data)
+        return shared.JsonUtils.to_kocha_message(data)
+
+    def serve(self, client):
+        """
+        Die Anfragen eines KOCHA-Clients bis zu dessen Abmeldung oder
+        dem Herunterfahren des KochaTcpServers bearbeiten.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+        """
+        # Bei TLS zuerst den Handshake durchfuehren
+        if isinstance(client.socket, ssl.SSLSocket):
+            try:
+                client.socket.do_handshake()
+            except (OSError, ValueError):
+                client.close()
+                return
+
         while not self.stop:
             # Auf eine Anfrage des Clients warten
             request = None
             try:
-                request = client.receive()
+                request = self.receive_request(client)
             except socket.timeout:
+                # Von anderen Threads nur vorgemerkte Frames wie das
+                # /ping senden
+                if client.writer.queued:
+                    client.writer.flush()
                 continue
             except:
                 # Den Client abmelden, da der Socket
@@ -133,66 +810,420 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
                 self.on_quit(client)
                 break
 
-            # Wenn der Client unbekannt ist, Anmeldung am Server
-            # versuchen
-            if client not in self.clients:
-                self.try_login(client, request.content)
+            # Die Anfrage und alle bereits vollstaendig empfangenen
+            # weiteren Anfragen bearbeiten und die dabei entstehenden
+            # Nachrichten je Empfaenger gesammelt mit einem
+            # Systemaufruf senden
+            with shared.KochaFrameWriter.cork():
+                if not self.process(client, request):
+                    break
+                while client.has_pending() and not self.stop:
+                    try:
+                        request = self.receive_request(client)
+                    except ValueError:
+                        self.on_quit(client)
+                        return
+                    if not self.process(client, request):
+                        return
 
-                # Auf naechste Anfrage des Clients warten
-                continue
+    def pump(self, client):
+        """
+        Alle bereits empfangenen Anfragen einer nicht blockierenden
+        Verbindung (siehe connect_memory) bearbeiten, ohne auf weitere
+        zu warten. So kann ein einzelner Thread viele virtuelle Clients
+        bedienen.
 
-            # Die Anfrage des Clients interpretieren und bearbeiten
-            if (request.content == "/h" or request.content == "/help"):
-                # Dem KOCHA-Client die Kommandouebersicht schicken
-                self.on_help(client)
-            elif (request.content == "/q" or request.content == "/quit"):
-                # TODO: Den Client vom Server abmelden
-                self.on_quit(client)
-                break
-            elif (request.content == "/m" or request.content == "/members"):
-                # TODO: Dem Client eine Liste mit allen angemeldeten
-                # Clients geben
-                self.on_members(client)
-            elif (request.content.startswith("/dm ")):
-                # Einem anderen Client eine direkte Nachricht
-                # weiterleiten
-                self.on_dm(client, request)
-            else:
-                # Die Nachricht im Chat veroeffentlichen
-                self.on_broadcast(client, request)
+        Args:
+            client: Die Daten der Clientverbindung.
+
+        Returns:
+            False, wenn der Client sich abgemeldet hat oder die
+            Verbindung geschlossen wurde, sonst True.
+        """
+        with shared.KochaFrameWriter.cork():
+            while True:
+                try:
+                    request = self.receive_request(client)
+                except BlockingIOError:
+                    return True
+                except (ConnectionError, ValueError):
+                    self.on_quit(client)
+                    break
+
+                if not self.process(client, request):
+                    break
+
+        if self.capture is not None:
+            self.capture.record(client, capture.KochaCapture.CLOSE)
+        return False
+
+    def process(self, client, request):
+        """
+        Eine Anfrage bearbeiten (siehe dispatch). Ein unerwarteter
+        Fehler meldet nur diesen Client ab, statt seinen Thread ohne
+        Abmeldung zu beenden.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            request: Das KochaMessage-Object der Anfrage.
+
+        Returns:
+            False, wenn der Client abgemeldet ist, sonst True.
+        """
+        try:
+            return self.dispatch(client, request)
+        except Exception:
+            logger.exception(
+                "Failed to handle request of %r", client.address,
+                extra={"address": client.address,
+                       "alias": self.clients.get(client)})
+            self.on_quit(client)
+            return False
+
+    def dispatch(self, client, request):
+        """
+        Eine Anfrage eines KOCHA-Clients interpretieren und bearbeiten.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            request: Das KochaMessage-Object der Anfrage.
+
+        Returns:
+            False, wenn der Client sich abgemeldet hat, sonst True.
+        """
+        # Wenn der Client unbekannt ist, Anmeldung am Server
+        # versuchen
+        if client not in self.clients:
+            self.try_login(client, request.content)
+
+            # Auf naechste Anfrage des Clients warten
+            return True
+
+        # Den Absender immer auf den angemeldeten Alias setzen, damit
+        # sich Clients nicht als jemand anderes ausgeben koennen
+        request.sender = self.clients[client]
+
+        # Empfangsbestaetigungen werden entweder an eine Nachricht
+        # angehaengt oder gesammelt mit /ack geschickt
+        if request.ack is not None:
+            self.on_ack(client, request.ack)
+            request.ack = None
+        if request.content in ("/ack", "/pong"):
+            return True
+
+        # Zu schnelle und stummgeschaltete Clients abweisen
+        if not self.allow(client, request):
+            return True
+
+        # Die Anfrage des Clients interpretieren und bearbeiten
+        if (request.content == "/h" or request.content == "/help"):
+            # Dem KOCHA-Client die Kommandouebersicht schicken
+            self.on_help(client)
+        elif (request.content == "/q" or request.content == "/quit"):
+            # TODO: Den Client vom Server abmelden
+            self.on_quit(client)
+            return False
+        elif (request.content == "/m" or request.content == "/members"):
+            # TODO: Dem Client eine Liste mit allen angemeldeten
+            # Clients geben
+            self.on_members(client)
+        elif (request.content.startswith("/dm ")):
+            # Einem anderen Client eine direkte Nachricht
+            # weiterleiten
+            self.on_dm(client, request)
+        elif (request.content == "/presence"):
+            # Dem Client die Mitgliederliste schicken und ihn ueber
+            # Aenderungen informieren
+            self.on_presence(client)
+        elif (request.content.startswith("/nick ")):
+            # Den Alias des Clients aendern
+            self.on_nick(client, request)
+        elif (request.content == "/search"
+                or request.content.startswith("/search ")):
+            # Den Verlauf durchsuchen
+            self.on_search(client, request)
+        elif (request.content.startswith(
+                ("/send ", "/accept ", "/chunk ", "/cancel "))):
+            # Ein Kommando der Dateiuebertragung weiterleiten
+            self.on_transfer(client, request)
+        else:
+            # Die Nachricht im Chat veroeffentlichen
+            self.on_broadcast(client, request)
+
+        return True
 
     def try_login(self, client, content):
         """
         Einen KOCHA-Client am KOCHA-Server anmelden.
 
+        Das Kommando lautet ``/login <alias> [<seq>]``. Wird die
+        Sequenznummer der zuletzt empfangenen Nachricht mitgeschickt,
+        erhaelt der Client nach der Willkommensnachricht alle seitdem
+        verpassten Nachrichten als einen Batch.
+
         Args:
             client: Die Daten der Clientverbindung.
             content: Der Inhalt der Nachricht.
         """
-        command, alias, *_ = content.split()
+        # Fehlende Teile als leer bzw. None behandeln
+        parts = content.split()
+        command = parts[0] if parts else ""
+        alias = parts[1] if len(parts) > 1 else ""
+        last_seq = None
+        if len(parts) > 2 and parts[2].isdecimal():
+            last_seq = int(parts[2])
+
+        def greet():
+            # Die Willkommensnachricht und verpasste Nachrichten als
+            # einen Batch einreihen. Das geschieht unter history_lock
+            # und clients_lock, bevor der Client in recipients steht.
+            # So fehlt keine Nachricht zwischen Batch und den ersten
+            # live zugestellten, und beide kommen nach der
+            # Willkommensnachricht an. Der Aufrufer (serve oder pump)
+            # sammelt die Frames mit cork(), daher wird hier nur
+            # eingereiht und nicht unter den Locks gesendet
+            client.send(shared.KochaMessage(
+                content=self.KOCHA_WELCOME_MESSAGE.format(alias),
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True,
+                seq=self.last_seq), shared.KOCHA_LANE_CONTROL)
+            if last_seq is not None:
+                self.on_catch_up(
+                    client, alias, last_seq, list(self.history))
+
         content = ""
         if command == "/login":
-            if (not set(": ").issubset(alias)
-                    and alias not in self.clients.values()
-                    and alias != shared.KOCHA_SERVER_ALIAS):
-                self.clients[client] = alias
-                content = self.KOCHA_WELCOME_MESSAGE.format(alias)
-
-        # Neuem Nutzer eine Nachricht senden (Willkommensnachricht bei
-        # erfolgreicher Anmeldung, sonst einen leeren String)
-        response = shared.KochaMessage(
-            content=content,
-            sender=shared.KOCHA_SERVER_ALIAS,
-            is_dm=True)
-        client.send(response)
+            with self.history_lock:
+                # Im zuverlaessigen Modus ab der letzten Bestaetigung
+                # nachliefern, damit auch Nachrichten, die zwar
+                # gesendet aber nie angekommen sind, erneut
+                # uebertragen werden
+                if (self.reliable and last_seq is not None
+                        and alias in self.acked):
+                    last_seq = min(last_seq, self.acked[alias])
+                if self.register(client, alias, greet):
+                    content = self.KOCHA_WELCOME_MESSAGE.format(alias)
+
+        # Bei gescheiterter Anmeldung einen leeren String senden. Die
+        # Sequenznummer der Willkommensnachricht ist die aktuell
+        # letzte vergebene Sequenznummer, ab der der Client weiterzaehlt
+        if content == "":
+            client.send(shared.KochaMessage(
+                content=content,
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True,
+                seq=self.last_seq), shared.KOCHA_LANE_CONTROL)
+            return
+
+        self.update_presence("+", alias)
+
+        # Aufbewahrte Direct-Messages als einen Batch zustellen
+        self.deliver_mailbox(client, alias)
 
         # Die anderen Clients darueber informieren, dass ein neuer
         # Nutzer sich erfolgreich am Chat angemeldet hat
-        if content != "":
-            message = shared.KochaMessage(
-                content="{} joined the chat.".format(alias),
-                sender=shared.KOCHA_SERVER_ALIAS)
-            self.on_broadcast(client, message)
+        self.announce(client, alias, joined=True)
+
+    def allow(self, client, request):
+        """
+        Gibt an, ob die Anfrage eines angemeldeten Clients bearbeitet
+        wird. Mit rate_limit darf jeder Client im Mittel rate_limit und
+        auf einmal rate_burst Anfragen stellen (Token Bucket). Weitere
+        werden verworfen und der Client einmal darauf hingewiesen.
+        Stummgeschaltete Nutzer duerfen nur KOCHA_MUTED_COMMANDS
+        ausfuehren. Abmelden ist immer moeglich, und Chunks laufender
+        Dateiuebertragungen zaehlen nicht zur Rate.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            request: Das KochaMessage-Object der Anfrage.
+
+        Returns:
+            True, wenn die Anfrage bearbeitet wird, sonst False.
+        """
+        if request.content in ("/q", "/quit"):
+            return True
+        command = request.content.split(" ", 1)[0]
+
+        # Die Grenzen koennen sich ueber kocha.admin jederzeit aendern
+        rate_limit = self.rate_limit
+        if rate_limit is not None and command != "/chunk":
+            now = time.monotonic()
+            client.tokens = min(
+                self.rate_burst,
+                client.tokens + (now - client.refilled) * rate_limit)
+            client.refilled = now
+            if client.tokens < 1:
+                if not client.throttled:
+                    client.throttled = True
+                    client.send(shared.KochaMessage(
+                        content="You are sending too fast. Your messages "
+                                "are dropped for now.",
+                        sender=shared.KOCHA_SERVER_ALIAS,
+                        is_dm=True))
+                return False
+            client.tokens -= 1
+            client.throttled = False
+
+        if (self.muted and self.is_muted(request.sender)
+                and command not in KOCHA_MUTED_COMMANDS):
+            # Nicht auf jeden Chunk einer Dateiuebertragung antworten
+            if command != "/chunk":
+                client.send(shared.KochaMessage(
+                    content="You are muted.",
+                    sender=shared.KOCHA_SERVER_ALIAS,
+                    is_dm=True))
+            return False
+
+        return True
+
+    def is_muted(self, alias):
+        """
+        Gibt an, ob ein Nutzer stummgeschaltet ist. Abgelaufene
+        Stummschaltungen werden dabei entfernt.
+
+        Args:
+            alias: Der Alias des Nutzers.
+
+        Returns:
+            True, wenn der Nutzer stummgeschaltet ist.
+        """
+        if alias not in self.muted:
+            return False
+        until = self.muted.get(alias)
+        if until is not None and time.monotonic() >= until:
+            self.muted.pop(alias, None)
+            return False
+        return True
+
+    def mute(self, alias, seconds=None):
+        """
+        Einen Nutzer stummschalten, auch wenn er gerade nicht
+        angemeldet ist.
+
+        Args:
+            alias: Der Alias des Nutzers.
+            seconds: Die Dauer in Sekunden oder None fuer unbegrenzt.
+        """
+        self.muted[alias] = (
+            None if seconds is None else time.monotonic() + seconds)
+
+    def unmute(self, alias):
+        """
+        Die Stummschaltung eines Nutzers aufheben.
+
+        Args:
+            alias: Der Alias des Nutzers.
+
+        Returns:
+            True, wenn der Nutzer stummgeschaltet war.
+        """
+        return self.muted.pop(alias, False) is not False
+
+    def kick(self, alias):
+        """
+        Einen Nutzer vom KOCHA-Server trennen. Wie bei on_heartbeat
+        wird die Verbindung nur heruntergefahren, der Thread des Clients
+        meldet ihn dann ab.
+
+        Args:
+            alias: Der Alias des Nutzers.
+
+        Returns:
+            True, wenn der Nutzer angemeldet war.
+        """
+        for client, name in self.recipients:
+            if name == alias:
+                client.send(shared.KochaMessage(
+                    content="You were disconnected by an administrator.",
+                    sender=shared.KOCHA_SERVER_ALIAS,
+                    is_dm=True), shared.KOCHA_LANE_CONTROL)
+                try:
+                    client.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return True
+        return False
+
+    def set_backlog(self, backlog):
+        """
+        Die Laenge der Warteschlange fuer noch nicht angenommene
+        Verbindungen aendern. Ein erneutes listen wirkt auf lauschende
+        Sockets sofort.
+
+        Args:
+            backlog: Die neue Laenge.
+        """
+        for sock in (self.socket, self.unix_socket):
+            if sock is not None:
+                sock.listen(backlog)
+        self.backlog = backlog
+
+    def register(self, client, alias, on_register=None):
+        """
+        Einen Client mit einem Alias anmelden oder einem angemeldeten
+        Client einen neuen Alias geben, sofern der Alias verfuegbar
+        ist. Pruefen und Eintragen geschehen unter clients_lock, daher
+        kann derselbe Alias nie zweimal vergeben werden.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            alias: Der Alias.
+            on_register: Funktion ohne Parameter, die unter
+                clients_lock aufgerufen wird, wenn der Alias verfuegbar
+                ist, aber bevor der Client Nachrichten anderer erhaelt,
+                oder None.
+
+        Returns:
+            True, wenn der Client nun den Alias hat, sonst False.
+        """
+        with self.clients_lock:
+            if not self.is_alias_available(alias):
+                return False
+            if on_register is not None:
+                on_register()
+            self.clients[client] = alias
+            self.known_aliases.add(alias)
+            self.recipients = tuple(self.clients.items())
+            if self.fanout is not None:
+                self.fanout.add(client)
+        return True
+
+    def unregister(self, client):
+        """
+        Einen Client abmelden.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+
+        Returns:
+            Der Alias des Clients oder None, wenn er nicht angemeldet
+            war.
+        """
+        with self.clients_lock:
+            alias = self.clients.pop(client, None)
+            if alias is not None:
+                self.recipients = tuple(self.clients.items())
+                if self.fanout is not None:
+                    self.fanout.remove(client)
+        return alias
+
+    def is_alias_available(self, alias):
+        """
+        Gibt an, ob ein Alias gueltig ist und von keinem anderen Client
+        verwendet wird. Der Aufrufer haelt clients_lock.
+
+        Args:
+            alias: Der Alias.
+
+        Returns:
+            True, wenn der Alias verwendet werden darf.
+        """
+        return bool(
+            alias
+            and not set(": ").issubset(alias)
+            and alias not in self.clients.values()
+            and alias != shared.KOCHA_SERVER_ALIAS)
 
     def close(self):
         """
@@ -200,17 +1231,370 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         """
         # Alle handler-Threads beenden
         self.stop = True
-        for handler in self.handlers:
+        for handler in list(self.handlers.values()):
             handler.join()
 
+        # Keine Sammelmeldung mehr verschicken, keine Heartbeats und
+        # keine Verwaltung
+        if self.notice_timer is not None:
+            self.notice_timer.cancel()
+        if self.heartbeats is not None:
+            self.heartbeats.stop()
+        if self.admin is not None:
+            self.admin.stop()
+
+        # Den Zustand ein letztes Mal sichern, damit der naechste Start
+        # nahtlos anschließt
+        if self.snapshot is not None:
+            self.snapshot.stop()
+            self.snapshot.save(self.get_snapshot())
+
+        # Noch eingereihte oeffentliche Nachrichten senden
+        if self.fanout is not None:
+            self.fanout.close()
+
+        # Den Index aktualisieren und die Datei der Suche schließen
+        self.search_index.close()
+
+        # Die Aufzeichnung beenden
+        if self.capture is not None:
+            self.capture.close()
+
         # Alle Clientverbindungen schließen
-        for client in self.clients:
+        for client, _ in self.recipients:
             client.close()
 
         # Den TCP-Socket des KOCHA-Servers herunterfahren und
         # anschließend die Verbindung zum Socket schließen
-        self.socket.shutdown(socket.SHUT_RDWR)
-        super().close()
+        if self.socket is not None:
+            self.socket.shutdown(socket.SHUT_RDWR)
+            super().close()
+
+        # Den Unix Domain Socket schließen und aus dem Dateisystem
+        # entfernen
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            os.unlink(self.unix_path)
+
+        # Den Socket fuer den Neustart schließen und entfernen
+        if self.handoff_socket is not None:
+            self.handoff_socket.close()
+            os.unlink(self.handoff_path)
+
+    def get_state(self, clients, encode=shared.JsonUtils.to_json):
+        """
+        Den Zustand des KochaTcpServers als JSON-kompatibles Dictionary
+        liefern.
+
+        Args:
+            clients: Die Clientverbindungen, deren Zustand uebernommen
+                werden soll.
+            encode: Die Funktion, mit der jede Nachricht kodiert wird
+                (z.B. snapshot.KochaSnapshot.pack).
+
+        Returns:
+            Das Dictionary mit dem Zustand.
+        """
+        # Unter den Locks nur die Eintraege kopieren, damit das Kodieren
+        # die Zustellung nicht aufhaelt. Gespeicherte Nachrichten werden
+        # nicht mehr veraendert
+        with self.history_lock:
+            history = list(self.history)
+            acked = dict(self.acked)
+            pending_dms = {
+                alias: list(pending)
+                for alias, pending in self.pending_dms.items()}
+        with self.mailbox_lock:
+            mailboxes = {
+                alias: list(mailbox)
+                for alias, mailbox in self.mailboxes.items()}
+        with self.clients_lock:
+            known_aliases = sorted(self.known_aliases)
+
+        # Die Nachrichten einzeln kodieren, da der KochaMessageDecoder
+        # jedes JSON-Object in eine KochaMessage umwandelt
+        history = [
+            [encode(message), recipient, excluded]
+            for message, recipient, excluded in history]
+        mailboxes = {
+            alias: [
+                [stored_at, encode(message)]
+                for stored_at, message in mailbox]
+            for alias, mailbox in mailboxes.items()}
+
+        return {
+            "version": shared.KOCHA_VERSION,
+            "unix_path": (
+                self.unix_path if self.unix_socket is not None else None),
+            "last_seq": self.last_seq,
+            "history": history,
+            "acked": acked,
+            "pending_dms": pending_dms,
+            "presence_version": self.presence_version,
+            "mailboxes": mailboxes,
+            "known_aliases": known_aliases,
+            "clients": [
+                {
+                    "alias": self.clients.get(client),
+                    "address": client.address,
+                    "presence": client in self.presence_subscribers,
+                    "unread": base64.b64encode(
+                        client.reader.unread()).decode("ascii"),
+                }
+                for client in clients],
+        }
+
+    def get_snapshot(self):
+        """
+        Den Zustand ohne Clientverbindungen fuer eine Sicherung liefern
+        (siehe snapshot.KochaSnapshot).
+
+        Returns:
+            Das Dictionary mit dem Zustand.
+        """
+        return self.get_state([], snapshot.KochaSnapshot.pack)
+
+    def set_state(
+            self, state, sockets, decode=shared.JsonUtils.to_kocha_message):
+        """
+        Den mit get_state ermittelten Zustand eines anderen
+        KochaTcpServers uebernehmen und die Clientverbindungen
+        bearbeiten.
+
+        Args:
+            state: Das Dictionary mit dem Zustand.
+            sockets: Die Sockets der Clientverbindungen in der
+                Reihenfolge von state["clients"].
+            decode: Die Funktion, mit der jede Nachricht dekodiert wird
+                (Gegenstueck zu encode von get_state).
+        """
+        with self.history_lock:
+            self.last_seq = state["last_seq"]
+            self.history.extend(
+                (decode(message), recipient, excluded)
+                for message, recipient, excluded in state["history"])
+            self.acked = state["acked"]
+            self.pending_dms = {
+                alias: collections.deque(
+                    map(tuple, pending), maxlen=KOCHA_HISTORY_SIZE)
+                for alias, pending in state["pending_dms"].items()}
+        self.presence_version = state["presence_version"]
+
+        with self.mailbox_lock:
+            for alias, mailbox in state["mailboxes"].items():
+                self.mailboxes[alias] = collections.deque(
+                    (stored_at, decode(message))
+                    for stored_at, message in mailbox)
+                self.mailbox_memory += sum(
+                    len(message.content)
+                    for _, message in self.mailboxes[alias])
+
+        # Zustaende aelterer Versionen enthalten keine bekannten Aliase.
+        # Dann gelten zumindest die mit aufbewahrten Direct-Messages
+        with self.clients_lock:
+            self.known_aliases.update(
+                state.get("known_aliases", state["mailboxes"]))
+
+        for info, client_socket in zip(state["clients"], sockets):
+            client_socket.settimeout(shared.KOCHA_TIMEOUT)
+
+            # JSON kennt keine Tupel
+            address = info["address"]
+            if isinstance(address, list):
+                address = tuple(address)
+
+            # Bereits empfangene, aber noch nicht bearbeitete Daten
+            # wieder in den Empfangspuffer legen
+            client = KochaTcpConnection(client_socket, address)
+            client.reader.feed(base64.b64decode(info["unread"]))
+            if info["alias"] is not None:
+                self.register(client, info["alias"])
+            if info["presence"]:
+                self.presence_subscribers.add(client)
+
+            self.start_handler(client)
+
+    def hand_off(self, connection):
+        """
+        Die lauschenden Sockets, alle Clientverbindungen und den
+        Zustand an einen neu gestarteten KOCHA-Server uebergeben. Die
+        Dateideskriptoren werden per SCM_RIGHTS ueber den Unix Domain
+        Socket uebertragen, sodass kein Client die Verbindung verliert.
+
+        TLS-Verbindungen koennen nicht uebergeben werden, da der
+        Zustand der Verschluesselung in diesem Prozess liegt. Diese
+        Clients verbinden sich mit dem neuen KOCHA-Server neu.
+
+        Bestaetigt der neue KOCHA-Server die Uebernahme nicht, arbeitet
+        der KochaTcpServer weiter.
+
+        Args:
+            connection: Der Socket der Verbindung zum neuen
+                KOCHA-Server.
+
+        Returns:
+            True, wenn der neue KOCHA-Server uebernommen hat, sonst
+            False.
+        """
+        # Alle handler-Threads anhalten, ohne die Clientverbindungen zu
+        # schließen
+        connections = list(self.handlers)
+        self.stop = True
+        for handler in list(self.handlers.values()):
+            handler.join()
+        connections = [
+            client for client in connections
+            if client.socket.fileno() != -1]
+
+        # Noch offene Clientverbindungen ohne TLS uebergeben und noch
+        # nicht gesendete Nachrichten vorher senden
+        clients = [
+            client for client in connections
+            if not isinstance(client.socket, ssl.SSLSocket)]
+        if self.notice_timer is not None:
+            self.notice_timer.cancel()
+        self.flush_notices()
+        if self.fanout is not None:
+            self.fanout.flush()
+        for client in clients:
+            client.writer.flush()
+
+        # Alle Nachrichten in die Datei der Suche schreiben, damit der
+        # neue KOCHA-Server sie einlesen kann
+        self.search_index.flush()
+
+        sockets = [self.socket]
+        if self.unix_socket is not None:
+            sockets.append(self.unix_socket)
+        sockets.extend(client.socket for client in clients)
+        fds = [sock.fileno() for sock in sockets]
+
+        try:
+            # Zuerst den Zustand mit vorangestellter Laenge senden, dann
+            # die Dateideskriptoren in Bloecken mit je einem Byte
+            data = json.dumps(self.get_state(clients)).encode()
+            connection.settimeout(KOCHA_HANDOFF_TIMEOUT)
+            connection.sendall(len(data).to_bytes(8, "big") + data)
+            for i in range(0, len(fds), KOCHA_HANDOFF_MAX_FDS):
+                socket.send_fds(
+                    connection, [b"F"], fds[i:i + KOCHA_HANDOFF_MAX_FDS])
+
+            # Warten, bis der neue KOCHA-Server alles uebernommen hat
+            ready = connection.recv(5, socket.MSG_WAITALL) == b"ready"
+        except OSError as e:
+            logger.error("Hand-off failed: %s", e)
+            ready = False
+        finally:
+            connection.close()
+
+        if not ready:
+            # Die Clients selbst weiter bedienen
+            logger.warning("Hand-off failed, resuming")
+            self.stop = False
+            for client in connections:
+                self.start_handler(client)
+            return False
+
+        logger.info(
+            "Handed off %d connections", len(clients),
+            extra={"connections": len(clients)})
+
+        # Die Aufzeichnung endet mit diesem Prozess. Die Sicherung
+        # schreibt ab jetzt der neue KOCHA-Server
+        if self.capture is not None:
+            self.capture.close()
+        if self.snapshot is not None:
+            self.snapshot.stop()
+        if self.admin is not None:
+            self.admin.stop()
+
+        # Nur den eigenen Socket fuer den Neustart schließen. Der Pfad
+        # gehoert jetzt dem neuen KOCHA-Server
+        self.handoff_socket.close()
+        return True
+
+    @staticmethod
+    def receive_handoff(path):
+        """
+        Die Sockets und den Zustand eines laufenden KOCHA-Servers
+        uebernehmen (siehe hand_off).
+
+        Args:
+            path: Der Pfad des Unix Domain Sockets, auf dem der
+                laufende KOCHA-Server auf seinen Nachfolger wartet.
+
+        Returns:
+            Ein Tupel aus dem Zustand (siehe get_state), den Sockets
+            (lauschender TCP-Socket, ggf. Unix Domain Socket, dann die
+            Clientverbindungen) und dem Socket der Verbindung zum
+            Vorgaenger, dem die Uebernahme bestaetigt werden muss.
+            Laeuft kein KOCHA-Server, ist der Zustand None.
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Kein laufender KOCHA-Server, normal starten
+            connection.close()
+            return None, [], None
+
+        # Der Vorgaenger wartet zuerst auf das Ende seiner
+        # handler-Threads
+        connection.settimeout(KOCHA_HANDOFF_TIMEOUT)
+        header = connection.recv(8, socket.MSG_WAITALL)
+        size = int.from_bytes(header, "big")
+        data = connection.recv(size, socket.MSG_WAITALL)
+        if len(header) < 8 or len(data) < size:
+            raise ConnectionError("Hand-off interrupted")
+        state = json.loads(data)
+
+        # Die Dateideskriptoren blockweise empfangen
+        count = (
+            1 + (state["unix_path"] is not None) + len(state["clients"]))
+        fds = []
+        while len(fds) < count:
+            _, received, _, _ = socket.recv_fds(
+                connection, 1, KOCHA_HANDOFF_MAX_FDS)
+            if not received:
+                raise ConnectionError("Hand-off interrupted")
+            fds.extend(received)
+
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        return state, sockets, connection
+
+    def on_heartbeat(self, client):
+        """
+        Eine Verbindung auf Lebenszeichen pruefen (siehe
+        heartbeat.KochaTimerWheel). Hat der Client ein Intervall lang
+        nichts gesendet, erhaelt er ein ``/ping``. Nach
+        heartbeat_misses Intervallen wird die Verbindung geschlossen,
+        sodass der Thread des Clients ihn abmeldet und sein Alias
+        wieder frei wird.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+        """
+        idle = time.monotonic() - client.last_seen
+        if idle >= self.heartbeat_interval * self.heartbeat_misses:
+            logger.info(
+                "Reaping idle connection of %r", client.address,
+                extra={"address": client.address,
+                       "alias": self.clients.get(client),
+                       "idle": round(idle, 1)})
+            self.heartbeats.remove(client)
+
+            # Nur herunterfahren, schließen muss der Thread des
+            # Clients, der dabei aus recv zurueckkehrt
+            try:
+                client.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        elif idle >= self.heartbeat_interval and client in self.clients:
+            # Nur vormerken, da ein voller Sendepuffer sonst den Thread
+            # des Timer-Rads blockiert. Der Thread des Clients sendet
+            # den Frame spaetestens nach dem naechsten Timeout von recv
+            client.writer.queue(
+                self.ping_frame, shared.KOCHA_LANE_CONTROL)
 
     def on_members(self, client):
         """
@@ -220,22 +1604,217 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         Args:
             client: Die Daten der Clientverbindung.
         """
+        with self.presence_lock:
+            if self.members_content is None:
+                self.members_content = ", ".join(
+                    alias for _, alias in self.recipients)
+            content = self.members_content
+
         response = shared.KochaMessage(
-            content=", ".join(self.clients.values()),
-            sender=shared.KOCHA_SERVER_ALIAS)
+            content=content, sender=shared.KOCHA_SERVER_ALIAS)
         client.send(response)
 
+    def on_presence(self, client):
+        """
+        Dem Client die Mitgliederliste als Snapshot mit der aktuellen
+        Version schicken und ihn anschließend ueber jede Aenderung mit
+        einem Delta informieren (siehe update_presence).
+
+        Der Snapshot hat den Inhalt ``/presence <version> = <alias> ...``.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+        """
+        with self.presence_lock:
+            # Den Snapshot nur nach einer Aenderung neu erstellen
+            if self.presence_snapshot is None:
+                self.presence_snapshot = shared.JsonUtils.to_frame(
+                    shared.KochaMessage(
+                        content="/presence {} = {}".format(
+                            self.presence_version,
+                            " ".join(
+                                alias for _, alias in self.recipients)),
+                        sender=shared.KOCHA_SERVER_ALIAS,
+                        is_dm=True))
+
+            self.presence_subscribers.add(client)
+            client.send_frame(self.presence_snapshot)
+
+    def update_presence(self, operation, *aliases):
+        """
+        Die Version der Mitgliederliste erhoehen, die zwischengespeicherten
+        Listen verwerfen und allen Abonnenten das Delta schicken.
+
+        Ein Delta hat den Inhalt ``/presence <version> <operation>
+        <alias> ...`` mit den Operationen ``+`` (angemeldet), ``-``
+        (abgemeldet) und ``~`` (umbenannt, alter und neuer Alias).
+
+        Args:
+            operation: Die Art der Aenderung.
+            aliases: Die betroffenen Aliase.
+        """
+        with self.presence_lock:
+            self.presence_version += 1
+            self.presence_snapshot = None
+            self.members_content = None
+
+            # Das Delta nur einmal kodieren
+            frame = shared.JsonUtils.to_frame(shared.KochaMessage(
+                content="/presence {} {} {}".format(
+                    self.presence_version, operation, " ".join(aliases)),
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True))
+            lane = shared.KOCHA_LANE_DIRECT
+            for cli in self.presence_subscribers:
+                cli.send_frame(frame, lane)
+
+    def on_nick(self, client, message):
+        """
+        Den Alias des Clients aendern.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            message: Das KochaMessage-Object.
+        """
+        _, alias, *_ = message.content.split() + [""]
+        old_alias = self.clients[client]
+        if not self.register(client, alias):
+            client.send(shared.KochaMessage(
+                content="The alias {!r} is not available.".format(alias),
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True))
+            return
+
+        # Bestaetigungen und ausstehende Direct-Messages gehoeren zum
+        # neuen Alias
+        with self.history_lock:
+            if old_alias in self.acked:
+                self.acked[alias] = self.acked.pop(old_alias)
+            if old_alias in self.pending_dms:
+                self.pending_dms[alias] = self.pending_dms.pop(old_alias)
+
+        self.update_presence("~", old_alias, alias)
+
+        # Fuer den neuen Alias aufbewahrte Direct-Messages zustellen
+        self.deliver_mailbox(client, alias)
+
+        message = shared.KochaMessage(
+            content="{} is now known as {}.".format(old_alias, alias),
+            sender=shared.KOCHA_SERVER_ALIAS)
+        self.on_broadcast(None, message)
+
     def on_broadcast(self, client, message):
         """
         Die Nachricht des Clients im Chat veroeffentlichen.
 
         Args:
-            client: Die Daten der Clientverbindung
+            client: Die Daten der Clientverbindung, die die Nachricht
+                nicht erhaelt, oder None, wenn alle Clients sie
+                erhalten.
+            message: Das KochaMessage-Object.
+        """
+        # Sequenznummer vergeben und einreihen unter history_lock,
+        # damit jede Verbindung die Frames in der Reihenfolge der
+        # Sequenznummern erhaelt. Gesendet wird erst am Ende von cork()
+        with shared.KochaFrameWriter.cork(), self.history_lock:
+            self.sequence(message, excluded=self.clients.get(client))
+
+            # Die Nachricht nur einmal kodieren. Mit Shards wird der
+            # Frame nur je Shard eingereiht und dort an die Empfaenger
+            # gesendet
+            frame = shared.JsonUtils.to_frame(message)
+            lane = shared.KOCHA_LANE_BROADCAST
+            if self.fanout is not None:
+                self.fanout.broadcast(frame, client, lane)
+                return
+
+            # Sonst denselben Frame selbst an alle Empfaenger senden.
+            # Der Snapshot aendert sich waehrend der Schleife nicht,
+            # auch wenn sich Clients an- oder abmelden
+            for cli, _ in self.recipients:
+                if cli is not client:
+                    cli.send_frame(frame, lane)
+
+    def sequence(self, message, recipient=None, excluded=None):
+        """
+        Einer Nachricht die naechste Sequenznummer geben und sie im
+        Verlauf ablegen. Der Aufrufer haelt history_lock und reiht die
+        Nachricht noch unter dem Lock ein (siehe send_sequenced).
+
+        Args:
             message: Das KochaMessage-Object.
+            recipient: Der Alias des Empfaengers bei einer
+                Direct-Message, sonst None.
+            excluded: Der Alias des Clients, der die oeffentliche
+                Nachricht nicht erhaelt (in der Regel der Sender).
+        """
+        self.last_seq += 1
+        message.seq = self.last_seq
+        self.history.append((message, recipient, excluded))
+
+        # Nachrichten der Nutzer in der Reihenfolge der Sequenznummern
+        # fuer die Suche vormerken. Der Index wird in einem eigenen
+        # Thread aktualisiert
+        if message.sender != shared.KOCHA_SERVER_ALIAS:
+            self.search_index.add(message, recipient)
+
+    def send_sequenced(self, client, message):
+        """
+        Einem Client eine Nachricht (oder einen Batch) mit
+        Sequenznummer schicken. Der Aufrufer haelt history_lock und
+        sammelt die Frames mit cork(). Mit Shards laeuft der Frame durch
+        den Shard des Clients, damit er nicht vor zuvor dort
+        eingereihten Nachrichten ankommt.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            message: Das KochaMessage-Object oder eine Liste von
+                KochaMessage-Objects.
+        """
+        frame = shared.JsonUtils.to_frame(message)
+        lane = shared.KOCHA_LANE_BROADCAST
+        if self.fanout is not None:
+            self.fanout.send(client, frame, lane)
+        else:
+            client.send_frame(frame, lane)
+
+    def on_catch_up(self, client, alias, last_seq, history=None):
         """
-        for cli in self.clients:
-            if cli != client:
-                cli.send(message)
+        Dem Client alle Nachrichten aus dem Verlauf, die nach der
+        Sequenznummer last_seq versendet wurden und fuer ihn bestimmt
+        sind, als einen einzigen Batch schicken.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            alias: Der Alias des Clients.
+            last_seq: Die Sequenznummer der zuletzt vom Client
+                empfangenen Nachricht.
+            history: Eine Kopie des Verlaufs, die der Aufrufer unter
+                history_lock erstellt hat, oder None.
+        """
+        if history is None:
+            with self.history_lock:
+                history = list(self.history)
+
+        if not history or history[-1][0].seq <= last_seq:
+            return
+
+        batch = [
+            message for message, recipient, excluded in history
+            if message.seq > last_seq
+            and (recipient == alias
+                 or (recipient is None and excluded != alias))]
+
+        # Den Client darauf hinweisen, wenn der Verlauf nicht weit
+        # genug zurueck reicht
+        if history[0][0].seq > last_seq + 1:
+            batch.insert(0, shared.KochaMessage(
+                content="Some messages could not be recovered.",
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True))
+
+        if batch:
+            client.send(batch, shared.KOCHA_LANE_BROADCAST)
 
     def on_dm(self, client, message):
         """
@@ -256,14 +1835,262 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         if message.sender == addressed_alias:
             return
 
-        for cli in self.clients:
-            alias = self.clients[cli]
-            if alias == addressed_alias:
-                message.content = content
-                message.is_dm = True
+        message.content = content
+        message.is_dm = True
+
+        with shared.KochaFrameWriter.cork(), self.history_lock:
+            for cli, alias in self.recipients:
+                if alias == addressed_alias:
+                    self.sequence(message, recipient=addressed_alias)
+                    self.expect_ack(message, addressed_alias)
+                    self.send_sequenced(cli, message)
+                    return
+
+        # Der Empfaenger ist nicht angemeldet, daher die Direct-Message
+        # bis zu seiner naechsten Anmeldung aufbewahren. Der KOCHA-Server
+        # selbst und nie angemeldete Aliase erhalten keine Mailbox
+        if addressed_alias == shared.KOCHA_SERVER_ALIAS:
+            content = "{} does not accept direct messages.".format(
+                shared.KOCHA_SERVER_ALIAS)
+        elif addressed_alias not in self.known_aliases:
+            content = (
+                "Unknown user {}. Direct message not delivered.".format(
+                    addressed_alias))
+        else:
+            self.queue_dm(client, message, addressed_alias)
+            return
+        client.send(shared.KochaMessage(
+            content=content, sender=shared.KOCHA_SERVER_ALIAS, is_dm=True))
+
+    def on_transfer(self, client, message):
+        """
+        Ein Kommando der Dateiuebertragung (siehe kocha.transfer) an die
+        Gegenseite weiterleiten. Jeder Chunk wird sofort weitergeleitet,
+        der KOCHA-Server haelt also nie die ganze Datei. Die Kommandos
+        erhalten keine Sequenznummer und landen weder im Verlauf noch
+        in der Suche.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            message: Das KochaMessage-Object.
+        """
+        try:
+            command, addressed_alias, rest = message.content.split(" ", 2)
+        except ValueError:
+            return
+
+        # In der weitergeleiteten Nachricht steht statt des Empfaengers
+        # der Sender, damit der Empfaenger direkt antworten kann
+        if message.sender != addressed_alias:
+            for cli, alias in self.recipients:
+                if alias == addressed_alias:
+                    cli.send(
+                        shared.KochaMessage(
+                            content=" ".join((command, message.sender, rest)),
+                            sender=message.sender,
+                            is_dm=True),
+                        shared.KOCHA_LANE_BULK if command == "/chunk"
+                        else shared.KOCHA_LANE_DIRECT)
+                    return
+
+        # Der Empfaenger ist nicht angemeldet, daher die Uebertragung
+        # beim Sender abbrechen
+        if command != "/cancel":
+            client.send(shared.KochaMessage(
+                content="/cancel {} {}".format(
+                    addressed_alias, rest.split(" ", 1)[0]),
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True))
+
+    def expect_ack(self, message, recipient):
+        """
+        Im zuverlaessigen Modus auf die Bestaetigung einer
+        Direct-Message durch den Empfaenger warten, um dem Sender
+        anschließend die Zustellung zu melden (siehe on_ack).
+
+        Args:
+            message: Das KochaMessage-Object mit Sequenznummer.
+            recipient: Der Alias des Empfaengers.
+
+        Returns:
+            True, wenn die Zustellung spaeter gemeldet wird, sonst
+            False.
+        """
+        if not self.reliable or recipient not in self.acked:
+            return False
+
+        pending = self.pending_dms.setdefault(
+            recipient, collections.deque(maxlen=KOCHA_HISTORY_SIZE))
+        pending.append((message.seq, message.sender))
+        return True
+
+    def queue_dm(self, client, message, recipient):
+        """
+        Eine Direct-Message fuer einen abgemeldeten, aber schon einmal
+        angemeldeten Nutzer aufbewahren und dem Sender mitteilen, ob sie
+        aufbewahrt wird.
+
+        Args:
+            client: Die Daten der Clientverbindung des Senders.
+            message: Das KochaMessage-Object.
+            recipient: Der Alias des Empfaengers.
+        """
+        now = time.time()
+        with self.mailbox_lock:
+            # Zu alte Direct-Messages verwerfen
+            mailbox = self.mailboxes.setdefault(
+                recipient, collections.deque())
+            while mailbox and mailbox[0][0] < now - self.mailbox_max_age:
+                self.mailbox_memory -= len(mailbox.popleft()[1].content)
+
+            queued = False
+            if len(mailbox) + self.spilled[recipient] < self.mailbox_size:
+                if (self.mailbox_memory + len(message.content)
+                        <= KOCHA_MAILBOX_MEMORY):
+                    mailbox.append((now, message))
+                    self.mailbox_memory += len(message.content)
+                    queued = True
+                elif self.mailbox_file is not None:
+                    # Der Speicher ist voll, daher in die Datei auslagern
+                    with open(
+                            self.mailbox_file, "a",
+                            encoding="utf-8") as file:
+                        file.write(json.dumps([
+                            now,
+                            recipient,
+                            shared.JsonUtils.to_json(message)]) + "\n")
+                    self.spilled[recipient] += 1
+                    queued = True
+
+            if not mailbox:
+                del self.mailboxes[recipient]
+
+        if queued:
+            content = "Direct message to {} queued.".format(recipient)
+        else:
+            content = (
+                "Mailbox of {} is full. Direct message not "
+                "delivered.".format(recipient))
+        client.send(shared.KochaMessage(
+            content=content, sender=shared.KOCHA_SERVER_ALIAS, is_dm=True))
+
+    def deliver_mailbox(self, client, alias):
+        """
+        Alle fuer einen Alias aufbewahrten Direct-Messages als einen
+        Batch zustellen und den Sendern die Zustellung melden.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            alias: Der Alias des Clients.
+        """
+        with self.mailbox_lock:
+            entries = list(self.mailboxes.pop(alias, ()))
+            self.mailbox_memory -= sum(
+                len(message.content) for _, message in entries)
+            if self.spilled.pop(alias, 0):
+                entries.extend(self.unspill(alias))
+
+        # Zu alte Direct-Messages verwerfen
+        now = time.time()
+        entries = sorted(
+            (entry for entry in entries
+             if entry[0] >= now - self.mailbox_max_age),
+            key=lambda entry: entry[0])
+        if not entries:
+            return
+
+        # Die Direct-Messages erst jetzt in den Verlauf aufnehmen, damit
+        # sie auch nach einem erneuten Verbinden nachgeliefert werden
+        batch = [message for _, message in entries]
+        with shared.KochaFrameWriter.cork(), self.history_lock:
+            for message in batch:
+                self.sequence(message, recipient=alias)
+            self.send_sequenced(client, batch)
+
+        # Angemeldeten Sendern die Zustellung melden (im
+        # zuverlaessigen Modus erst nach der Bestaetigung)
+        for message in batch:
+            if self.expect_ack(message, alias):
+                continue
+            for cli, cli_alias in self.recipients:
+                if cli_alias == message.sender:
+                    cli.send(shared.KochaMessage(
+                        content="Direct message to {} delivered.".format(
+                            alias),
+                        sender=shared.KOCHA_SERVER_ALIAS,
+                        is_dm=True))
+
+    def unspill(self, alias):
+        """
+        Die fuer einen Alias ausgelagerten Direct-Messages aus der Datei
+        lesen und dort entfernen. Der Aufrufer haelt mailbox_lock.
+
+        Args:
+            alias: Der Alias des Empfaengers.
+
+        Returns:
+            Liste von Tupeln aus dem Zeitpunkt der Aufbewahrung und der
+            Nachricht.
+        """
+        entries, lines = [], []
+        with open(self.mailbox_file, encoding="utf-8") as file:
+            for line in file:
+                stored_at, recipient, message = json.loads(line)
+                if recipient == alias:
+                    entries.append((
+                        stored_at,
+                        shared.JsonUtils.to_kocha_message(message)))
+                else:
+                    lines.append(line)
+
+        # Die Datei ersetzen, damit sie nie nur halb geschrieben ist
+        path = self.mailbox_file + ".tmp"
+        with open(path, "w", encoding="utf-8") as file:
+            file.writelines(lines)
+        os.replace(path, self.mailbox_file)
+        return entries
+
+    def on_ack(self, client, seq):
+        """
+        Eine kumulative Empfangsbestaetigung eines Clients verarbeiten
+        und den Sendern dadurch bestaetigter Direct-Messages die
+        Zustellung melden.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            seq: Die hoechste Sequenznummer, bis zu der der Client alle
+                Nachrichten erhalten hat.
+        """
+        # Der Wert kommt vom Client. Nur nicht negative Ganzzahlen
+        # (keine bool) annehmen und hoechstens bis zur zuletzt
+        # vergebenen Sequenznummer bestaetigen lassen
+        if type(seq) is not int or seq < 0:
+            return
 
-                cli.send(message)
+        alias = self.clients[client]
+        with self.history_lock:
+            seq = min(seq, self.last_seq)
+            if seq <= self.acked.get(alias, 0):
                 return
+            self.acked[alias] = seq
+
+            # Bestaetigte Direct-Messages aus der Warteschlange nehmen
+            senders = []
+            pending = self.pending_dms.get(alias, ())
+            while pending and pending[0][0] <= seq:
+                senders.append(pending.popleft()[1])
+
+        if not self.reliable:
+            return
+
+        for cli, cli_alias in self.recipients:
+            for sender in senders:
+                if cli_alias == sender:
+                    cli.send(shared.KochaMessage(
+                        content="Direct message to {} delivered.".format(
+                            alias),
+                        sender=shared.KOCHA_SERVER_ALIAS,
+                        is_dm=True))
 
     def on_quit(self, client):
         """
@@ -272,17 +2099,179 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         # Die Clientverbindung schließen
         client.close()
 
-        print("Closed connection of {!r}".format(client.address))
+        logger.info(
+            "Closed connection of %r", client.address,
+            extra={"address": client.address,
+                   "alias": self.clients.get(client)})
+
+        # Clients, die sich nie angemeldet haben, muessen nicht
+        # abgemeldet werden
+        alias = self.clients.get(client)
+        if alias is None:
+            return
 
         # Andere Nutzer informieren, dass dieser Nutzer den Chat
         # verlassen hat
-        message = shared.KochaMessage(
-            content="{} left the chat.".format(self.clients[client]),
-            sender=shared.KOCHA_SERVER_ALIAS)
-        self.on_broadcast(client, message)
+        self.announce(client, alias, joined=False)
 
         # Den Client aus der Liste der angemeldenten Clients entfernen
-        del self.clients[client]
+        self.unregister(client)
+        with self.presence_lock:
+            self.presence_subscribers.discard(client)
+        self.update_presence("-", alias)
+
+    def announce(self, client, alias, joined):
+        """
+        Die anderen Clients darueber informieren, dass sich ein Nutzer
+        an- oder abgemeldet hat.
+
+        Innerhalb eines Zeitfensters werden die ersten Meldungen einzeln
+        verschickt. Alle weiteren werden gesammelt und am Ende des
+        Zeitfensters als eine Sammelmeldung verschickt (siehe
+        flush_notices), damit z.B. nach einem Netzwerkausfall nicht
+        jeder Client hunderte Meldungen erhaelt.
+
+        Args:
+            client: Die Daten der Clientverbindung des Nutzers.
+            alias: Der Alias des Nutzers.
+            joined: True, wenn sich der Nutzer angemeldet hat, False,
+                wenn er sich abgemeldet hat.
+        """
+        with self.notice_lock:
+            now = time.monotonic()
+            if now >= self.notice_window_end and self.notice_timer is None:
+                # Ein neues Zeitfenster beginnen
+                self.notice_window_end = now + self.notice_window
+                self.notice_count = 0
+
+            queued = self.notice_count >= self.notice_threshold
+            if not queued:
+                self.notice_count += 1
+            elif joined and alias in self.left:
+                # Nutzer, die sich im selben Zeitfenster ab- und wieder
+                # anmelden (bzw. umgekehrt), tauchen gar nicht auf
+                self.left.remove(alias)
+            elif not joined and alias in self.joined:
+                self.joined.remove(alias)
+            else:
+                (self.joined if joined else self.left).append(alias)
+
+            # Die Sammelmeldung am Ende des Zeitfensters verschicken
+            if queued and self.notice_timer is None:
+                self.notice_timer = threading.Timer(
+                    self.notice_window_end - now, self.flush_notices)
+                self.notice_timer.daemon = True
+                self.notice_timer.start()
+
+        if not queued:
+            message = shared.KochaMessage(
+                content="{} {} the chat.".format(
+                    alias, "joined" if joined else "left"),
+                sender=shared.KOCHA_SERVER_ALIAS)
+            self.on_broadcast(client, message)
+
+    def flush_notices(self):
+        """
+        Die gesammelten Meldungen ueber an- und abgemeldete Nutzer als
+        eine Sammelmeldung an alle Clients verschicken, z.B.
+        ``37 users joined: alice, bob, ...``.
+        """
+        with self.notice_lock:
+            joined, left = self.joined, self.left
+            self.joined, self.left = [], []
+            self.notice_timer = None
+
+            # Haelt der Ansturm an, wird auch im naechsten Zeitfenster
+            # sofort gesammelt
+            self.notice_window_end = time.monotonic() + self.notice_window
+            self.notice_count = self.notice_threshold
+
+        lines = []
+        for aliases, verb in ((joined, "joined"), (left, "left")):
+            if not aliases:
+                continue
+            line = "{} user{} {}: {}".format(
+                len(aliases),
+                "s" if len(aliases) > 1 else "",
+                verb,
+                ", ".join(aliases[:KOCHA_NOTICE_MAX_ALIASES]))
+            if len(aliases) > KOCHA_NOTICE_MAX_ALIASES:
+                line += " and {} more".format(
+                    len(aliases) - KOCHA_NOTICE_MAX_ALIASES)
+            lines.append(line)
+
+        if lines:
+            message = shared.KochaMessage(
+                content="\n".join(lines),
+                sender=shared.KOCHA_SERVER_ALIAS)
+            self.on_broadcast(None, message)
+
+    def on_search(self, client, message):
+        """
+        Dem Client eine Seite mit den neuesten Nachrichten schicken, die
+        zur Suchanfrage passen.
+
+        Args:
+            client: Die Daten der Clientverbindung.
+            message: Das KochaMessage-Object mit der Suchanfrage.
+        """
+        # Die Filter von den gesuchten Woertern trennen
+        words, filters = [], {}
+        for part in message.content.split()[1:]:
+            key, sep, value = part.partition(":")
+            if sep and key in ("from", "is", "after", "before", "page"):
+                filters[key] = value
+            else:
+                words.append(part)
+
+        try:
+            is_dm = {None: None, "dm": True, "public": False}[
+                filters.get("is")]
+            after, before = (
+                datetime.datetime.fromisoformat(filters[key]).timestamp()
+                if key in filters else None
+                for key in ("after", "before"))
+            page = int(filters.get("page", 1))
+            if page < 1:
+                raise ValueError("Invalid page")
+
+            results, more = self.search_index.search(
+                self.clients[client],
+                " ".join(words),
+                sender=filters.get("from"),
+                is_dm=is_dm,
+                after=after,
+                before=before,
+                page=page)
+        except (KeyError, ValueError):
+            client.send(shared.KochaMessage(
+                content=self.KOCHA_SEARCH_USAGE,
+                sender=shared.KOCHA_SERVER_ALIAS,
+                is_dm=True))
+            return
+
+        query = " ".join(message.content.split()[1:])
+        if not results:
+            content = "No results for {!r}.".format(query)
+        else:
+            lines = ["Results for {!r} (page {}):".format(query, page)]
+            for sent_at, sender, is_dm, recipient, text in results:
+                lines.append("[{}] {}{}: {}".format(
+                    datetime.datetime.fromtimestamp(sent_at).strftime(
+                        "%Y-%m-%d %H:%M"),
+                    sender,
+                    " -> " + recipient if is_dm else "",
+                    text))
+            if more:
+                lines.append("More: /search {} page:{}".format(
+                    " ".join(
+                        part for part in message.content.split()[1:]
+                        if not part.startswith("page:")),
+                    page + 1))
+            content = "\n".join(lines)
+
+        client.send(shared.KochaMessage(
+            content=content, sender=shared.KOCHA_SERVER_ALIAS, is_dm=True))
 
     def on_help(self, client):
         """
@@ -301,19 +2290,166 @@ class KochaTcpServer(shared.KochaTcpSocketWrapper):
         locale.setlocale(locale.LC_ALL, "")
 
         # Kommandozeilenparameter verarbeiten
-        if (len(sys.argv) != 3):
-            print("Usage: python3 -m kocha.server HOST PORT")
-            return 1
+        parser = argparse.ArgumentParser(prog="python3 -m kocha.server")
+        parser.add_argument("host", metavar="HOST")
+        parser.add_argument("port", metavar="PORT", type=int)
+        parser.add_argument(
+            "--reliable", action="store_true",
+            help="retransmit unacknowledged messages after a reconnect and "
+                 "confirm the delivery of direct messages")
+        parser.add_argument(
+            "--certfile", metavar="PATH",
+            help="certificate (PEM) that enables TLS")
+        parser.add_argument(
+            "--keyfile", metavar="PATH",
+            help="private key (PEM) of the certificate")
+        parser.add_argument(
+            "--unix", metavar="PATH",
+            help="additionally listen on a unix domain socket")
+        parser.add_argument(
+            "--stack-size", metavar="KIB", type=int,
+            help="stack size of the client handler threads in KiB "
+                 "(at least 32)")
+        parser.add_argument(
+            "--notice-window", metavar="SECONDS", type=float,
+            default=KOCHA_NOTICE_WINDOW,
+            help="time window for combining join and leave notices "
+                 "(default: %(default)s, 0 disables)")
+        parser.add_argument(
+            "--notice-threshold", metavar="N", type=int,
+            default=KOCHA_NOTICE_THRESHOLD,
+            help="join and leave notices sent individually per window "
+                 "before they are combined (default: %(default)s)")
+        parser.add_argument(
+            "--history-file", metavar="PATH",
+            help="store all messages for /search in this file and load "
+                 "them on start")
+        parser.add_argument(
+            "--mailbox-size", metavar="N", type=int,
+            default=KOCHA_MAILBOX_SIZE,
+            help="direct messages kept per offline user "
+                 "(default: %(default)s)")
+        parser.add_argument(
+            "--mailbox-age", metavar="SECONDS", type=float,
+            default=KOCHA_MAILBOX_MAX_AGE,
+            help="how long direct messages for offline users are kept "
+                 "(default: %(default)s)")
+        parser.add_argument(
+            "--mailbox-file", metavar="PATH",
+            help="spill direct messages for offline users to this file "
+                 "when the in-memory mailboxes are full")
+        parser.add_argument(
+            "--backlog", metavar="N", type=int, default=KOCHA_BACKLOG,
+            help="length of the queue for pending connections "
+                 "(default: %(default)s)")
+        parser.add_argument(
+            "--max-connections", metavar="N", type=int,
+            help="reject further connections with a 'server full' reply")
+        parser.add_argument(
+            "--capture", metavar="PATH",
+            help="record all inbound frames for python3 -m kocha.replay")
+        parser.add_argument(
+            "--anonymize", action="store_true",
+            help="replace aliases and message content in the capture")
+        parser.add_argument(
+            "--handoff", metavar="PATH",
+            help="unix domain socket for restarts without dropping "
+                 "connections: take over from the server listening there, "
+                 "then listen there for a successor")
+        parser.add_argument(
+            "--fanout-shards", metavar="N", type=int, default=0,
+            help="deliver public messages from N writer threads instead "
+                 "of the sender's thread (default: %(default)s)")
+        parser.add_argument(
+            "--heartbeat", metavar="SECONDS", type=float,
+            default=heartbeat.KOCHA_HEARTBEAT_INTERVAL,
+            help="ping clients that were silent this long "
+                 "(default: %(default)s, 0 disables)")
+        parser.add_argument(
+            "--heartbeat-misses", metavar="N", type=int,
+            default=heartbeat.KOCHA_HEARTBEAT_MISSES,
+            help="close connections silent for N heartbeat intervals "
+                 "(default: %(default)s)")
+        parser.add_argument(
+            "--snapshot", metavar="PATH",
+            help="save history, mailboxes and sequence numbers to this "
+                 "file periodically and restore them on start")
+        parser.add_argument(
+            "--snapshot-interval", metavar="SECONDS", type=float,
+            default=snapshot.KOCHA_SNAPSHOT_INTERVAL,
+            help="time between two snapshots (default: %(default)s)")
+        parser.add_argument(
+            "--rate-limit", metavar="N", type=float,
+            help="drop requests of clients that send more than N per "
+                 "second on average")
+        parser.add_argument(
+            "--rate-burst", metavar="N", type=int, default=KOCHA_RATE_BURST,
+            help="requests a client may send at once under --rate-limit "
+                 "(default: %(default)s)")
+        parser.add_argument(
+            "--admin", metavar="PATH",
+            help="unix domain socket for python3 -m kocha.admin")
+        parser.add_argument(
+            "--log-file", metavar="PATH",
+            help="write the JSON log to this file instead of stderr")
+        parser.add_argument(
+            "--log-level", metavar="LEVEL", default="info",
+            choices=["debug", "info", "warning", "error"],
+            help="lowest level that is logged (default: %(default)s)")
+        parser.add_argument(
+            "--log-max-bytes", metavar="BYTES", type=int,
+            default=log.KOCHA_LOG_MAX_BYTES,
+            help="rotate the log file at this size (default: %(default)s, "
+                 "0 disables)")
+        parser.add_argument(
+            "--log-backups", metavar="N", type=int,
+            default=log.KOCHA_LOG_BACKUPS,
+            help="rotated log files to keep (default: %(default)s)")
+        args = parser.parse_args()
 
-        host = sys.argv[1]
-        port = int(sys.argv[2])
+        # Das Protokoll in einem eigenen Thread schreiben
+        kocha_log = log.KochaLog(
+            path=args.log_file,
+            level=args.log_level,
+            max_bytes=args.log_max_bytes,
+            backups=args.log_backups)
+        kocha_log.start()
 
         # Den KOCHA-Server starten
         try:
-            server = KochaTcpServer(host=host, port=port)
+            server = KochaTcpServer(
+                host=args.host,
+                port=args.port,
+                reliable=args.reliable,
+                certfile=args.certfile,
+                keyfile=args.keyfile,
+                unix_path=args.unix,
+                stack_size=(
+                    args.stack_size * 1024 if args.stack_size else None),
+                handoff_path=args.handoff,
+                notice_window=args.notice_window,
+                notice_threshold=args.notice_threshold,
+                history_file=args.history_file,
+                mailbox_size=args.mailbox_size,
+                mailbox_max_age=args.mailbox_age,
+                mailbox_file=args.mailbox_file,
+                backlog=args.backlog,
+                max_connections=args.max_connections,
+                capture_path=args.capture,
+                anonymize=args.anonymize,
+                fanout_shards=args.fanout_shards,
+                heartbeat_interval=args.heartbeat,
+                heartbeat_misses=args.heartbeat_misses,
+                snapshot_path=args.snapshot,
+                snapshot_interval=args.snapshot_interval,
+                rate_limit=args.rate_limit,
+                rate_burst=args.rate_burst,
+                admin_path=args.admin)
             server.loop()
         except KeyboardInterrupt:
             server.close()
+        finally:
+            kocha_log.close()
 
 
 if __name__ == "__main__":
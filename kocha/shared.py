@@ -3,8 +3,14 @@ Modul mit Klassen und Methoden, die sowohl vom KOCHA-Client als auch
 vom KOCHA-Server verwendet werden.
 """
 
+import contextlib
 import json
-import sys
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
 from datetime import datetime
 
 KOCHA_VERSION = "v1.0.0"
@@ -14,8 +20,18 @@ Die aktuelle Versionsnummer des KOCHA-Servers und des KOCHA-Clients.
 
 KOCHA_BUFSIZE = 4096
 """
-Die maximale Anzahl an Bytes die auf einmal uebetragen werden
-duerfen.
+Die Anfangsgroeße des Empfangspuffers einer Verbindung in Bytes.
+"""
+
+KOCHA_MAX_FRAME_SIZE = 1 << 20
+"""
+Die maximale Groeße einer einzelnen Nachricht in Bytes. Bis zu dieser
+Groeße waechst der Empfangspuffer bei Bedarf.
+"""
+
+logger = logging.getLogger(__name__)
+"""
+Der Logger fuer Fehler beim Senden und Empfangen.
 """
 
 KOCHA_TIMEOUT = 2.0
@@ -28,6 +44,67 @@ KOCHA_SERVER_ALIAS = "KOCHA-Server"
 Der Alias des KOCHA-Servers.
 """
 
+KOCHA_FRAME_DELIMITER = b"\n"
+"""
+Trennzeichen zwischen zwei Nachrichten im Datenstrom. Da JSON-Daten
+keine unmaskierten Zeilenumbrueche enthalten, kann der Zeilenumbruch
+als Ende einer Nachricht verwendet werden.
+"""
+
+KOCHA_LANE_CONTROL = 0
+"""
+Die Spur (Prioritaet) ausgehender Frames fuer Anmeldung, Ablehnung und
+andere Steuerdaten. Die Spuren sind von der hoechsten zur niedrigsten
+nummeriert.
+"""
+
+KOCHA_LANE_DIRECT = 1
+"""
+Die Spur fuer Antworten auf eigene Kommandos, die Mitgliederliste und
+die Steuerbefehle der Dateiuebertragung. Diese Frames haben keine
+Sequenznummer.
+"""
+
+KOCHA_LANE_BROADCAST = 2
+"""
+Die Spur fuer alle Nachrichten mit Sequenznummer: Nachrichten an alle,
+Meldungen ueber andere Nutzer und Direct-Messages. Sie teilen sich eine
+Spur, damit sie je Verbindung in der Reihenfolge ihrer Sequenznummern
+ankommen, denn der KOCHA-Client meldet die hoechste empfangene als
+Wiederaufsetzpunkt und Bestaetigung.
+"""
+
+KOCHA_LANE_BULK = 3
+"""
+Die Spur fuer Chunks von Dateiuebertragungen.
+"""
+
+KOCHA_LANE_NAMES = ("control", "direct", "broadcast", "bulk")
+"""
+Die Namen der Spuren, z.B. fuer Statistiken.
+"""
+
+KOCHA_LANE_WEIGHTS = (8, 4, 2, 1)
+"""
+Die Anzahl der Frames, die je Runde der Zuteilung hoechstens aus jeder
+Spur gesendet werden. Hoeher priorisierte Spuren kommen in jeder Runde
+zuerst und oefter an die Reihe, niedrige Spuren verhungern aber nicht.
+"""
+
+KOCHA_LANE_BATCH = 64
+"""
+Die maximale Anzahl an Frames je Systemaufruf. Danach wird neu
+zugeteilt, sodass ein inzwischen eingetroffener Frame einer hoeheren
+Spur hoechstens auf einen Systemaufruf warten muss.
+"""
+
+KOCHA_MAX_QUEUED = 10000
+"""
+Die maximale Anzahl ausstehender Frames je Verbindung oder None fuer
+unbegrenzt. Eine Verbindung, die so weit zurueckliegt, wird getrennt,
+statt den Speicher des KOCHA-Servers zu fuellen.
+"""
+
 
 class KochaMessage:
     """
@@ -35,7 +112,9 @@ class KochaMessage:
     TCP/IP zwischen KOCHA-Server und KOCHA-Client ausgetauscht wird.
     """
 
-    def __init__(self, content="", sender="", sent_at=None, is_dm=False):
+    def __init__(
+            self, content="", sender="", sent_at=None, is_dm=False, seq=None,
+            ack=None):
         """
         Initialisiert ein Object der Klasse KochaMessage.
 
@@ -44,11 +123,19 @@ class KochaMessage:
             sender: Der Alias des Senders.
             sent_at: datetime-Object mit dem Versendezeitpunkt.
             is_dm: Gibt an, ob die Nachricht eine Direct-Message ist.
+            seq: Die vom KOCHA-Server vergebene, monoton steigende
+                Sequenznummer der Nachricht oder None, falls die
+                Nachricht (noch) keine Sequenznummer hat.
+            ack: Kumulative Empfangsbestaetigung: die hoechste
+                Sequenznummer, bis zu der der Sender alle Nachrichten
+                erhalten hat, oder None.
         """
         self.content = content
         self.sender = sender
         self.sent_at = datetime.now() if sent_at is None else sent_at
         self.is_dm = is_dm
+        self.seq = seq
+        self.ack = ack
 
 
 class KochaMessageEncoder(json.JSONEncoder):
@@ -98,6 +185,14 @@ class KochaMessageDecoder(json.JSONDecoder):
         """
         super().__init__(object_hook=self.object_hook, *args, **kwargs)
 
+    REQUIRED_KEYS = ("content", "sender", "sent_at", "is_dm")
+    """
+    Attribute, die ein deserialisiertes Object mindestens haben muss,
+    damit es als KochaMessage-Object erkannt wird. Alle weiteren
+    Attribute sind optional, damit auch Nachrichten aelterer
+    KOCHA-Versionen gelesen werden koennen.
+    """
+
     def object_hook(self, dct):
         """
         Wird aufgerufen, um anstelle des normalen deserialisierten
@@ -113,13 +208,14 @@ class KochaMessageDecoder(json.JSONDecoder):
 
         # Attribute setzen, falls es sich bei dem deserialisierten
         # Obejct um ein KochaMessage-Object handelt
-        is_kocha_message = all(
-            True if key in dct else False for key in vars(obj))
+        is_kocha_message = all(key in dct for key in self.REQUIRED_KEYS)
         if is_kocha_message:
             obj.sender = dct["sender"]
             obj.content = dct["content"]
             obj.sent_at = datetime.fromtimestamp(dct["sent_at"])
             obj.is_dm = dct["is_dm"]
+            obj.seq = dct.get("seq")
+            obj.ack = dct.get("ack")
 
         return obj
 
@@ -138,7 +234,8 @@ class JsonUtils:
             data: Daten im JSON-Format.
 
         Returns:
-            Ein KochaMessage-Object.
+            Ein KochaMessage-Object oder, falls die Daten einen Batch
+            enthalten, eine Liste von KochaMessage-Objects.
         """
         return json.loads(data, cls=KochaMessageDecoder)
 
@@ -155,6 +252,670 @@ class JsonUtils:
         """
         return json.dumps(kocha_message, cls=KochaMessageEncoder)
 
+    @staticmethod
+    def to_frame(kocha_message):
+        """
+        Erstellt aus einem KochaMessage-Object (oder einer Liste von
+        KochaMessage-Objects) die Bytes, die ueber den Socket
+        uebertragen werden.
+
+        Args:
+            kocha_message: Ein KochaMessage-Object oder eine Liste von
+                KochaMessage-Objects, die als ein Batch uebertragen
+                werden.
+
+        Returns:
+            Die mit KOCHA_FRAME_DELIMITER abgeschlossenen Bytes.
+        """
+        data = JsonUtils.to_json(kocha_message)
+        return data.encode() + KOCHA_FRAME_DELIMITER
+
+
+class KochaFrameWriter:
+    """
+    Klasse sammelt die ausstehenden Frames einer Verbindung und schreibt
+    sie gemeinsam mit einem einzigen socket.sendmsg-Aufruf
+    (Scatter-Gather), ohne die Frames vorher zusammenzukopieren.
+
+    Schreiben mehrere Threads gleichzeitig, sendet nur einer von ihnen
+    und nimmt dabei die Frames der anderen mit. Innerhalb von cork()
+    werden Frames nur gesammelt und erst am Ende des Blocks gesendet.
+
+    Jeder Frame wartet in einer Spur (KOCHA_LANE_*). Die Spuren werden
+    gewichtet nach KOCHA_LANE_WEIGHTS zugeteilt, damit z.B. eine
+    Antwort auf ein Kommando nicht hinter einem Rueckstau von
+    Nachrichten wartet. Innerhalb einer Spur bleibt die Reihenfolge
+    erhalten. Je Spur wird die Wartezeit der Frames gemessen.
+    """
+
+    __slots__ = (
+        "socket", "pending", "enqueued", "queued", "lock", "flushing",
+        "overflowed", "frames", "syscalls", "waited")
+
+    IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+    """
+    Die maximale Anzahl an Puffern pro sendmsg-Aufruf.
+    """
+
+    corked = threading.local()
+    """
+    Thread-lokale Menge der KochaFrameWriter, die innerhalb von cork()
+    beschrieben wurden.
+    """
+
+    def __init__(self, socket):
+        """
+        Initialisiert ein Object der Klasse KochaFrameWriter.
+
+        Args:
+            socket: Das Socket-Object, auf das geschrieben wird.
+        """
+        self.socket = socket
+
+        # Noch nicht gesendete Frames je Spur, der Zeitpunkt ihres
+        # Einreihens, ihre Gesamtzahl und das Signal, dass gerade ein
+        # Thread sendet
+        self.pending = [[] for _ in KOCHA_LANE_NAMES]
+        self.enqueued = [[] for _ in KOCHA_LANE_NAMES]
+        self.queued = 0
+        self.lock = threading.Lock()
+        self.flushing = False
+
+        # Gibt an, ob die Verbindung wegen zu vieler ausstehender
+        # Frames bereits getrennt wurde
+        self.overflowed = False
+
+        # Statistik: Anzahl gesendeter Frames und Systemaufrufe sowie je
+        # Spur die Anzahl der Frames, deren gesamte und maximale
+        # Wartezeit in Sekunden
+        self.frames = 0
+        self.syscalls = 0
+        self.waited = tuple([0, 0.0, 0.0] for _ in KOCHA_LANE_NAMES)
+
+    @classmethod
+    @contextlib.contextmanager
+    def cork(cls):
+        """
+        Kontextmanager, innerhalb dessen alle Frames des aktuellen
+        Threads nur gesammelt werden. Beim Verlassen wird jeder
+        beschriebene KochaFrameWriter mit einem Aufruf geleert.
+        """
+        # Verschachtelte Aufrufe teilen sich die aeussere Menge
+        if getattr(cls.corked, "writers", None) is not None:
+            yield
+            return
+
+        cls.corked.writers = writers = set()
+        try:
+            yield
+        finally:
+            cls.corked.writers = None
+            for writer in writers:
+                writer.flush()
+
+    def write(self, frame, lane=KOCHA_LANE_DIRECT):
+        """
+        Einen Frame senden oder, innerhalb von cork(), zum Senden
+        vormerken.
+
+        Args:
+            frame: Die Bytes des Frames.
+            lane: Die Spur (KOCHA_LANE_*) des Frames.
+
+        Returns:
+            False, wenn das Senden fehlgeschlagen ist, sonst True.
+        """
+        if not self.queue(frame, lane):
+            return False
+
+        writers = getattr(self.corked, "writers", None)
+        if writers is not None:
+            writers.add(self)
+            return True
+
+        return self.flush()
+
+    def queue(self, frame, lane=KOCHA_LANE_DIRECT):
+        """
+        Einen Frame nur vormerken, ohne zu senden. Gesendet wird er mit
+        dem naechsten flush, z.B. durch den Thread der Verbindung. So
+        blockieren fremde Threads nie auf dem Socket.
+
+        Args:
+            frame: Die Bytes des Frames.
+            lane: Die Spur (KOCHA_LANE_*) des Frames.
+
+        Returns:
+            False, wenn bereits KOCHA_MAX_QUEUED Frames ausstehen und
+            die Verbindung deshalb getrennt wird, sonst True.
+        """
+        now = time.monotonic()
+        with self.lock:
+            if (KOCHA_MAX_QUEUED is None
+                    or self.queued < KOCHA_MAX_QUEUED):
+                self.pending[lane].append(frame)
+                self.enqueued[lane].append(now)
+                self.queued += 1
+                return True
+            first = not self.overflowed
+            self.overflowed = True
+
+        # Wie nach einem Fehler beim Senden baut der Thread der
+        # Verbindung sie ab, sobald recv fehlschlaegt
+        if first:
+            logger.warning("Send queue full, closing connection")
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return False
+
+    def flush(self):
+        """
+        Alle ausstehenden Frames senden. Sendet bereits ein anderer
+        Thread, uebernimmt dieser die Frames.
+
+        Returns:
+            False, wenn das Senden fehlgeschlagen ist, sonst True.
+        """
+        with self.lock:
+            if self.flushing:
+                return True
+            frames = self.schedule()
+            if not frames:
+                return True
+            self.flushing = True
+
+        while True:
+            try:
+                self.write_all(frames)
+            except Exception as e:
+                logger.warning("Send failed: %s", e)
+                with self.lock:
+                    for pending, enqueued in zip(
+                            self.pending, self.enqueued):
+                        pending.clear()
+                        enqueued.clear()
+                    self.queued = 0
+                    self.flushing = False
+
+                # Ein Teil eines Frames kann bereits gesendet sein. Die
+                # Verbindung schließen, damit der besitzende Thread sie
+                # abbaut, statt in den zerstoerten Strom zu schreiben
+                try:
+                    self.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                return False
+
+            # Inzwischen eingereihte Frames gleich mitsenden
+            with self.lock:
+                frames = self.schedule()
+                if not frames:
+                    self.flushing = False
+                    return True
+
+    def schedule(self):
+        """
+        Die naechsten hoechstens KOCHA_LANE_BATCH Frames gewichtet aus
+        den Spuren entnehmen und ihre Wartezeit erfassen. Der Aufrufer
+        haelt lock.
+
+        Returns:
+            Liste der Bytes der Frames in Sendereihenfolge.
+        """
+        if not self.queued:
+            return []
+        now = time.monotonic()
+
+        # Meist ist nur eine Spur mit wenigen Frames belegt, dann
+        # entfaellt die Zuteilung und die Listen werden ausgetauscht
+        if self.queued <= KOCHA_LANE_BATCH:
+            for lane, frames in enumerate(self.pending):
+                if frames:
+                    break
+            if len(frames) == self.queued:
+                enqueued = self.enqueued[lane]
+                waited = self.waited[lane]
+                waited[0] += len(frames)
+                waited[1] += len(frames) * now - sum(enqueued)
+                if now - enqueued[0] > waited[2]:
+                    waited[2] = now - enqueued[0]
+                self.pending[lane] = []
+                self.enqueued[lane] = []
+                self.queued = 0
+                return frames
+
+        busy = [
+            lane for lane, pending in enumerate(self.pending) if pending]
+        frames = []
+        while busy and len(frames) < KOCHA_LANE_BATCH:
+            for lane in busy:
+                pending, enqueued = self.pending[lane], self.enqueued[lane]
+                count = KOCHA_LANE_BATCH - len(frames)
+                if len(busy) > 1:
+                    count = min(count, KOCHA_LANE_WEIGHTS[lane])
+                count = min(count, len(pending))
+                self.account(lane, now, count)
+                frames.extend(pending[:count])
+                del pending[:count]
+                del enqueued[:count]
+                self.queued -= count
+            busy = [lane for lane in busy if self.pending[lane]]
+        return frames
+
+    def account(self, lane, now, count):
+        """
+        Die Wartezeit der aeltesten Frames einer Spur erfassen, bevor
+        sie entnommen werden. Der Aufrufer haelt lock.
+
+        Args:
+            lane: Die Spur.
+            now: Der aktuelle Zeitpunkt (time.monotonic).
+            count: Die Anzahl der entnommenen Frames.
+        """
+        if count == 0:
+            return
+        enqueued = self.enqueued[lane]
+        waited = self.waited[lane]
+        waited[0] += count
+        waited[1] += count * now - (
+            sum(enqueued) if count == len(enqueued)
+            else sum(enqueued[:count]))
+
+        # Der aelteste Frame steht vorne
+        if now - enqueued[0] > waited[2]:
+            waited[2] = now - enqueued[0]
+
+    def write_all(self, frames):
+        """
+        Frames vollstaendig auf den Socket schreiben und dabei
+        Teilschreibvorgaenge fortsetzen.
+
+        Args:
+            frames: Liste der Bytes der Frames.
+        """
+        self.frames += len(frames)
+
+        # TLS-Sockets unterstuetzen kein sendmsg
+        if isinstance(self.socket, ssl.SSLSocket):
+            self.socket.sendall(b"".join(frames))
+            self.syscalls += 1
+            return
+
+        views = [memoryview(frame) for frame in frames]
+        index = 0
+        while index < len(views):
+            sent = self.socket.sendmsg(views[index:index + self.IOV_MAX])
+            self.syscalls += 1
+
+            # Vollstaendig gesendete Frames ueberspringen und den
+            # teilweise gesendeten Frame kuerzen
+            while sent > 0:
+                length = len(views[index])
+                if sent >= length:
+                    sent -= length
+                    index += 1
+                else:
+                    views[index] = views[index][sent:]
+                    sent = 0
+
+
+class KochaFrameReader:
+    """
+    Klasse liest die Frames einer Verbindung mit socket.recv_into in
+    einen wiederverwendeten Puffer und dekodiert sie direkt aus
+    memoryview-Ausschnitten, ohne fuer jedes recv ein neues
+    bytes-Object anzulegen.
+
+    Der Puffer waechst bei Bedarf bis KOCHA_MAX_FRAME_SIZE. Gelesene
+    Daten werden erst nach vorne verschoben, wenn am Ende des Puffers
+    kein Platz mehr ist.
+    """
+
+    __slots__ = ("socket", "buffer", "view", "start", "end", "scan")
+
+    def __init__(self, socket):
+        """
+        Initialisiert ein Object der Klasse KochaFrameReader.
+
+        Args:
+            socket: Das Socket-Object, von dem gelesen wird.
+        """
+        self.socket = socket
+        self.buffer = bytearray(KOCHA_BUFSIZE)
+        self.view = memoryview(self.buffer)
+
+        # Beginn des naechsten Frames, Ende der empfangenen Daten und
+        # die Position, ab der nach dem naechsten Trennzeichen gesucht
+        # wird (bereits durchsuchte Daten werden nicht erneut
+        # durchsucht)
+        self.start = 0
+        self.end = 0
+        self.scan = 0
+
+    def has_frame(self):
+        """
+        Gibt an, ob ein vollstaendiger Frame im Puffer liegt.
+
+        Returns:
+            True, wenn ein vollstaendiger Frame im Puffer liegt.
+        """
+        return self.buffer.find(
+            KOCHA_FRAME_DELIMITER, self.scan, self.end) != -1
+
+    def read_frame(self):
+        """
+        Den naechsten vollstaendigen Frame lesen und dafuer so oft wie
+        noetig vom Socket empfangen.
+
+        Returns:
+            Der Inhalt des Frames als str.
+
+        Raises:
+            ConnectionError: Wenn die Gegenseite die Verbindung
+                geschlossen hat.
+            ValueError: Wenn der Frame groeßer als KOCHA_MAX_FRAME_SIZE
+                ist.
+        """
+        while True:
+            index = self.buffer.find(
+                KOCHA_FRAME_DELIMITER, self.scan, self.end)
+            if index != -1:
+                break
+
+            self.scan = self.end
+            self.fill()
+
+        # Den Frame ohne Zwischenkopie direkt aus dem Puffer dekodieren
+        with self.view[self.start:index] as frame:
+            data = str(frame, "utf-8")
+
+        self.start = self.scan = index + 1
+
+        # Ist der Puffer vollstaendig gelesen, wieder von vorne
+        # beginnen. Ein zuvor gewachsener Puffer wird dabei wieder
+        # freigegeben
+        if self.start == self.end:
+            self.start = self.end = self.scan = 0
+            if len(self.buffer) > KOCHA_BUFSIZE:
+                self.resize(KOCHA_BUFSIZE)
+
+        return data
+
+    def fill(self):
+        """
+        Daten vom Socket an das Ende des Puffers empfangen. Vorher wird
+        bei Bedarf Platz geschaffen.
+
+        Raises:
+            ConnectionError: Wenn die Gegenseite die Verbindung
+                geschlossen hat.
+            ValueError: Wenn ein Frame groeßer als KOCHA_MAX_FRAME_SIZE
+                ist.
+        """
+        if self.end == len(self.buffer):
+            if self.start > 0:
+                # Ungelesene Daten an den Anfang verschieben (ueber eine
+                # Kopie, da sich Quelle und Ziel ueberlappen koennen)
+                length = self.end - self.start
+                unread = self.view[self.start:self.end].tobytes()
+                self.buffer[:length] = unread
+                self.scan -= self.start
+                self.start, self.end = 0, length
+            elif len(self.buffer) < KOCHA_MAX_FRAME_SIZE:
+                self.resize(min(len(self.buffer) * 2, KOCHA_MAX_FRAME_SIZE))
+            else:
+                raise ValueError("Frame exceeds KOCHA_MAX_FRAME_SIZE")
+
+        with self.view[self.end:] as free:
+            received = self.socket.recv_into(free)
+        if not received:
+            raise ConnectionError("Connection closed by peer")
+        self.end += received
+
+    def unread(self):
+        """
+        Gibt die empfangenen, aber noch nicht gelesenen Daten zurueck.
+
+        Returns:
+            Die ungelesenen Daten als bytes.
+        """
+        return self.view[self.start:self.end].tobytes()
+
+    def feed(self, data):
+        """
+        Daten an das Ende des Puffers anhaengen, als waeren sie vom
+        Socket empfangen worden.
+
+        Args:
+            data: Die Daten als bytes.
+        """
+        size = self.end + len(data)
+        if size > len(self.buffer):
+            self.resize(size)
+        self.buffer[self.end:size] = data
+        self.end = size
+
+    def resize(self, size):
+        """
+        Die Groeße des Puffers aendern und dabei die ungelesenen Daten
+        erhalten.
+
+        Args:
+            size: Die neue Groeße in Bytes.
+        """
+        buffer = bytearray(size)
+        buffer[:self.end] = self.view[:self.end]
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+
+class KochaMemorySocket:
+    """
+    Klasse bildet die von KochaFrameReader, KochaFrameWriter und dem
+    KOCHA-Server genutzten Methoden eines Sockets im Speicher nach. Zwei
+    mit pair erzeugte KochaMemorySockets sind miteinander verbunden;
+    was auf den einen geschrieben wird, kann vom anderen gelesen
+    werden.
+
+    So lassen sich viele virtuelle Clients ohne Netzwerk und ohne
+    Systemaufrufe im selben Prozess durch die Logik des KOCHA-Servers
+    schicken (siehe KochaTcpServer.connect_memory). Gesendete Daten
+    werden unbegrenzt gepuffert.
+    """
+
+    __slots__ = ("peer", "buffer", "condition", "eof", "closed", "timeout")
+
+    family = None
+    """
+    Die Adressfamilie. Ein KochaMemorySocket gehoert zu keiner.
+    """
+
+    def __init__(self):
+        """
+        Initialisiert ein Object der Klasse KochaMemorySocket. Verbunden
+        wird er erst durch pair.
+        """
+        self.peer = None
+
+        # Vom Gegenueber geschriebene, noch nicht gelesene Daten und das
+        # Signal, dass das Gegenueber nichts mehr schreibt
+        self.buffer = bytearray()
+        self.condition = threading.Condition(threading.Lock())
+        self.eof = False
+
+        self.closed = False
+        self.timeout = None
+
+    @classmethod
+    def pair(cls):
+        """
+        Zwei miteinander verbundene KochaMemorySockets erzeugen (analog
+        zu socket.socketpair).
+
+        Returns:
+            Tupel aus den beiden KochaMemorySockets.
+        """
+        first, second = cls(), cls()
+        first.peer, second.peer = second, first
+        return first, second
+
+    def fileno(self):
+        """
+        Gibt den Dateideskriptor zurueck. Ein KochaMemorySocket hat
+        keinen, daher kann er z.B. nicht bei einem Neustart uebergeben
+        werden.
+
+        Returns:
+            Immer -1.
+        """
+        return -1
+
+    def settimeout(self, timeout):
+        """
+        Den Timeout fuer das Empfangen setzen.
+
+        Args:
+            timeout: Der Timeout in Sekunden, 0 fuer nicht blockierend
+                oder None fuer unbegrenzt.
+        """
+        self.timeout = timeout
+
+    def setblocking(self, flag):
+        """
+        Festlegen, ob das Empfangen blockiert.
+
+        Args:
+            flag: False fuer nicht blockierend.
+        """
+        self.timeout = None if flag else 0.0
+
+    def setsockopt(self, *args):
+        """
+        Socket-Optionen haben keine Wirkung.
+        """
+
+    def sendmsg(self, buffers):
+        """
+        Mehrere Puffer an das Gegenueber senden.
+
+        Args:
+            buffers: Die Puffer (bytes-artige Objects).
+
+        Returns:
+            Die Anzahl der gesendeten Bytes.
+
+        Raises:
+            OSError: Wenn dieser KochaMemorySocket geschlossen ist.
+            BrokenPipeError: Wenn das Gegenueber geschlossen ist.
+        """
+        if self.closed:
+            raise OSError(9, "Bad file descriptor")
+
+        peer = self.peer
+        with peer.condition:
+            if peer.closed or peer.eof:
+                raise BrokenPipeError(32, "Broken pipe")
+            size = len(peer.buffer)
+            for buffer in buffers:
+                peer.buffer += buffer
+            peer.condition.notify()
+            return len(peer.buffer) - size
+
+    def sendall(self, data):
+        """
+        Daten vollstaendig an das Gegenueber senden.
+
+        Args:
+            data: Die Daten als bytes.
+        """
+        self.sendmsg((data,))
+
+    def recv_into(self, buffer, nbytes=0):
+        """
+        Daten des Gegenuebers in einen Puffer empfangen. Wartet dafuer
+        hoechstens timeout Sekunden.
+
+        Args:
+            buffer: Der beschreibbare Puffer.
+            nbytes: Die maximale Anzahl an Bytes oder 0 fuer die Groeße
+                des Puffers.
+
+        Returns:
+            Die Anzahl der empfangenen Bytes, 0 wenn das Gegenueber
+            nichts mehr sendet.
+
+        Raises:
+            OSError: Wenn dieser KochaMemorySocket geschlossen ist.
+            BlockingIOError: Wenn nicht blockierend empfangen wird und
+                keine Daten vorliegen.
+            socket.timeout: Wenn innerhalb des Timeouts keine Daten
+                eingetroffen sind.
+        """
+        with self.condition:
+            if self.closed:
+                raise OSError(9, "Bad file descriptor")
+            if not self.buffer and not self.eof:
+                if self.timeout == 0:
+                    raise BlockingIOError(11, "Resource temporarily "
+                                              "unavailable")
+                if not self.condition.wait_for(
+                        lambda: self.buffer or self.eof or self.closed,
+                        self.timeout):
+                    raise socket.timeout("timed out")
+                if self.closed:
+                    raise OSError(9, "Bad file descriptor")
+
+            size = min(nbytes or len(buffer), len(self.buffer))
+            buffer[:size] = self.buffer[:size]
+            del self.buffer[:size]
+            return size
+
+    def recv(self, bufsize):
+        """
+        Daten des Gegenuebers empfangen (siehe recv_into).
+
+        Args:
+            bufsize: Die maximale Anzahl an Bytes.
+
+        Returns:
+            Die empfangenen Daten als bytes.
+        """
+        buffer = bytearray(bufsize)
+        size = self.recv_into(buffer)
+        return bytes(buffer[:size])
+
+    def shutdown(self, how):
+        """
+        Die Verbindung in einer oder beiden Richtungen beenden.
+
+        Args:
+            how: socket.SHUT_RD, socket.SHUT_WR oder socket.SHUT_RDWR.
+        """
+        if how in (socket.SHUT_WR, socket.SHUT_RDWR):
+            with self.peer.condition:
+                self.peer.eof = True
+                self.peer.condition.notify_all()
+        if how in (socket.SHUT_RD, socket.SHUT_RDWR):
+            with self.condition:
+                self.eof = True
+                self.condition.notify_all()
+
+    def close(self):
+        """
+        Den KochaMemorySocket schließen. Das Gegenueber empfaengt danach
+        das Ende der Verbindung.
+        """
+        if self.closed:
+            return
+        self.shutdown(socket.SHUT_RDWR)
+        with self.condition:
+            self.closed = True
+            self.buffer = bytearray()
+            self.condition.notify_all()
+
 
 class KochaTcpSocketWrapper:
     """
@@ -162,6 +923,11 @@ class KochaTcpSocketWrapper:
     zu vereinfachen.
     """
 
+    # Ohne __dict__, damit jede Verbindung moeglichst wenig Speicher
+    # belegt. Unterklassen ohne eigene __slots__ erhalten wieder ein
+    # __dict__
+    __slots__ = ("socket", "reader", "writer")
+
     def __init__(self, socket):
         """
         Initialisiert ein Object der Klasse KochaTcpSocketWrapper.
@@ -171,32 +937,75 @@ class KochaTcpSocketWrapper:
         """
         self.socket = socket
 
-    def send(self, message):
+        # Puffer fuer empfangene, aber noch nicht vollstaendige
+        # Nachrichten
+        self.reader = KochaFrameReader(socket)
+
+        # Ausgehende Frames sammeln und gemeinsam senden, damit sich
+        # Nachrichten mehrerer Threads im Datenstrom nicht vermischen
+        self.writer = KochaFrameWriter(socket)
+
+    def send(self, message, lane=KOCHA_LANE_DIRECT):
         """
         Eine Nachricht senden.
         
         Args:
-            message: Das KochaMessage-Object.
+            message: Das KochaMessage-Object oder eine Liste von
+                KochaMessage-Objects, die als ein Batch gesendet werden.
+            lane: Die Spur (KOCHA_LANE_*) der Nachricht.
+
+        Returns:
+            False, wenn das Senden fehlgeschlagen ist, sonst True.
+        """
+        return self.send_frame(JsonUtils.to_frame(message), lane)
+
+    def send_frame(self, frame, lane=KOCHA_LANE_DIRECT):
+        """
+        Einen bereits kodierten Frame senden. So muss eine Nachricht,
+        die an viele Clients geht, nur einmal kodiert werden.
+
+        Args:
+            frame: Die Bytes des Frames (siehe JsonUtils.to_frame).
+            lane: Die Spur (KOCHA_LANE_*) des Frames.
+
+        Returns:
+            False, wenn das Senden fehlgeschlagen ist, sonst True.
         """
-        data = JsonUtils.to_json(message)
-        try:
-            self.socket.sendall(data.encode())
-        except Exception as e:
-            print(e, file=sys.stderr)
+        return self.writer.write(frame, lane)
+
+    def has_pending(self):
+        """
+        Gibt an, ob bereits eine vollstaendige Nachricht im
+        Empfangspuffer liegt, receive also nicht blockiert.
+
+        Returns:
+            True, wenn eine Nachricht im Empfangspuffer liegt.
+        """
+        return self.reader.has_frame()
 
     def receive(self):
         """
         Eine Nachricht empfangen.
 
         Returns:
-            Die Nachricht.
+            Die Nachricht oder eine Liste von Nachrichten, falls ein
+            Batch empfangen wurde.
+
+        Raises:
+            ConnectionError: Wenn die Gegenseite die Verbindung
+                geschlossen hat.
         """
-        data = self.socket.recv(KOCHA_BUFSIZE)
+        data = self.reader.read_frame()
         message = JsonUtils.to_kocha_message(data)
         return message
 
     def close(self):
         """
-        Das Handle des gekapselten Socket-Objects schließen.
+        Noch vorgemerkte Frames senden und das Handle des gekapselten
+        Socket-Objects schließen.
         """
+        # Sonst gingen z.B. die Antworten auf die Anfragen verloren,
+        # die zusammen mit /q im selben Block bearbeitet wurden
+        if self.writer.queued:
+            self.writer.flush()
         self.socket.close()
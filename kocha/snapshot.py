@@ -0,0 +1,177 @@
+"""
+Modul zum regelmaeßigen Sichern des Zustands des KOCHA-Servers
+(Verlauf, Sequenznummern, Bestaetigungen und Direct-Messages fuer
+abgemeldete Nutzer) in eine kompakte Binaerdatei, aus der ein neu
+gestarteter KOCHA-Server ihn wiederherstellt.
+"""
+
+import datetime
+import logging
+import marshal
+import os
+import threading
+import time
+
+from kocha import shared
+
+KOCHA_SNAPSHOT_MAGIC = b"KOCHASNAP1" + bytes([marshal.version]) + b"\n"
+"""
+Die Kennung am Anfang jeder Sicherung. Sie enthaelt die Version des
+marshal-Formats, da sich dieses zwischen Python-Versionen aendern kann.
+"""
+
+KOCHA_SNAPSHOT_INTERVAL = 60.0
+"""
+Der Abstand in Sekunden zwischen zwei Sicherungen.
+"""
+
+logger = logging.getLogger(__name__)
+"""
+Der Logger fuer Sicherungen.
+"""
+
+
+class KochaSnapshot:
+    """
+    Klasse sichert den mit KochaTcpServer.get_state ermittelten Zustand
+    in einem eigenen Thread. Die Nachrichten werden dabei nicht als
+    JSON, sondern als Tupel abgelegt und mit marshal geschrieben, da
+    sich beides ein Vielfaches schneller lesen laesst.
+
+    Die Datei wird erst vollstaendig unter einem temporaeren Namen
+    geschrieben und dann ersetzt, sodass immer eine vollstaendige
+    Sicherung vorliegt.
+    """
+
+    def __init__(self, path, interval=KOCHA_SNAPSHOT_INTERVAL):
+        """
+        Initialisiert ein Object der Klasse KochaSnapshot.
+
+        Args:
+            path: Pfad der Sicherung.
+            interval: Der Abstand in Sekunden zwischen zwei
+                Sicherungen.
+        """
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+        self.collect = None
+
+    @staticmethod
+    def pack(message):
+        """
+        Eine Nachricht fuer die Sicherung in ein Tupel umwandeln.
+
+        Args:
+            message: Das KochaMessage-Object.
+
+        Returns:
+            Tupel aus Inhalt, Sender, Zeitstempel, is_dm und
+            Sequenznummer.
+        """
+        return (message.content, message.sender,
+                message.sent_at.timestamp(), message.is_dm, message.seq)
+
+    @staticmethod
+    def unpack(data):
+        """
+        Eine mit pack umgewandelte Nachricht wiederherstellen.
+
+        Args:
+            data: Das Tupel.
+
+        Returns:
+            Das KochaMessage-Object.
+        """
+        content, sender, sent_at, is_dm, seq = data
+        return shared.KochaMessage(
+            content, sender, datetime.datetime.fromtimestamp(sent_at),
+            is_dm, seq)
+
+    def load(self):
+        """
+        Die letzte Sicherung lesen.
+
+        Returns:
+            Das Dictionary mit dem Zustand oder None, wenn keine
+            lesbare Sicherung vorliegt.
+        """
+        try:
+            with open(self.path, "rb") as file:
+                data = file.read()
+        except FileNotFoundError:
+            return None
+
+        if not data.startswith(KOCHA_SNAPSHOT_MAGIC):
+            logger.warning("Ignoring unreadable snapshot %s", self.path)
+            return None
+        try:
+            return marshal.loads(
+                memoryview(data)[len(KOCHA_SNAPSHOT_MAGIC):])
+        except (EOFError, ValueError, TypeError):
+            logger.warning("Ignoring unreadable snapshot %s", self.path)
+            return None
+
+    def save(self, state):
+        """
+        Den Zustand sichern.
+
+        Args:
+            state: Das Dictionary mit dem Zustand (siehe
+                KochaTcpServer.get_state mit encode=pack).
+        """
+        start = time.monotonic()
+        data = marshal.dumps(state)
+
+        # Zuerst vollstaendig auf den Datentraeger schreiben, dann die
+        # alte Sicherung in einem Schritt ersetzen
+        path = self.path + ".tmp"
+        with open(path, "wb") as file:
+            file.write(KOCHA_SNAPSHOT_MAGIC)
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path, self.path)
+
+        logger.debug(
+            "Saved snapshot in %.1f ms", (time.monotonic() - start) * 1e3,
+            extra={"bytes": len(data)})
+
+    def start(self, collect):
+        """
+        Den Zustand in einem eigenen Thread alle interval Sekunden
+        sichern.
+
+        Args:
+            collect: Funktion ohne Parameter, die den Zustand liefert.
+        """
+        self.collect = collect
+        self.thread = threading.Thread(
+            target=self.run, name="snapshot", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """
+        Den Zustand alle interval Sekunden sichern, bis stop aufgerufen
+        wird.
+        """
+        while not self.stopped.wait(self.interval):
+            try:
+                self.save(self.collect())
+            except OSError as e:
+                # Z.B. Datentraeger voll. Beim naechsten Mal erneut
+                # versuchen
+                logger.error("Snapshot failed: %s", e)
+            except Exception:
+                # Ein Fehler beim Sammeln des Zustands darf den Thread
+                # nicht beenden, sonst wird nie wieder gesichert
+                logger.exception("Snapshot failed")
+
+    def stop(self):
+        """
+        Den Thread beenden.
+        """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
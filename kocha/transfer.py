@@ -0,0 +1,480 @@
+"""
+Modul fuer die Uebertragung von Dateien zwischen KOCHA-Clients.
+
+Eine Datei wird in Chunks zerlegt, die der KOCHA-Server einzeln und
+ohne sie zu sammeln an den Empfaenger weiterleitet. Zwischen den Chunks
+koennen jederzeit normale Nachrichten gesendet werden. Die Kommandos
+lauten (``<user>`` ist jeweils die Gegenseite):
+
+    /send <user> <id> <size> <name>    Angebot des Senders
+    /accept <user> <id> <offset>       Empfangen bis offset bestaetigt
+    /chunk <user> <id> <offset> <data> Daten ab offset (Base64)
+    /cancel <user> <id>                Abbruch durch eine der Seiten
+
+/accept dient zugleich der Flusskontrolle und der Wiederaufnahme: Der
+Sender hat hoechstens KOCHA_TRANSFER_WINDOW Bytes unbestaetigt
+ausstehen und setzt nach einem erneuten Angebot an der bestaetigten
+Stelle fort.
+"""
+
+import base64
+import hashlib
+import os
+import re
+import threading
+
+from kocha import shared
+
+KOCHA_TRANSFER_COMMANDS = ("/send", "/accept", "/chunk", "/cancel")
+"""
+Die Kommandos der Dateiuebertragung.
+"""
+
+KOCHA_TRANSFER_CHUNK_SIZE = 32 * 1024
+"""
+Die Groeße eines Chunks in Bytes (vor der Base64-Kodierung). Eine
+Nachricht wartet hoechstens auf einen Chunk derselben Verbindung.
+"""
+
+KOCHA_TRANSFER_ID_PATTERN = re.compile(r"[0-9a-f]+")
+"""
+Regulaerer Ausdruck fuer die Id einer Uebertragung (siehe
+KochaTransfers.offer). Die Id wird Teil des Namens der .part-Datei,
+daher werden andere Ids der Gegenseite abgelehnt.
+"""
+
+KOCHA_TRANSFER_WINDOW = 8 * KOCHA_TRANSFER_CHUNK_SIZE
+"""
+Die maximale Anzahl an Bytes, die der Sender ohne Bestaetigung des
+Empfaengers ausstehen hat. Sie begrenzt auch, wie viel der KOCHA-Server
+je Uebertragung hoechstens in seinen Puffern haelt.
+"""
+
+
+class KochaTransfers:
+    """
+    Klasse verwaltet die ausgehenden und eingehenden Dateiuebertragungen
+    eines KOCHA-Clients.
+
+    Jede ausgehende Uebertragung sendet ihre Chunks in einem eigenen
+    Thread. Eingehende Dateien werden zunaechst als ``.part``-Datei im
+    Downloadverzeichnis geschrieben, sodass ein erneutes Angebot
+    derselben Datei (gleiche Id) an der bereits empfangenen Stelle
+    fortgesetzt wird, auch nach einem Neustart des Empfaengers.
+    """
+
+    def __init__(self, kocha_tcp_client, directory=".", notify=print):
+        """
+        Initialisiert ein Object der Klasse KochaTransfers.
+
+        Args:
+            kocha_tcp_client: Der angemeldete KochaTcpClient.
+            directory: Das Verzeichnis fuer empfangene Dateien.
+            notify: Funktion, die Statusmeldungen (str) anzeigt. Sie
+                wird aus beliebigen Threads aufgerufen.
+        """
+        self.kocha_tcp_client = kocha_tcp_client
+        self.directory = directory
+        self.notify = notify
+
+        # Die ausgehenden Uebertragungen je Empfaenger und Id als
+        # Dictionary mit Pfad, Groeße, gesendeter und bestaetigter
+        # Stelle und dem sendenden Thread
+        self.outgoing = {}
+
+        # Die eingehenden Uebertragungen je Sender und Id als
+        # Dictionary mit Name, Groeße, Pfad der .part-Datei und der
+        # geoeffneten Datei (None, solange nicht angenommen)
+        self.incoming = {}
+
+        self.condition = threading.Condition()
+        self.stop = False
+
+    def offer(self, alias, path):
+        """
+        Einem Nutzer eine Datei anbieten. Gesendet wird erst, wenn er
+        das Angebot annimmt.
+
+        Args:
+            alias: Der Alias des Empfaengers.
+            path: Der Pfad der Datei.
+
+        Raises:
+            OSError: Wenn die Datei nicht gelesen werden kann.
+        """
+        stat = os.stat(path)
+        name = os.path.basename(path)
+
+        # Dieselbe unveraenderte Datei erhaelt dieselbe Id, damit der
+        # Empfaenger eine abgebrochene Uebertragung fortsetzen kann
+        key = "{}\0{}\0{}".format(
+            os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        transfer_id = hashlib.blake2b(key.encode(), digest_size=4).hexdigest()
+
+        with self.condition:
+            self.outgoing[(alias, transfer_id)] = {
+                "path": path,
+                "size": stat.st_size,
+                "sent": 0,
+                "acked": 0,
+                "resumed": False,
+                "thread": None,
+            }
+
+        self.send("/send {} {} {} {}".format(
+            alias, transfer_id, stat.st_size, name))
+        self.notify("Offered {} ({} bytes) to {}.".format(
+            name, stat.st_size, alias))
+
+    def accept(self, alias, transfer_id):
+        """
+        Ein Angebot annehmen und ab der bereits empfangenen Stelle
+        empfangen.
+
+        Args:
+            alias: Der Alias des Senders.
+            transfer_id: Die Id der Uebertragung.
+        """
+        with self.condition:
+            transfer = self.incoming.get((alias, transfer_id))
+            if transfer is None:
+                self.notify("No file offered by {} with id {}.".format(
+                    alias, transfer_id))
+                return
+            error = None
+            if transfer["file"] is None:
+                try:
+                    transfer["file"] = open(transfer["part"], "ab")
+                except OSError as e:
+                    error = e
+            if error is None:
+                offset = transfer["file"].tell()
+
+        # Kann die .part-Datei nicht geschrieben werden, die
+        # Uebertragung bei beiden Seiten abbrechen
+        if error is not None:
+            self.notify(str(error))
+            self.cancel(alias, transfer_id)
+            return
+
+        self.send("/accept {} {} {}".format(alias, transfer_id, offset))
+
+    def cancel(self, alias, transfer_id, notify_peer=True):
+        """
+        Eine Uebertragung in beliebiger Richtung abbrechen. Bereits
+        empfangene Daten bleiben fuer eine spaetere Wiederaufnahme
+        erhalten.
+
+        Args:
+            alias: Der Alias der Gegenseite.
+            transfer_id: Die Id der Uebertragung.
+            notify_peer: Gibt an, ob die Gegenseite informiert wird.
+        """
+        with self.condition:
+            outgoing = self.outgoing.pop((alias, transfer_id), None)
+            incoming = self.incoming.pop((alias, transfer_id), None)
+            self.condition.notify_all()
+
+        if incoming is not None and incoming["file"] is not None:
+            incoming["file"].close()
+        if outgoing is None and incoming is None:
+            return
+
+        if notify_peer:
+            self.send("/cancel {} {}".format(alias, transfer_id))
+        self.notify("Transfer {} with {} cancelled.".format(
+            transfer_id, alias))
+
+    def resume(self):
+        """
+        Alle unvollstaendigen ausgehenden Uebertragungen erneut
+        anbieten, z.B. nach dem Wiederherstellen der Verbindung. Hatte
+        der Empfaenger angenommen, setzt er automatisch fort.
+        """
+        with self.condition:
+            outgoing = list(self.outgoing.items())
+
+            # Mit der alten Verbindung verlorene Chunks ab der naechsten
+            # Bestaetigung erneut senden
+            for _, transfer in outgoing:
+                transfer["resumed"] = True
+
+        for (alias, transfer_id), transfer in outgoing:
+            self.send("/send {} {} {} {}".format(
+                alias,
+                transfer_id,
+                transfer["size"],
+                os.path.basename(transfer["path"])))
+
+    def close(self):
+        """
+        Alle sendenden Threads beenden. Empfangene Teile bleiben
+        erhalten.
+        """
+        with self.condition:
+            self.stop = True
+            self.condition.notify_all()
+            threads = [
+                transfer["thread"] for transfer in self.outgoing.values()
+                if transfer["thread"] is not None]
+            files = [
+                transfer["file"] for transfer in self.incoming.values()
+                if transfer["file"] is not None]
+
+        for thread in threads:
+            thread.join()
+        for file in files:
+            file.close()
+
+    def handle(self, message):
+        """
+        Eine vom KOCHA-Server weitergeleitete Nachricht der
+        Dateiuebertragung bearbeiten.
+
+        Args:
+            message: Das empfangene KochaMessage-Object.
+
+        Returns:
+            True, wenn die Nachricht zur Dateiuebertragung gehoerte und
+            nicht angezeigt werden soll, sonst False.
+        """
+        if (isinstance(message, list)
+                or not message.is_dm
+                or not message.content.startswith(KOCHA_TRANSFER_COMMANDS)):
+            return False
+
+        try:
+            command, alias, transfer_id, *args = message.content.split(
+                " ", 4 if message.content.startswith("/send ") else 3)
+        except ValueError:
+            return False
+
+        # Nur vom KOCHA-Server weitergeleitete Nachrichten, bei denen
+        # der Absender zur Gegenseite passt
+        if message.sender != alias:
+            if message.sender == shared.KOCHA_SERVER_ALIAS and (
+                    command == "/cancel"):
+                # Die Gegenseite ist nicht angemeldet. Ausgehende
+                # Uebertragungen abbrechen; eingehende bleiben offen,
+                # da der Sender sie nach dem erneuten Verbinden wieder
+                # anbietet
+                with self.condition:
+                    outgoing = (alias, transfer_id) in self.outgoing
+                if outgoing:
+                    self.notify("{} is not online.".format(alias))
+                    self.cancel(alias, transfer_id, notify_peer=False)
+                return True
+            return False
+
+        try:
+            if command == "/send":
+                self.on_offer(alias, transfer_id, int(args[0]), args[1])
+            elif command == "/accept":
+                self.on_accept(alias, transfer_id, int(args[0]))
+            elif command == "/chunk":
+                offset, data = args[0].split(" ", 1)
+                self.on_chunk(alias, transfer_id, int(offset), data)
+            elif command == "/cancel":
+                self.cancel(alias, transfer_id, notify_peer=False)
+        except (IndexError, ValueError):
+            pass
+        return True
+
+    def on_offer(self, alias, transfer_id, size, name):
+        """
+        Ein Angebot eines anderen Nutzers bearbeiten. Ist es ein
+        erneutes Angebot einer bereits angenommenen Uebertragung, wird
+        sie sofort fortgesetzt.
+
+        Args:
+            alias: Der Alias des Senders.
+            transfer_id: Die Id der Uebertragung.
+            size: Die Groeße der Datei in Bytes.
+            name: Der Dateiname.
+        """
+        # Nur den Dateinamen und Ids im Format von offer verwenden,
+        # damit der Sender nicht außerhalb des Downloadverzeichnisses
+        # schreiben kann
+        name = os.path.basename(name)
+        if (name in ("", ".", "..")
+                or not KOCHA_TRANSFER_ID_PATTERN.fullmatch(transfer_id)):
+            self.send("/cancel {} {}".format(alias, transfer_id))
+            return
+
+        with self.condition:
+            transfer = self.incoming.get((alias, transfer_id))
+            if transfer is None:
+                part = os.path.join(
+                    self.directory, "{}.{}.part".format(name, transfer_id))
+                self.incoming[(alias, transfer_id)] = {
+                    "name": name,
+                    "size": size,
+                    "part": part,
+                    "file": None,
+                }
+                resumable = os.path.exists(part)
+            elif transfer["file"] is None:
+                resumable = os.path.exists(transfer["part"])
+            else:
+                resumable = None
+
+        if resumable is None:
+            self.accept(alias, transfer_id)
+            return
+
+        self.notify(
+            "{} offers {} ({} bytes{}). Type /accept {} {} to receive "
+            "it.".format(
+                alias,
+                name,
+                size,
+                ", partially received" if resumable else "",
+                alias,
+                transfer_id))
+
+    def on_accept(self, alias, transfer_id, offset):
+        """
+        Eine Bestaetigung des Empfaengers bearbeiten und beim ersten
+        Mal den sendenden Thread starten.
+
+        Args:
+            alias: Der Alias des Empfaengers.
+            transfer_id: Die Id der Uebertragung.
+            offset: Die Anzahl der beim Empfaenger vorliegenden Bytes.
+        """
+        with self.condition:
+            transfer = self.outgoing.get((alias, transfer_id))
+            if transfer is None:
+                return
+
+            # Bei einer Wiederaufnahme ab der bestaetigten Stelle erneut
+            # senden
+            if transfer["resumed"] or offset > transfer["sent"]:
+                transfer["sent"] = offset
+                transfer["resumed"] = False
+            transfer["acked"] = offset
+            self.condition.notify_all()
+
+            done = offset >= transfer["size"]
+            if done:
+                del self.outgoing[(alias, transfer_id)]
+            elif transfer["thread"] is None:
+                transfer["thread"] = threading.Thread(
+                    target=self.run,
+                    args=(alias, transfer_id, transfer),
+                    daemon=True)
+                transfer["thread"].start()
+
+        if done:
+            self.notify("Sent {} to {}.".format(
+                os.path.basename(transfer["path"]), alias))
+
+    def on_chunk(self, alias, transfer_id, offset, data):
+        """
+        Einen Chunk in die .part-Datei schreiben und bestaetigen. Ist
+        die Datei vollstaendig, wird sie umbenannt.
+
+        Args:
+            alias: Der Alias des Senders.
+            transfer_id: Die Id der Uebertragung.
+            offset: Die Stelle des Chunks in der Datei.
+            data: Die Daten des Chunks (Base64).
+        """
+        with self.condition:
+            transfer = self.incoming.get((alias, transfer_id))
+            if transfer is None or transfer["file"] is None:
+                return
+            file = transfer["file"]
+
+            # Chunks, die nicht an die empfangene Stelle passen (z.B.
+            # nach einer Wiederaufnahme noch unterwegs), verwerfen
+            if offset != file.tell():
+                return
+            file.write(base64.b64decode(data))
+            received = file.tell()
+
+            done = received >= transfer["size"]
+            if done:
+                file.close()
+                del self.incoming[(alias, transfer_id)]
+
+        self.send("/accept {} {} {}".format(alias, transfer_id, received))
+        if not done:
+            return
+
+        # Die fertige Datei unter einem noch freien Namen ablegen
+        path = os.path.join(self.directory, transfer["name"])
+        root, extension = os.path.splitext(path)
+        number = 1
+        while os.path.exists(path):
+            path = "{}.{}{}".format(root, number, extension)
+            number += 1
+        os.replace(transfer["part"], path)
+        self.notify("Received {} from {}.".format(path, alias))
+
+    def run(self, alias, transfer_id, transfer):
+        """
+        Die Chunks einer ausgehenden Uebertragung senden und dabei nie
+        mehr als KOCHA_TRANSFER_WINDOW Bytes unbestaetigt ausstehen
+        haben.
+
+        Args:
+            alias: Der Alias des Empfaengers.
+            transfer_id: Die Id der Uebertragung.
+            transfer: Das Dictionary der Uebertragung.
+        """
+        try:
+            file = open(transfer["path"], "rb")
+        except OSError as e:
+            self.notify(str(e))
+            self.cancel(alias, transfer_id)
+            return
+
+        with file:
+            while True:
+                with self.condition:
+                    # Auf Bestaetigungen warten, bis das Fenster wieder
+                    # Platz bietet
+                    self.condition.wait_for(lambda: (
+                        self.stop
+                        or self.outgoing.get((alias, transfer_id))
+                        is not transfer
+                        or (transfer["sent"] < transfer["size"]
+                            and transfer["sent"] - transfer["acked"]
+                            < KOCHA_TRANSFER_WINDOW)))
+                    if (self.stop or self.outgoing.get((alias, transfer_id))
+                            is not transfer):
+                        return
+                    offset = transfer["sent"]
+                    file.seek(offset)
+                    data = file.read(KOCHA_TRANSFER_CHUNK_SIZE)
+                    transfer["sent"] = offset + len(data)
+
+                # Die Datei wurde waehrend der Uebertragung gekuerzt
+                if not data:
+                    self.notify("{} changed during the transfer.".format(
+                        transfer["path"]))
+                    self.cancel(alias, transfer_id)
+                    return
+
+                # Jeder Chunk ist ein eigener Frame in der niedrigsten
+                # Spur, daher ziehen Nachrichten an wartenden Chunks
+                # vorbei
+                self.send(
+                    "/chunk {} {} {} {}".format(
+                        alias,
+                        transfer_id,
+                        offset,
+                        base64.b64encode(data).decode()),
+                    shared.KOCHA_LANE_BULK)
+
+    def send(self, content, lane=shared.KOCHA_LANE_DIRECT):
+        """
+        Ein Kommando der Dateiuebertragung an den KOCHA-Server senden.
+
+        Args:
+            content: Der Inhalt der Nachricht.
+            lane: Die Spur (KOCHA_LANE_*) der Nachricht.
+        """
+        self.kocha_tcp_client.send(
+            shared.KochaMessage(content=content), lane)
@@ -6,7 +6,11 @@
 HOST=$(hostname)
 PORT=9999
 PYTHON3=$(which python3)
-CMD="$PYTHON3 -m kocha.server $HOST $PORT"
+HANDOFF=/run/kocha.handoff
+LOG=/var/log/kocha/server.log
+ADMIN=/run/kocha.admin
+CMD="$PYTHON3 -m kocha.server $HOST $PORT --handoff $HANDOFF --log-file $LOG \
+--admin $ADMIN"
 
 # Eingehende Anfragen ueber TCP/IP auf Port erlauben
 sudo ufw allow proto tcp from 192.168.10.0/24 to any port "$PORT"
@@ -25,5 +29,10 @@ fi
 # Befehl ausfuehren
 #sudo crontab -l 2>/dev/null | grep -v "@reboot $CMD" | sudo crontab -
 
-# KOCHA-Server jetzt starten
-$CMD 2>/dev/null &
\ No newline at end of file
+# KOCHA-Server jetzt starten. Laeuft bereits ein KOCHA-Server (z.B.
+# nach einem Update), uebernimmt der neue KOCHA-Server ueber $HANDOFF
+# alle Verbindungen, ohne dass die Clients getrennt werden. Das
+# Protokoll landet rotierend in $LOG. Verwaltet wird der KOCHA-Server
+# mit "sudo python3 -m kocha.admin $ADMIN list" usw.
+sudo mkdir -p "$(dirname "$LOG")"
+$CMD &
\ No newline at end of file
@@ -13,7 +13,7 @@ setup(
     long_description=readme,
     long_description_content_type="text/markdown",
     author="Daniel Schmitt",
-    python_requires=">=3.6.0",
+    python_requires=">=3.9.0",
     license=license,
     packages=find_packages()
 )